@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Benchmarks for the G-code path containers.
+#   python bench_gcode.py memory [points]   - bytes per point of a path as GPoint objects and as Toolpath
+#   python bench_gcode.py parse [file]      - parser throughput in lines/s (synthetic program without a file),
+#                                             for a file also sequential and parallel chunked reading
+#   python bench_gcode.py write [points]    - time and peak memory of writing a path to a file
+#   python bench_gcode.py estimate [points] - time of the simple and the planner cycle time estimates
+import sys
+import time
+import tracemalloc
+import os
+
+from numpy import *
+from gcode import *
+from toolpath import Toolpath
+
+
+def traced_bytes(build):
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    result = build()
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return used, result
+
+
+def bench_memory(count):
+    positions = random.rand(count, 3)*100.0
+    rows = positions.tolist()
+    used, path = traced_bytes(lambda: [GPoint(position=p) for p in rows])
+    print("GPoint list: %i points, %.1f bytes/point" % (count, used/float(count)))
+    del path
+    used, path = traced_bytes(lambda: Toolpath.fromArrays(positions))
+    print("Toolpath:    %i points, %.1f bytes/point" % (count, used/float(count)))
+
+
+def synthetic_program(count):
+    lines = ["( synthetic test program )", "G90G21G17G54", "F1000"]
+    for i in range(0, count):
+        if i % 100 == 0:
+            lines.append("G0 X%f Y%f Z10.000000" % (i*0.01, i*0.02))
+        elif i % 37 == 0:
+            lines.append("G2 X%f Y%f I1.000000 J0.000000" % (i*0.01, i*0.02))
+        else:
+            lines.append("G1 X%f Y%f Z-1.000000 (cut)" % (i*0.01, i*0.02))
+    return lines
+
+
+def bench_parse(filename=None):
+    if filename is None:
+        lines = synthetic_program(500000)
+    else:
+        lines = open(filename).readlines()
+    start = time.time()
+    path = parse_gcode(lines)
+    elapsed = time.time()-start
+    print("parse: %i lines in %.2f s, %.0f lines/s" % (len(lines), elapsed, len(lines)/elapsed))
+    if filename is None:
+        return
+    from gcode_parser import GCodeReader
+    for name in ["readPath", "readPathParallel"]:
+        reader = GCodeReader(filename)
+        start = time.time()
+        path = getattr(reader, name)()
+        elapsed = time.time()-start
+        print("%s: %i lines in %.2f s, %.0f lines/s" % (name, len(reader), elapsed, len(reader)/elapsed))
+        reader.close()
+
+
+def bench_write(count):
+    import tempfile
+    positions = random.rand(count, 3)*100.0
+    path = Toolpath.fromArrays(positions, feedrate=1000.0)
+    path._flags[0:count:50] |= 1 # a rapid every 50 points
+    gcode = GCode(path=path)
+    filename = tempfile.mktemp(suffix=".ngc")
+    start = time.time()
+    gcode.write(filename)
+    elapsed = time.time()-start
+    # peak memory on a fifth of the path, tracing slows the writer down a lot
+    gcode = GCode(path=path[0:count//5])
+    tracemalloc.start()
+    gcode.write(filename)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("write: %i points in %.2f s, %.0f points/s, peak %.1f MB for %i points" % (count, elapsed, count/elapsed, peak/1e6, count//5))
+    os.remove(filename)
+
+
+def bench_estimate(count):
+    positions = cumsum(random.rand(count, 3)-0.5, axis=0)*10.0
+    path = Toolpath.fromArrays(positions, feedrate=1000.0)
+    path._flags[0:count:50] |= 1
+    gcode = GCode(path=path)
+    for name in ["estimate", "plannerEstimate"]:
+        start = time.time()
+        estimate = getattr(gcode, name)()
+        elapsed = time.time()-start
+        print("%s: %i points in %.2f s, %.1f min" % (name, count, elapsed, estimate[1]))
+
+
+if __name__ == "__main__":
+    mode = sys.argv[1] if len(sys.argv) > 1 else "memory"
+    if mode == "memory":
+        bench_memory(int(sys.argv[2]) if len(sys.argv) > 2 else 1000000)
+    if mode == "parse":
+        bench_parse(sys.argv[2] if len(sys.argv) > 2 else None)
+    if mode == "write":
+        bench_write(int(sys.argv[2]) if len(sys.argv) > 2 else 1000000)
+    if mode == "estimate":
+        bench_estimate(int(sys.argv[2]) if len(sys.argv) > 2 else 1000000)
@@ -1,15 +1,41 @@
 from numpy import *
 from geometry import *
 import traceback
+import re
+from planner import *
+
+# axis mapping/scaling shared by all points of a path; interned so that a million points
+# with the same configuration reference one object instead of three lists each
+class AxisConfig:
+    __slots__ = ("axis_mapping", "axis_scaling", "rot_axis_mapping")
+
+    def __init__(self, axis_mapping, axis_scaling, rot_axis_mapping):
+        self.axis_mapping = axis_mapping
+        self.axis_scaling = axis_scaling
+        self.rot_axis_mapping = rot_axis_mapping
+
+    def __reduce__(self):
+        return (axis_config, (self.axis_mapping, self.axis_scaling, self.rot_axis_mapping))
+
+_axis_configs = {}
+
+def axis_config(axis_mapping, axis_scaling, rot_axis_mapping):
+    key = (tuple(axis_mapping), tuple(axis_scaling), tuple(rot_axis_mapping))
+    config = _axis_configs.get(key)
+    if config is None:
+        config = AxisConfig(axis_mapping, axis_scaling, rot_axis_mapping)
+        _axis_configs[key] = config
+    return config
+
 
 class GCommand:
+    __slots__ = ("command", "axes", "control_point", "feedrate", "rapid", "position", "rotation", "line_number", "interpolated")
+
     def __init__(self, command="", position=None, rotation=None, feedrate=None, rapid=False,
                  control_point=True, line_number=0,
                  axis_mapping = ["X", "Y", "Z"], axis_scaling = [1.0, 1.0, 1,0], rot_axis_mapping=["A", "B", "C"]):
         self.command = command
-        self.axis_mapping = axis_mapping
-        self.axis_scaling = axis_scaling
-        self.rot_axis_mapping=  rot_axis_mapping
+        self.axes = axis_config(axis_mapping, axis_scaling, rot_axis_mapping)
         self.control_point = control_point
         self.feedrate = feedrate
         self.rapid = rapid
@@ -18,6 +44,30 @@ class GCommand:
         self.line_number=line_number
         self.interpolated=False
 
+    @property
+    def axis_mapping(self):
+        return self.axes.axis_mapping
+
+    @axis_mapping.setter
+    def axis_mapping(self, value):
+        self.axes = axis_config(value, self.axes.axis_scaling, self.axes.rot_axis_mapping)
+
+    @property
+    def axis_scaling(self):
+        return self.axes.axis_scaling
+
+    @axis_scaling.setter
+    def axis_scaling(self, value):
+        self.axes = axis_config(self.axes.axis_mapping, value, self.axes.rot_axis_mapping)
+
+    @property
+    def rot_axis_mapping(self):
+        return self.axes.rot_axis_mapping
+
+    @rot_axis_mapping.setter
+    def rot_axis_mapping(self, value):
+        self.axes = axis_config(self.axes.axis_mapping, self.axes.axis_scaling, value)
+
     def to_output(self):
         return "%s" % (self.command)
 
@@ -29,6 +79,9 @@ class GCommand:
 
 
 class GPoint(GCommand):
+    __slots__ = ("inside_model", "in_contact", "dist_from_model", "order")
+    current_system_feedrate = None
+
     def __init__(self, inside_model=True, control_point=False,
                  in_contact=True, interpolated = False, order=0, dist_from_model=None, **kwargs):
         GCommand.__init__(self,  **kwargs)
@@ -36,12 +89,14 @@ class GPoint(GCommand):
         self.inside_model = inside_model
         self.in_contact = in_contact
         self.dist_from_model = dist_from_model
-        self.current_system_feedrate = None
         self.interpolated=interpolated
         self.order = order  # indicates order of cascaded pocket paths - 0 is innermost (starting) path
-        self.gmode = "G1"
+
+    @property
+    def gmode(self):
         if self.rapid:
-            self.gmode = "G0"
+            return "G0"
+        return "G1"
 
     def z_to_output(self):
 
@@ -66,6 +121,8 @@ class GPoint(GCommand):
         return[(GPoint(position=self.position, rotation = self.rotation, feedrate=self.feedrate, rapid=self.rapid, line_number=self.line_number))]
 
 class GArc(GPoint):
+    __slots__ = ("ij", "arcdir")
+
     def __init__(self, ij=None, arcdir=None, control_point=False, **kwargs):
         GPoint.__init__(self, **kwargs)
         self.control_point = control_point
@@ -73,7 +130,10 @@ class GArc(GPoint):
         if arcdir is None:
             print("Error: undefined arc direction!")
         self.arcdir = arcdir
-        self.gmode = "G"+str(self.arcdir)
+
+    @property
+    def gmode(self):
+        return "G"+str(self.arcdir)
 
     def z_to_output(self):
         am = self.axis_mapping
@@ -92,42 +152,13 @@ class GArc(GPoint):
         return self.command
 
     def interpolate_to_points(self, current_pos):
-        arc_start = current_pos
-        path=[]
-        #print(arc_start, self.ij, self.position)
-        center = [arc_start[0] + self.ij[0], arc_start[1] + self.ij[1], self.position[2]]
-        start_angle = full_angle2d([arc_start[0] - center[0], arc_start[1] - center[1]], [1, 0])
-        end_angle = full_angle2d([self.position[0] - center[0], self.position[1] - center[1]], [1, 0])
-        angle_step = 0.05
-
-        angle = start_angle
-        radius = dist([center[0], center[1]], [arc_start[0], arc_start[1]])
-        radius2 = dist([center[0], center[1]], [self.position[0], self.position[1]])
-
+        radius = dist([0, 0], self.ij[0:2])
+        radius2 = dist([current_pos[0]+self.ij[0], current_pos[1]+self.ij[1]], self.position[0:2])
         if abs(radius-radius2)>0.01:
             print("radius mismatch:", radius, radius2)
-
-        if int(self.arcdir) == 3:
-            print(int(self.arcdir))
-            while end_angle > start_angle:
-                end_angle -= 2.0 * PI
-            while angle > end_angle:
-                path.append(
-                    GPoint(position=[center[0] + radius * cos(angle), center[1] - radius * sin(angle),
-                                     self.position[2]], feedrate=self.feedrate, rapid=self.rapid, interpolated=True, line_number=self.line_number));
-                angle -= angle_step
-
-        else:
-
-            while end_angle < start_angle:
-                end_angle += 2.0 * PI
-            while angle < end_angle:
-                path.append(
-                    GPoint(position=[center[0] + radius * cos(angle), center[1] - radius * sin(angle), self.position[2]],
-                           feedrate=self.feedrate, rapid=self.rapid, interpolated=True, line_number=self.line_number));
-                angle += angle_step
-
-        path.append(GPoint(position=self.position, feedrate=self.feedrate, rapid=self.rapid, line_number=self.line_number));
+        points, arc = discretize_arcs(current_pos[0:3], self.position[0:3], self.ij[0:2], self.arcdir)
+        path = [GPoint(position=p, feedrate=self.feedrate, rapid=self.rapid, interpolated=True, line_number=self.line_number) for p in points[:-1]]
+        path.append(GPoint(position=self.position, feedrate=self.feedrate, rapid=self.rapid, line_number=self.line_number))
         return path
 
 
@@ -143,6 +174,8 @@ class GCode:
         self.rapid_feedrate = 3000
         self.initialisation = "G90G21G17G54\n"
         self.laser_mode = False
+        self.compact = False # compact output: modal axes, trimmed numbers
+        self.precision = [3, 3, 3] # decimals per axis for compact output
         self.steppingAxis = 2 # major cutting axis for step-down (incremental cutting). Normally z-axis on mills.
 
 
@@ -164,40 +197,159 @@ class GCode:
     def combinePath(self, gcode):
         if gcode is None or gcode.path is None:
             return None
-        for p in gcode.path:
-            self.append(p)
-
-    def get_draw_path(self, start = 0, end=-1, start_rotation = [0,0,0], interpolate_arcs = True):
-        draw_path=[]
-        current_pos = [0,0,0]
-        current_rotation = None
-        line=1
-        for p in self.path[start:end]:
-            if p.line_number==0:
-                p.line_number=line
-            line = max(p.line_number+1, line+1)
-            try:
-                point_list=[GPoint(position=p.position, feedrate=p.feedrate, rapid=p.rapid, line_number=p.line_number)]
-                if interpolate_arcs:
-                    point_list = p.interpolate_to_points(current_pos)
-                for ip in point_list:
-                    if ip.position is None:
-                        ip.position = current_pos
-                    if ip.rotation is not None:
-                        current_rotation = ip.rotation
-                    else:
-                        if current_rotation is not None:
-                            ip.rotation = current_rotation
-                    if ip.rotation is not None: # apply rotation to path points for preview only
-
-                        ip.position = rotate_x(ip.position, ip.rotation[0] * PI / 180.0)
-                        ip.position = rotate_y(ip.position, ip.rotation[1] * PI / 180.0)
-                        ip.position = rotate_z(ip.position, ip.rotation[2] * PI / 180.0)
-                    draw_path.append(ip)
-            except:
-                traceback.print_exc()
-            if (len(draw_path)>1):
-                current_pos = draw_path[-1].position
+        self.path.extend(gcode.path)
+
+    # per-row columns of rows start..end-1 of the path (a Toolpath or a list of GCommands).
+    # Rows without a position have NaN positions, rotation is NaN where not set, arcs are given by
+    # their rows, ij and direction.
+    def pathArrays(self, start=0, end=None):
+        path = self.path
+        if end is None or end > len(path):
+            end = len(path)
+        if end < 0:
+            end += len(path)
+        n = max(end-start, 0)
+        rotation = full((n, 3), nan)
+        if hasattr(path, "commands"):
+            columns = {"position": path.position[start:end].copy(),
+                       "feedrate": path.feedrate[start:end].copy(),
+                       "rapid": path.rapid[start:end],
+                       "in_contact": path.in_contact[start:end],
+                       "inside_model": path.inside_model[start:end],
+                       "interpolated": path.interpolated[start:end],
+                       "line_number": path.line_number[start:end].astype(int64),
+                       "is_gpoint": ones(n, dtype=bool)}
+            for i, c in path.commands.items():
+                if start <= i < end:
+                    r = i-start
+                    columns["feedrate"][r] = nan if c.feedrate is None else c.feedrate
+                    columns["is_gpoint"][r] = isinstance(c, GPoint)
+                    if isinstance(c, GPoint):
+                        columns["rapid"][r] = bool(c.rapid)
+                        columns["in_contact"][r] = bool(c.in_contact)
+                        columns["inside_model"][r] = bool(c.inside_model)
+            for i, rot in path.rotations.items():
+                if start <= i < end:
+                    rotation[i-start] = rot[0:3]
+            slots = arange(searchsorted(path.arc_index, start), searchsorted(path.arc_index, end))
+            columns["arc_rows"] = path.arc_index[slots]-start
+            columns["arc_ij"] = path.arc_ij[slots]
+            columns["arc_dir"] = path.arc_dir[slots].astype(int)
+        else:
+            rows = path[start:end]
+            columns = {"position": array([p.position[0:3] if p.position is not None else [nan, nan, nan] for p in rows], dtype=float).reshape(-1, 3),
+                       "feedrate": array([nan if p.feedrate is None else p.feedrate for p in rows], dtype=float),
+                       "rapid": array([bool(p.rapid) for p in rows], dtype=bool),
+                       "in_contact": array([bool(getattr(p, "in_contact", True)) for p in rows], dtype=bool),
+                       "inside_model": array([bool(getattr(p, "inside_model", True)) for p in rows], dtype=bool),
+                       "interpolated": array([bool(p.interpolated) for p in rows], dtype=bool),
+                       "line_number": array([p.line_number for p in rows], dtype=int64),
+                       "is_gpoint": array([isinstance(p, GPoint) for p in rows], dtype=bool)}
+            arcs = [r for r, p in enumerate(rows) if isinstance(p, GArc) and p.position is not None]
+            for r, p in enumerate(rows):
+                if p.rotation is not None:
+                    rotation[r] = p.rotation[0:3]
+            columns["arc_rows"] = array(arcs, dtype=int64)
+            columns["arc_ij"] = array([rows[r].ij[0:2] for r in arcs], dtype=float).reshape(-1, 2)
+            columns["arc_dir"] = array([int(rows[r].arcdir) for r in arcs], dtype=int)
+        columns["rotation"] = rotation
+        return columns
+
+    # The path as arrays for drawing: rows without a position are drawn at the last position, arcs are
+    # interpolated within the chord tolerance, plain commands are skipped. Positions are rotated by the
+    # current rotation for preview (rotate=False for machine coordinates). Returns a dict of per-point
+    # arrays: position, row (index into the path), interpolated, rapid, in_contact, inside_model,
+    # feedrate (NaN if none), line_number and rotation.
+    def get_draw_arrays(self, start=0, end=None, interpolate_arcs=True, rotate=True, tolerance=None):
+        columns = self.pathArrays(start, end)
+        n = len(columns["feedrate"])
+        # rows without line numbers continue the numbering of the rows before them
+        line_number = columns["line_number"]
+        unnumbered = line_number == 0
+        if unnumbered.any():
+            rows = arange(n)
+            line = rows+maximum.accumulate(concatenate(([1], line_number[:-1]-rows[:-1])))
+            line_number = where(unnumbered, line, line_number)
+            self.setLineNumbers(start, line_number, unnumbered)
+
+        position = columns["position"]
+        has_position = ~isnan(position[:, 0])
+        last = maximum.accumulate(where(has_position, arange(n), -1)) if n > 0 else zeros(0, dtype=int64)
+        initial_position, initial_rotation = self.stateBefore(start)
+        filled = where((last >= 0)[:, newaxis], position[maximum(last, 0)], initial_position)
+
+        counts = ones(n, dtype=int64) if not interpolate_arcs else columns["is_gpoint"].astype(int64)
+        is_arc = zeros(n, dtype=bool)
+        if interpolate_arcs and len(columns["arc_rows"]) > 0:
+            arc_rows = columns["arc_rows"]
+            arc_start = where((arc_rows > 0)[:, newaxis], filled[maximum(arc_rows-1, 0)], initial_position)
+            points, arc = discretize_arcs(arc_start, position[arc_rows], columns["arc_ij"], columns["arc_dir"], tolerance)
+            counts[arc_rows] = bincount(arc, minlength=len(arc_rows))
+            is_arc[arc_rows] = True
+        rows = repeat(arange(n), counts)
+        draw_position = filled[rows]
+        interpolated = columns["interpolated"][rows]
+        if is_arc.any():
+            arc_points = is_arc[rows]
+            draw_position[arc_points] = points
+            interpolated[arc_points] |= concatenate((arc[1:] == arc[:-1], [False]))
+
+        rotation = columns["rotation"]
+        rotated = ~isnan(rotation[:, 0])
+        last = maximum.accumulate(where(rotated, arange(n), -1)) if n > 0 else zeros(0, dtype=int64)
+        rotation = where((last >= 0)[:, newaxis], rotation[maximum(last, 0)], initial_rotation)[rows]
+        if rotate:
+            draw_position = rotate_points(draw_position, rotation)
+        return {"position": draw_position, "row": rows+start, "interpolated": interpolated,
+                "rapid": columns["rapid"][rows], "in_contact": columns["in_contact"][rows],
+                "inside_model": columns["inside_model"][rows], "feedrate": columns["feedrate"][rows],
+                "line_number": line_number[rows], "rotation": rotation}
+
+    # last position and rotation (NaN if none) of the rows before start, to draw a part of the path
+    def stateBefore(self, start):
+        position = zeros(3)
+        rotation = full(3, nan)
+        if start <= 0:
+            return position, rotation
+        path = self.path
+        if hasattr(path, "commands"):
+            rows = flatnonzero(~isnan(path.position[:start, 0]))
+            if len(rows) > 0:
+                position = path.position[rows[-1]].copy()
+            last_rotated = -1
+            for i in path.rotations.keys():
+                if last_rotated < i < start:
+                    last_rotated = i
+            if last_rotated >= 0:
+                rotation = array(path.rotations[last_rotated][0:3], dtype=float)
+            return position, rotation
+        for p in reversed(path[:start]):
+            if p.position is not None:
+                position = array(p.position[0:3], dtype=float)
+                break
+        for p in reversed(path[:start]):
+            if p.rotation is not None:
+                rotation = array(p.rotation[0:3], dtype=float)
+                break
+        return position, rotation
+
+    def setLineNumbers(self, start, line_number, rows):
+        if hasattr(self.path, "commands"):
+            self.path.line_number[start:start+len(rows)][rows] = line_number[rows]
+            for i, c in self.path.commands.items():
+                if start <= i < start+len(rows) and rows[i-start]:
+                    c.line_number = int(line_number[i-start])
+        else:
+            for r in where(rows)[0]:
+                self.path[start+r].line_number = int(line_number[r])
+
+    def get_draw_path(self, start = 0, end=None, start_rotation = [0,0,0], interpolate_arcs = True):
+        draw = self.get_draw_arrays(start, end, interpolate_arcs=interpolate_arcs)
+        draw_path = []
+        for position, feedrate, rapid, line_number, interpolated, rotation in zip(draw["position"].tolist(), draw["feedrate"].tolist(), draw["rapid"].tolist(),
+                                                                             draw["line_number"].tolist(), draw["interpolated"].tolist(), draw["rotation"].tolist()):
+            draw_path.append(GPoint(position=position, feedrate=None if isnan(feedrate) else feedrate, rapid=rapid, line_number=line_number,
+                                    interpolated=interpolated, rotation=None if isnan(rotation[0]) else rotation))
         return draw_path
 
     def get_end_points(self, start = 0, end=-1):
@@ -218,141 +370,231 @@ class GCode:
         for p in gcode.path:
             self.append(p)
 
-    def estimate(self):
-        length = 0.0
-        duration = 0.0
-        rapid_length = 0.0
-        cut_length = 0.0
-        rapid_duration = 0.0
-        cut_duration = 0.0
+    # positions, feedrates and rapid flags of the moves, with arcs interpolated. Rows without a
+    # feedrate use the default feedrate, or keep the last one if there is no default (1000 before any).
+    # Also returns the feedrate after the last row.
+    def motionArrays(self):
         current_feedrate = 1000
-        
         if self.default_feedrate != None:
             current_feedrate = self.default_feedrate
-            
-        paths = []
-        paths.append(self.path)
-        if len(paths) == 0 or len(paths[0]) == 0:
-            return (length, duration, current_feedrate, cut_length, rapid_length, cut_duration, rapid_duration)
-        lastp = None
-        for segment in paths:
-            for p in segment:
-                if p.feedrate is not None:
-                    current_feedrate = p.feedrate
-                if p.feedrate is None and self.default_feedrate is not None and current_feedrate != self.default_feedrate:
-                    current_feedrate = self.default_feedrate
-                if p.position is not None:
-                    s_length = 0
-                    if lastp is not None:
-                        s_length = norm(array(p.position) - lastp)
-                    lastp = array(p.position)
-                    if p.rapid:
-                        length += s_length
-                        rapid_length += s_length
-                        duration += s_length / self.rapid_feedrate
-                        rapid_duration += s_length / self.rapid_feedrate
-                    else:
-                        length += s_length
-                        cut_length += s_length
-                        duration += s_length / current_feedrate
-                        cut_duration += s_length / current_feedrate
+        draw = self.get_draw_arrays(interpolate_arcs=True, rotate=False)
+        columns = self.pathArrays()
+        feedrate = columns["feedrate"]
+        if self.default_feedrate != None:
+            feedrate = where(isnan(feedrate), self.default_feedrate, feedrate)
+        else:
+            last = maximum.accumulate(where(isnan(feedrate), -1, arange(len(feedrate))))
+            feedrate = where(last >= 0, feedrate[maximum(last, 0)], current_feedrate)
+        if len(feedrate) > 0:
+            current_feedrate = feedrate[-1]
+        moves = ~isnan(columns["position"][draw["row"], 0])
+        rows = draw["row"][moves]
+        return draw["position"][moves], feedrate[rows], draw["rapid"][moves], current_feedrate
+
+    def estimate(self):
+        position, feedrate, rapid, current_feedrate = self.motionArrays()
+        if len(position) < 2:
+            return (0.0, 0.0, current_feedrate, 0.0, 0.0, 0.0, 0.0)
+        delta = diff(position, axis=0)
+        s_length = sqrt((delta*delta).sum(axis=1))
+        rapid = rapid[1:]
+        cut_length = s_length[~rapid].sum()
+        rapid_length = s_length[rapid].sum()
+        cut_duration = (s_length[~rapid]/feedrate[1:][~rapid]).sum()
+        rapid_duration = rapid_length / self.rapid_feedrate
         # return "Path estimate: Length: %f mm;  Duration: %f minutes. Last feedrate: %f"%(length,  duration,    current_feedrate)
+        return (cut_length+rapid_length, cut_duration+rapid_duration, current_feedrate, cut_length, rapid_length, cut_duration, rapid_duration)
+
+    # estimate with acceleration and junction speeds as planned by GRBL (see planner.py),
+    # same tuple as estimate()
+    def plannerEstimate(self, limits=None):
+        position, feedrate, rapid, current_feedrate = self.motionArrays()
+        length, duration, cut_length, rapid_length, cut_duration, rapid_duration = planner_estimate(position, feedrate, rapid, limits)
         return (length, duration, current_feedrate, cut_length, rapid_length, cut_duration, rapid_duration)
 
-    def toText(self, write_header=False, pure=False):
-        output = ""
+    # the G-code text in blocks, for writing large programs without building the whole text
+    def textBlocks(self, write_header=False, pure=False, block_size=10000):
+        output = []
         #print("laser mode:", self.laser_mode, "pure: ", pure)
         if not pure:
-            estimate = self.estimate()
             if write_header:
+                estimate = self.estimate()
                 print("Path estimate: Length: %f mm;  Duration: %f minutes. Last feedrate: %f" % (estimate[0],
                                                                                                   estimate[1], estimate[2]))
-                output += "( " + "Path estimate: Length: %f mm;  Duration: %f minutes. Last feedrate: %f" % (
-                estimate[0], estimate[1], estimate[2]) + " )\n"
-                output += "G90G21G17G54\n"
+                output.append("( " + "Path estimate: Length: %f mm;  Duration: %f minutes. Last feedrate: %f" % (
+                estimate[0], estimate[1], estimate[2]) + " )\n")
+                output.append("G90G21G17G54\n")
             if self.default_feedrate != None:
-                output += "F%f\n" % (self.default_feedrate)
-        complete_path = self.path
-        # if self.outpaths!=None and len(self.outpaths)>0:
-        #     complete_path=[]
-        #     for segment in self.outpaths:
-        #         complete_path+=segment
-        rapid = None
-
-        current_feedrate = self.default_feedrate
-        current_gmode = "G1"
-        for p in complete_path:
-            if isinstance(p, GPoint):
-
-                if p.rapid != rapid:
-                    rapid = p.rapid
-                    if rapid:
-                        # in laser mode, issue a spindle off command before rapids
-                        if self.laser_mode:
-                            output += "M5\n"
-                            # print "laser off"
-                        output += "G0 "
+                output.append("F%f\n" % (self.default_feedrate))
+        yield "".join(output)
+
+        path = self.path
+        if self.compact and not hasattr(path, "textBlocks"):
+            from toolpath import Toolpath
+            path = Toolpath.fromPoints(path)
+        if hasattr(path, "textBlocks"):
+            for block in path.textBlocks(self.default_feedrate, self.laser_mode, block_size,
+                                         precision=self.precision if self.compact else None):
+                yield block
+        else:
+            rapid = None
+            current_feedrate = self.default_feedrate
+            current_gmode = "G1"
+            output = []
+            for p in self.path:
+                if isinstance(p, GPoint):
+
+                    if p.rapid != rapid:
+                        rapid = p.rapid
+                        if rapid:
+                            # in laser mode, issue a spindle off command before rapids
+                            if self.laser_mode:
+                                output.append("M5\n")
+                            output.append("G0 ")
+                        else:
+                            if self.laser_mode:
+                                # in laser mode, issue a spindle on command after rapids
+                                output.append("M4 S1000\n")
+
+                            if p.gmode != current_gmode:
+                                current_gmode = p.gmode
+
+                            output.append(current_gmode+" ")
                     else:
-                        if self.laser_mode:
-                            # in laser mode, issue a spindle on command after rapids
-                            output += "M4 S1000\n"
-
                         if p.gmode != current_gmode:
                             current_gmode = p.gmode
+                            output.append(current_gmode+" ")
 
-                        output += current_gmode+" "
-                else:
-                    if p.gmode != current_gmode:
-                        current_gmode = p.gmode
-                        output += current_gmode+" "
-
-            output += "" + p.to_output()
-            if p.feedrate is not None and (p.control_point or p.rapid == False and p.feedrate != current_feedrate):
-                current_feedrate = p.feedrate
-                output += "F%f" % p.feedrate
-            #if p.feedrate is None and current_feedrate != self.default_feedrate:
-            #    current_feedrate = self.default_feedrate
-            #    output += "F%f" % current_feedrate
-            output += "\n"
+                output.append(p.to_output())
+                if p.feedrate is not None and (p.control_point or p.rapid == False and p.feedrate != current_feedrate):
+                    current_feedrate = p.feedrate
+                    output.append("F%f" % p.feedrate)
+                output.append("\n")
+                if len(output) >= block_size:
+                    yield "".join(output)
+                    output = []
+            yield "".join(output)
 
         if not pure:
-            output += "M02\n%\n"
-        return output
+            yield "M02\n%\n"
 
+    def toText(self, write_header=False, pure=False):
+        return "".join(self.textBlocks(write_header, pure))
 
+    # size of the program in the full format, in bytes, for comparison with the compact output.
+    # The first block (header) is the same in both formats and is not rendered again.
+    def fullSize(self, header_size=0):
+        compact = self.compact
+        self.compact = False
+        try:
+            blocks = self.textBlocks()
+            next(blocks)
+            return header_size+sum([len(block) for block in blocks])
+        finally:
+            self.compact = compact
 
     def write(self, filename):
         f = open(filename, 'w')
-        f.write(self.toText(write_header=True))
+        sizes = []
+        for block in self.textBlocks(write_header=True):
+            f.write(block)
+            sizes.append(len(block))
         f.close()
         print(filename, "saved.")
-
-
-known_commands = ["G", "F", "X", "Y", "Z", "M", "I", "J", "T", "A", "B", "C"]
-
-
-def is_part_of_number(s):
-    return s == ' ' or s == "\t" or s == "-" or s == "+" or s == "." or (s >= "0" and s <= "9")
-
-
+        if self.compact:
+            compact_size = sum(sizes)
+            full_size = self.fullSize(sizes[0])
+            print("compact output: %i bytes instead of %i, %i bytes (%.1f%%) saved" % (compact_size, full_size,
+                  full_size-compact_size, 100.0*(full_size-compact_size)/max(full_size, 1)))
+
+
+# number without trailing zeros, e.g. 10.5 instead of 10.500000
+def format_number(value, decimals):
+    text = "%.*f" % (decimals, value)
+    if decimals > 0:
+        text = text.rstrip("0").rstrip(".")
+    if text == "-0":
+        return "0"
+    return text
+
+# decimals for an output axis: the precision in path units, plus the digits lost where the axis
+# scaling shrinks the values (e.g. 2 more for mm to inch)
+def output_decimals(precision, scaling):
+    if scaling == 0 or abs(scaling) >= 1:
+        return int(precision)
+    return int(precision) + int(-floor(log10(abs(scaling))))
+
+
+# maximum distance (mm) between an arc and its chords when arcs are interpolated for preview and estimates
+arc_tolerance = 0.01
+
+# Points along arcs in the XY plane: start and end (k,3), ij centre offsets (k,2), arcdir 2 (clockwise)
+# or 3, with the chord error below tolerance. Z is interpolated linearly (helices), and an arc ending at
+# its start is a full circle. Returns the points (without the start points, with the exact end points)
+# and the index of the arc of each point.
+def discretize_arcs(start, end, ij, arcdir, tolerance=None):
+    if tolerance is None:
+        tolerance = arc_tolerance
+    start = asarray(start, dtype=float).reshape(-1, 3)
+    end = asarray(end, dtype=float).reshape(-1, 3)
+    ij = asarray(ij, dtype=float).reshape(-1, 2)
+    clockwise = asarray(arcdir).astype(int).reshape(-1) == 2
+    center = start[:, 0:2]+ij
+    radius = sqrt((ij*ij).sum(axis=1))
+    start_angle = arctan2(-ij[:, 1], -ij[:, 0])
+    sweep = arctan2(end[:, 1]-center[:, 1], end[:, 0]-center[:, 0])-start_angle
+    sweep = where(clockwise, -mod(-sweep, 2.0*PI), mod(sweep, 2.0*PI))
+    # no (or a whole) turn left over: a full circle if the arc ends where it starts
+    closed = sqrt(((end[:, 0:2]-start[:, 0:2])**2).sum(axis=1)) < 1e-9*maximum(radius, 1.0)
+    full_turn = closed & ((abs(sweep) < 5e-7) | (abs(abs(sweep)-2.0*PI) < 5e-7))
+    sweep = where(full_turn, where(clockwise, -2.0*PI, 2.0*PI), sweep)
+    # largest angle per chord: the sagitta r*(1-cos(step/2)) is the chord error
+    with errstate(divide="ignore", invalid="ignore"):
+        step = 2.0*arccos(clip(1.0-tolerance/radius, -1.0, 1.0))
+    segments = maximum(ceil(abs(sweep)/where(step > 0, step, 2.0*PI)), 1).astype(int64)
+    arc = repeat(arange(len(start)), segments)
+    offsets = cumsum(segments)-segments
+    t = (arange(len(arc))-offsets[arc]+1)/segments[arc].astype(float)
+    angle = start_angle[arc]+t*sweep[arc]
+    points = column_stack((center[arc, 0]+radius[arc]*cos(angle), center[arc, 1]+radius[arc]*sin(angle),
+                           start[arc, 2]+t*(end[arc, 2]-start[arc, 2])))
+    last = offsets+segments-1
+    points[last] = end
+    return points, arc
+
+# rotation of points by per-point angles (degrees) around x, y and z, as rotate_x/y/z in that order.
+# Rows with NaN rotation stay unchanged.
+def rotate_points(points, rotation):
+    points = array(points, dtype=float)
+    rows = ~isnan(rotation[:, 0])
+    if not rows.any():
+        return points
+    x, y, z = points[rows, 0], points[rows, 1], points[rows, 2]
+    a = rotation[rows]*PI/180.0
+    y, z = y*cos(a[:, 0])+z*sin(a[:, 0]), -y*sin(a[:, 0])+z*cos(a[:, 0])
+    x, z = x*cos(a[:, 1])+z*sin(a[:, 1]), -x*sin(a[:, 1])+z*cos(a[:, 1])
+    x, y = x*cos(a[:, 2])+y*sin(a[:, 2]), -x*sin(a[:, 2])+y*cos(a[:, 2])
+    points[rows] = column_stack((x, y, z))
+    return points
+
+
+# a word is a letter followed by a number or a parameter reference (#n)
+number = r"[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)"
+word_pattern = re.compile(r"([A-Z])\s*(#[0-9]+|" + number + ")")
+comment_pattern = re.compile(r"\([^)]*\)|;.*")
+# parameter assignment #n=value
+assignment_pattern = re.compile(r"#([0-9]+)\s*=\s*(#[0-9]+|" + number + ")")
+
+
+def strip_comments(line):
+    if "(" in line or ";" in line:
+        return comment_pattern.sub(" ", line)
+    return line
+
+
+# returns the (letter, value) words of a line, with comments removed and letters in upper case
 def parseline(line):
-    p = []
-
-    for i in range(0, len(line)):
-        if line[i] == '(':
-            break
-
-        for cmd in known_commands:
-            if line[i].upper().startswith(cmd):
-
-                # find end of number
-                j = i + len(cmd)
-                while j < len(line) and is_part_of_number(line[j]):
-                    j += 1
-                value = line[i + len(cmd):j].strip()
-                p.append((cmd, value))
-
-    return p
+    return word_pattern.findall(strip_comments(line).upper())
 
 
 #def write_coordinate(point, file):
@@ -374,98 +616,24 @@ def write_gcode(path, filename):
 
 
 def read_gcode(filename):
+    from gcode_parser import GCodeReader, mp
     try:
-        infile = open(filename)
+        reader = GCodeReader(filename)
     except:
         print("Can't open file:", filename)
         return GCode()
 
-    datalines = infile.readlines();
-    return parse_gcode(datalines)
+    if len(reader) > 4*reader.chunk_size and mp.cpu_count() > 1:
+        path = reader.readPathParallel()
+    else:
+        path = reader.readPath()
+    reader.close()
+    return path
 
 def parse_gcode(datalines):
-
-    x = 0
-    y = 0
-    z = 0
-    ra = 0
-    rb = 0
-    rc = 0
-
-    GCOM = ""
-    feed = None
-    rapid = False
-    arc = False
-    arcdir = None
-
+    from gcode_parser import GCodeParser # imported here, the parser module depends on this one
+    parser = GCodeParser()
     path = GCode()
-    linecount = 0
-    for l in datalines:
-        i = 0
-        j = 0
-        k = 0
-        pl = parseline(l)
-        linecount += 1
-        # print linecount, pl
-        new_coord = False
-        new_rotation = False
-
-        try:
-            for c in pl:
-                if c[0].upper() == "X":
-                    x = float(c[1]);
-                    new_coord = True
-                if c[0].upper() == "Y":
-                    y = float(c[1]);
-                    new_coord = True
-                if c[0].upper() == "Z":
-                    z = float(c[1]);
-                    new_coord = True
-                if c[0].upper() == "A":
-                    ra = float(c[1]);
-                    new_coord = True
-                    new_rotation = True
-                if c[0].upper() == "B":
-                    rb = float(c[1]);
-                    new_coord = True
-                    new_rotation = True
-                if c[0].upper() == "C":
-                    rc = float(c[1]);
-                    new_coord = True
-                    new_rotation = True
-                if c[0].upper() == "F":
-                    feed = float(c[1])
-                    if path.default_feedrate is None: # set the default feedrate to the first encountered feed
-                        path.default_feedrate = feed
-                if c[0].upper() == "G" and (c[1] == "0" or c[1] == "00"):
-                    rapid = True
-                    arc = False
-                if c[0].upper() == "G" and (c[1] == "1" or c[1] == "01"):
-                    rapid = False
-                    arc = False
-                if c[0].upper() == "G" and (c[1] == "2" or c[1] == "3" or c[1] == "02" or c[1] == "03"):  # arc interpolation
-                    arc = True
-                    arcdir = c[1]
-                    rapid = False
-
-                if arc and c[0].upper() == "I":
-                    i = float(c[1])
-                if arc and c[0].upper() == "J":
-                    j = float(c[1])
-        except Exception as e:
-            print("conversion error in line %i:" % linecount, c)
-            print(e.message)
-
-        if new_coord:
-            if arc:
-                path.append(GArc(position=[x, y, z], ij= [i, j], arcdir = arcdir, feedrate=feed, rapid=rapid, command = l, line_number=linecount));
-            else:
-                if new_rotation:
-                    path.append(GPoint(position=[x, y, z], rotation=[ra, rb, rc], feedrate=feed, rapid=rapid, command=l, line_number=linecount));
-                    print("new rotation", ra, rb, rc)
-                else:
-                    path.append(GPoint(position=[x, y, z], feedrate=feed, rapid=rapid, command = l, line_number=linecount));
-
-        else:
-            path.append(GCommand(command =l.strip(), feedrate = feed,  line_number=linecount))
+    path.path = parser.parse(datalines)
+    path.default_feedrate = parser.default_feedrate
     return path
@@ -3,6 +3,7 @@ from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.Qsci import *
 import gcode
+from gcode_parser import GCodeDocument
 
 class QsciGcodeLexer(QsciLexerCPP):
 
@@ -41,6 +42,7 @@ class GcodeEditorWidget(QWidget):
         self.editor.selectionChanged.connect(self.onSelectionChanged)
         self.editor.textChanged.connect(self.onTextChanged)
         self.pathTool = None
+        self.document = None # parsed text, updated incrementally while editing
         self.editingFlag = False
 
     def setObjectViewer(self, object_viewer):
@@ -48,6 +50,7 @@ class GcodeEditorWidget(QWidget):
 
     def setPathTool(self, path):
         self.pathTool = path
+        self.document = None
 
     def onSelectionChanged(self):
         selection = self.editor.getSelection()
@@ -57,8 +60,14 @@ class GcodeEditorWidget(QWidget):
     def onTextChanged(self):
         self.editingFlag=True
         if self.pathTool is not None:
-            print ("..")
-            self.pathTool.updatePath( gcode.parse_gcode(self.getText()))
+            lines = self.getText()
+            if self.document is None:
+                self.document = GCodeDocument(lines)
+                self.pathTool.updatePath(self.document.getGCode())
+            else:
+                changed = self.document.update(lines)
+                if changed is not None:
+                    self.pathTool.updatePathRange(self.document.getGCode(), *changed, viewer=self.object_viewer)
         self.editingFlag=False
 
     def configureEditor(self, editor):
@@ -102,6 +111,7 @@ class GcodeEditorWidget(QWidget):
         marginTextStyle= QsciStyle()
         marginTextStyle.setPaper(QColor("#ffFF8888"))
         self.editor.setText("")
+        self.document = None
         self.label.setText(label)
         skipped_lines = 0
         annotation=None
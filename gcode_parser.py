@@ -0,0 +1,440 @@
+from numpy import *
+from gcode import *
+from toolpath import *
+import multiprocessing as mp
+import mmap
+import bisect
+import os
+
+linear_axes = {"X": 0, "Y": 1, "Z": 2}
+rotary_axes = {"A": 0, "B": 1, "C": 2}
+arc_offsets = {"I": 0, "J": 1}
+
+
+# Modal G-code parser. Keeps the machine state (position, motion mode, feedrate, parameters)
+# across lines and collects the parsed lines as Toolpath columns, one row per line.
+# Lines with a motion become points (arcs for G2/G3), all other lines are kept as GCommand rows.
+class GCodeParser:
+    def __init__(self):
+        self.position = [0.0, 0.0, 0.0]
+        self.rotation = [0.0, 0.0, 0.0]
+        self.feedrate = None
+        self.default_feedrate = None
+        self.motion = 1
+        self.parameters = dict()
+        self.unknown = False
+
+    # Starts from an unknown modal state, to parse a chunk without the lines before it.
+    # Unknown position and rotation axes are NaN and the motion mode is None. parse() records the
+    # rows that depend on the unknown state, resolve_chunk() fills them in once it is known.
+    def setUnknownState(self):
+        self.position = [nan, nan, nan]
+        self.rotation = [nan, nan, nan]
+        self.feedrate = None
+        self.motion = None
+        self.parameters = dict()
+        self.unknown = True
+        self.feed_row = None # first row with a feedrate set in the chunk
+        self.pending_motion = [] # (row, ij) of the points before the first motion word
+        self.missing_parameters = False
+
+    # modal state as a hashable tuple, e.g. to resume parsing in the middle of a program
+    def getState(self):
+        return (tuple(self.position), tuple(self.rotation), self.feedrate, self.motion,
+                tuple(sorted(self.parameters.items())))
+
+    def setState(self, state):
+        position, rotation, self.feedrate, self.motion, parameters = state
+        self.position = list(position)
+        self.rotation = list(rotation)
+        self.parameters = dict(parameters)
+
+    def value(self, text):
+        if text[0] == "#":
+            if self.unknown and int(text[1:]) not in self.parameters:
+                self.missing_parameters = True
+            return self.parameters.get(int(text[1:]), 0.0)
+        return float(text)
+
+    def parse(self, lines, line_number=1):
+        positions = []
+        feedrates = []
+        flags = []
+        line_numbers = []
+        arc_index = []
+        arc_ij = []
+        arc_dir = []
+        commands = dict()
+        rotations = dict()
+        no_position = (nan, nan, nan)
+        for l in lines:
+            row = len(flags)
+            if "#" in l:
+                for name, value in assignment_pattern.findall(l):
+                    self.parameters[int(name)] = self.value(value)
+            target = self.position[:]
+            ij = [0.0, 0.0]
+            new_coord = False
+            new_rotation = False
+            word = None
+            try:
+                for word in parseline(l):
+                    letter, value = word
+                    value = self.value(value) if value[0] == "#" else float(value)
+                    if letter in linear_axes:
+                        axis = linear_axes[letter]
+                        target[axis] = value
+                        new_coord = True
+                    elif letter in rotary_axes:
+                        axis = rotary_axes[letter]
+                        self.rotation[axis] = value
+                        new_coord = True
+                        new_rotation = True
+                    elif letter in arc_offsets:
+                        ij[arc_offsets[letter]] = value
+                    elif letter == "F":
+                        self.feedrate = value
+                        if self.unknown and self.feed_row is None:
+                            self.feed_row = row
+                        if self.default_feedrate is None: # set the default feedrate to the first encountered feed
+                            self.default_feedrate = self.feedrate
+                    elif letter == "G":
+                        if value in (0, 1, 2, 3):
+                            self.motion = int(value)
+            except Exception as e:
+                print("conversion error in line %i:" % line_number, word, e)
+
+            feedrates.append(nan if self.feedrate is None else self.feedrate)
+            line_numbers.append(line_number)
+            if new_coord:
+                self.position = target
+                positions.append(target)
+                if self.motion == 0:
+                    flags.append(RAPID | IN_CONTACT | INSIDE_MODEL)
+                elif self.motion == 1:
+                    flags.append(IN_CONTACT | INSIDE_MODEL)
+                elif self.motion is None:
+                    flags.append(IN_CONTACT | INSIDE_MODEL)
+                    self.pending_motion.append((row, ij))
+                else:
+                    flags.append(ARC | IN_CONTACT | INSIDE_MODEL)
+                    arc_index.append(row)
+                    arc_ij.append(ij)
+                    arc_dir.append(str(self.motion))
+                if new_rotation:
+                    rotations[row] = self.rotation[:]
+            else:
+                positions.append(no_position)
+                flags.append(COMMAND)
+                commands[row] = GCommand(command=l.strip(), feedrate=self.feedrate, line_number=line_number)
+            line_number += 1
+        return Toolpath.fromColumns(positions, feedrates, flags, line_numbers, arc_index, arc_ij, arc_dir, commands, rotations)
+
+
+# Fills in the rows of a chunk parsed from an unknown modal state (see GCodeParser.setUnknownState),
+# given the state before the chunk. info holds what the chunk parser recorded. Returns the state
+# after the chunk.
+def resolve_chunk(path, info, state):
+    position, rotation, feedrate, motion, parameters = state
+    unknown = isnan(path.position) & ((path.flags & COMMAND) == 0)[:, newaxis]
+    if unknown.any():
+        path._position[:path.size] = where(unknown, array(position), path.position)
+    feed_row = info["feed_row"] if info["feed_row"] is not None else path.size
+    path._feedrate[:feed_row] = nan if feedrate is None else feedrate
+    for i, c in path.commands.items():
+        if i < feed_row:
+            c.feedrate = feedrate
+    if len(info["pending_motion"]) > 0:
+        rows = array([row for row, ij in info["pending_motion"]], dtype=int64)
+        if motion == 0:
+            path._flags[rows] |= RAPID
+        elif motion in (2, 3):
+            # the pending rows come before any arc of the chunk
+            path._flags[rows] |= ARC
+            path.arc_index = concatenate((rows, path.arc_index))
+            path.arc_ij = concatenate((array([ij for row, ij in info["pending_motion"]], dtype=float), path.arc_ij))
+            path.arc_dir = concatenate((array([str(motion)]*len(rows), dtype='<U2'), path.arc_dir))
+    for r in path.rotations.values():
+        for axis in range(0, 3):
+            if isnan(r[axis]):
+                r[axis] = rotation[axis]
+
+    end_position, end_rotation, end_feedrate, end_motion, end_parameters = info["state"]
+    parameters = dict(parameters)
+    parameters.update(dict(end_parameters))
+    return (tuple(p if isnan(e) else e for p, e in zip(position, end_position)),
+            tuple(r if isnan(e) else e for r, e in zip(rotation, end_rotation)),
+            feedrate if info["feed_row"] is None else end_feedrate,
+            motion if end_motion is None else end_motion,
+            tuple(sorted(parameters.items())))
+
+
+def parse_chunk_init(filename, data):
+    if filename is not None:
+        parse_chunk.file = open(filename, "rb")
+        data = mmap.mmap(parse_chunk.file.fileno(), 0, access=mmap.ACCESS_READ)
+    parse_chunk.data = data
+
+# parses lines start..end-1 (bytes byte_start..byte_end) from an unknown modal state
+def parse_chunk(chunk):
+    start, end, byte_start, byte_end = chunk
+    text = bytes(parse_chunk.data[byte_start:byte_end]).decode("utf-8", "replace")
+    parser = GCodeParser()
+    parser.setUnknownState()
+    path = parser.parse([l.rstrip("\r") for l in text.split("\n")[:end-start]], line_number=start+1)
+    info = {"state": parser.getState(), "feed_row": parser.feed_row, "pending_motion": parser.pending_motion,
+            "missing_parameters": parser.missing_parameters, "default_feedrate": parser.default_feedrate}
+    return path, info
+
+
+# Line-indexed access to a G-code program in a file (memory mapped) or a bytes buffer.
+# Only the offsets of the line starts are kept in memory; lines are decoded and parsed on demand,
+# so very large programs can be streamed or parsed chunk by chunk. The modal state at the start
+# of each chunk is recorded the first time the chunk is reached, for random access later.
+class GCodeReader:
+    def __init__(self, filename=None, data=None, chunk_size=100000):
+        self.file = None
+        self.filename = filename
+        self.chunk_size = chunk_size
+        if filename is not None:
+            self.file = open(filename, "rb")
+            if os.fstat(self.file.fileno()).st_size > 0:
+                data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = b""
+        self.data = data
+        self.line_start = self.indexLines()
+        self.states = [GCodeParser().getState()]
+        self.default_feedrate = None
+
+    # offsets of all line starts, followed by the end of the data
+    def indexLines(self, block_size=1 << 24):
+        size = len(self.data)
+        starts = [zeros(1, dtype=int64)]
+        for offset in range(0, size, block_size):
+            block = frombuffer(self.data[offset:offset+block_size], dtype=uint8)
+            starts.append(flatnonzero(block == 10)+offset+1)
+        starts = concatenate(starts)
+        if starts[-1] != size:
+            starts = append(starts, size)
+        return starts
+
+    def close(self):
+        if self.file is not None:
+            if len(self.data) > 0:
+                self.data.close()
+            self.file.close()
+            self.file = None
+
+    def __len__(self):
+        return len(self.line_start)-1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, end, step = index.indices(len(self))
+            return self.lines(start, end)[::step]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("line index out of range")
+        return bytes(self.data[self.line_start[index]:self.line_start[index+1]]).decode("utf-8", "replace").rstrip("\r\n")
+
+    def __iter__(self):
+        for start in range(0, len(self), self.chunk_size):
+            for l in self.lines(start, start+self.chunk_size):
+                yield l
+
+    # decoded lines start..end-1 (without line ends)
+    def lines(self, start, end):
+        end = min(end, len(self))
+        if end <= start:
+            return []
+        text = bytes(self.data[self.line_start[start]:self.line_start[end]]).decode("utf-8", "replace")
+        return [l.rstrip("\r") for l in text.split("\n")[:end-start]]
+
+    # parser positioned at the modal state before the given line
+    def parserAt(self, line):
+        parser = GCodeParser()
+        chunk = min(line // self.chunk_size, len(self.states)-1)
+        parser.setState(self.states[chunk])
+        start = chunk*self.chunk_size
+        while start < line:
+            end = min(start+self.chunk_size, line)
+            parser.parse(self.lines(start, end))
+            if end % self.chunk_size == 0 and end // self.chunk_size == len(self.states):
+                self.states.append(parser.getState())
+            start = end
+        return parser
+
+    # parses lines start..end-1 with the correct modal state
+    def parseLines(self, start, end):
+        return self.parserAt(start).parse(self.lines(start, end), line_number=start+1)
+
+    # yields (first line, Toolpath) for consecutive chunks of the program
+    def chunks(self, start=0, end=None):
+        if end is None:
+            end = len(self)
+        parser = self.parserAt(start)
+        if start == 0:
+            self.default_feedrate = None
+        else:
+            parser.default_feedrate = self.default_feedrate
+        while start < end:
+            chunk_end = min(start-start % self.chunk_size+self.chunk_size, end)
+            path = parser.parse(self.lines(start, chunk_end), line_number=start+1)
+            if chunk_end % self.chunk_size == 0 and chunk_end // self.chunk_size == len(self.states):
+                self.states.append(parser.getState())
+            self.default_feedrate = parser.default_feedrate
+            yield start, path
+            start = chunk_end
+
+    # the complete program as GCode
+    def readPath(self):
+        path = GCode()
+        path.path = Toolpath(capacity=max(16, len(self)))
+        for start, chunk in self.chunks():
+            path.path.extend(chunk)
+        path.default_feedrate = self.default_feedrate
+        return path
+
+    # the complete program as GCode, parsing the chunks in parallel processes. Each chunk is parsed
+    # from an unknown modal state, then the chunks are resolved in order with the state reached at
+    # the end of the previous one. Chunks reading parameters set before them are parsed again.
+    def readPathParallel(self, processes=None):
+        bounds = list(range(0, len(self), self.chunk_size))+[len(self)]
+        chunks = [(s, e, int(self.line_start[s]), int(self.line_start[e])) for s, e in zip(bounds[:-1], bounds[1:])]
+        path = GCode()
+        path.path = Toolpath(capacity=max(16, len(self)))
+        if len(chunks) == 0:
+            return path
+        pool = mp.Pool(processes, parse_chunk_init, [self.filename, None if self.filename is not None else bytes(self.data)])
+        results = pool.map(parse_chunk, chunks)
+        pool.close()
+        pool.join()
+
+        state = GCodeParser().getState()
+        self.states = [state]
+        self.default_feedrate = None
+        for (start, end, byte_start, byte_end), (chunk, info) in zip(chunks, results):
+            if info["missing_parameters"]:
+                parser = GCodeParser()
+                parser.setState(state)
+                parser.default_feedrate = self.default_feedrate
+                chunk = parser.parse(self.lines(start, end), line_number=start+1)
+                state = parser.getState()
+            else:
+                state = resolve_chunk(chunk, info, state)
+            if self.default_feedrate is None:
+                self.default_feedrate = info["default_feedrate"]
+            self.states.append(state)
+            path.path.extend(chunk)
+        path.default_feedrate = self.default_feedrate
+        return path
+
+
+# Parsed model of a program that is being edited: the rows of all lines (one Toolpath row per line)
+# and the modal state before checkpoint lines, about every checkpoint_interval lines. An edit is
+# parsed from the checkpoint before the first changed line up to the first old checkpoint after the
+# edit where the modal state is the same as before; the rows after it are kept, with line numbers
+# shifted by the number of inserted lines.
+class GCodeDocument:
+    def __init__(self, lines=[], checkpoint_interval=100):
+        self.lines = list(lines)
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_lines = [0]
+        self.checkpoint_states = [GCodeParser().getState()]
+        parser = GCodeParser()
+        self.path = self.joinPaths(self.parseRange(parser, 0, len(self.lines)))
+        self.default_feedrate = self.firstFeedrate()
+
+    # parses lines start..end-1 with the parser, recording checkpoints. Returns the parsed Toolpaths.
+    def parseRange(self, parser, start, end):
+        paths = []
+        while start < end:
+            stop = min(end, self.checkpoint_lines[-1]+self.checkpoint_interval)
+            if stop <= start:
+                self.checkpoint_lines.append(start)
+                self.checkpoint_states.append(parser.getState())
+                continue
+            paths.append(parser.parse(self.lines[start:stop], line_number=start+1))
+            start = stop
+        return paths
+
+    def joinPaths(self, paths):
+        path = Toolpath(capacity=max(16, sum([len(p) for p in paths])))
+        for p in paths:
+            path.extend(p)
+        return path
+
+    # the feedrate of the first F word, as the parser's default feedrate
+    def firstFeedrate(self):
+        feeds = flatnonzero(~isnan(self.path.feedrate))
+        if len(feeds) == 0:
+            return None
+        return float(self.path.feedrate[feeds[0]])
+
+    # first changed line, and the end of the changed lines in the old and in the new text
+    def changedRange(self, lines):
+        n = min(len(self.lines), len(lines))
+        start = 0
+        while start < n and self.lines[start] == lines[start]:
+            start += 1
+        end = 0
+        while end < n-start and self.lines[-1-end] == lines[-1-end]:
+            end += 1
+        return start, len(self.lines)-end, len(lines)-end
+
+    # Updates the model to the new text. Returns (start, old_end, new_end): the rows start..old_end-1
+    # of the old path were replaced by the rows start..new_end-1 of the new path, or None if nothing changed.
+    def update(self, lines):
+        lines = list(lines)
+        start, old_end, new_end = self.changedRange(lines)
+        if start == old_end and start == new_end:
+            self.lines = lines
+            return None
+        shift = new_end-old_end
+        # parser at the state before the first changed line, from the last checkpoint before it
+        checkpoint = bisect.bisect_right(self.checkpoint_lines, start)-1
+        parser = GCodeParser()
+        parser.setState(self.checkpoint_states[checkpoint])
+        parser.parse(self.lines[self.checkpoint_lines[checkpoint]:start])
+        old_lines = self.checkpoint_lines[checkpoint+1:]
+        old_states = self.checkpoint_states[checkpoint+1:]
+        self.checkpoint_lines = self.checkpoint_lines[:checkpoint+1]
+        self.checkpoint_states = self.checkpoint_states[:checkpoint+1]
+        self.lines = lines
+
+        paths = self.parseRange(parser, start, new_end)
+        parsed = new_end
+        converged = None
+        for line, state in zip(old_lines, old_states):
+            if line < old_end:
+                continue
+            paths += self.parseRange(parser, parsed, line+shift)
+            parsed = line+shift
+            if parser.getState() == state:
+                converged = line
+                break
+        if converged is None:
+            paths += self.parseRange(parser, parsed, len(lines))
+            old_rows, new_rows = len(self.path), len(lines)
+        else:
+            tail = self.path[converged:]
+            if shift != 0:
+                tail._line_number[:tail.size] += shift
+                tail.commands = dict((i, GCommand(command=c.command, feedrate=c.feedrate, line_number=c.line_number+shift))
+                                     for i, c in tail.commands.items())
+            paths.append(tail)
+            for line, state in zip(old_lines, old_states):
+                if line >= converged and line+shift >= self.checkpoint_lines[-1]+self.checkpoint_interval//2:
+                    self.checkpoint_lines.append(line+shift)
+                    self.checkpoint_states.append(state)
+            old_rows, new_rows = converged, converged+shift
+        self.path = self.joinPaths([self.path[0:start]]+paths)
+        self.default_feedrate = self.firstFeedrate()
+        return start, old_rows, new_rows
+
+    def getGCode(self):
+        path = GCode(path=self.path)
+        path.default_feedrate = self.default_feedrate
+        return path
@@ -0,0 +1,40 @@
+from gcode import *
+
+# full circles starting in each quadrant, in both directions (G2 with I>0 J0 starts on the branch cut of atan2)
+def testFullCircles():
+    for arcdir in [2, 3]:
+        for ij in [(1, 0), (-1, 0), (0, 1), (0, -1)]:
+            points, arc = discretize_arcs([0, 0, 0], [0, 0, 0], ij, arcdir)
+            center = array(ij, dtype=float)
+            radius = sqrt(((points[:, 0:2]-center)**2).sum(axis=1))
+            angles = unwrap(concatenate(([arctan2(-ij[1], -ij[0])], arctan2(points[:, 1]-center[1], points[:, 0]-center[0]))))
+            assert len(points) > 4
+            assert abs(radius-1.0).max() < 1e-9
+            assert abs(abs(angles[-1]-angles[0])-2.0*PI) < 1e-6
+            # G2 turns clockwise, G3 counter-clockwise
+            assert (diff(angles) < 0).all() if arcdir == 2 else (diff(angles) > 0).all()
+
+# a quarter arc stays a quarter arc across the branch cut
+def testQuarterArcs():
+    points, arc = discretize_arcs([0, 0, 0], [1, -1, 0], (1, 0), 3)
+    assert abs(sqrt(((points[:, 0:2]-[1, 0])**2).sum(axis=1))-1.0).max() < 1e-9
+    assert (points[:-1, 1] < 1e-9).all()
+    points, arc = discretize_arcs([0, 0, 0], [1, 1, 0], (1, 0), 2)
+    assert (points[:-1, 1] > -1e-9).all()
+
+# compact output parses back to the same moves, including a full circle that ends where it starts
+def testCompactRoundTrip():
+    program = ["G1 X0 Y0 Z0", "X1", "G2 X1 Y0 I-1 J0", "X2"]
+    g = parse_gcode(program)
+    full_text = g.toText(pure=True)
+    g.compact = True
+    compact_text = g.toText(pure=True)
+    assert "G2 X1 Y0 I-1 J0" in compact_text
+    full_estimate = parse_gcode(full_text.splitlines()).estimate()
+    compact_estimate = parse_gcode(compact_text.splitlines()).estimate()
+    assert abs(full_estimate[0]-(2.0+2.0*PI)) < 0.05
+    assert abs(compact_estimate[0]-full_estimate[0]) < 1e-6
+
+testFullCircles()
+testQuarterArcs()
+testCompactRoundTrip()
@@ -271,7 +271,16 @@ def polygon_closed_length(poly):
     length+=dist(poly[0].position, poly[-1].position)
     return length
 
+# 2D lengths of the closing edge (last to first point) followed by all edges of a Toolpath
+def toolpath_edge_lengths2D(poly):
+    xy = poly.position[:, 0:2]
+    d = xy - roll(xy, 1, axis=0)
+    return sqrt(d[:, 0]*d[:, 0] + d[:, 1]*d[:, 1])
+
 def polygon_closed_length2D(poly):
+    if hasattr(poly, "position"): # columnar Toolpath
+        edges = toolpath_edge_lengths2D(poly)
+        return float(sum(edges[1:]) + edges[0])
     length = sum([dist2D(poly[i].position, poly[i+1].position) for i in range(0, len(poly)-1)])
     # add last line segment between start and finish
     length+=dist2D(poly[0].position, poly[-1].position)
@@ -280,7 +289,16 @@ def polygon_closed_length2D(poly):
 def polygon_point_at_position(poly, length):
     n = len(poly)
     running_dist = 0
-    for i in range(n + 1):
+    start = 0
+    if hasattr(poly, "position") and n > 0: # columnar Toolpath: skip ahead to the edge that crosses the position
+        edges = toolpath_edge_lengths2D(poly)
+        running = cumsum(append(edges, edges[0]))
+        start = int(searchsorted(running, length, side='right'))
+        if start > n:
+            return None
+        if start > 0:
+            running_dist = float(running[start-1])
+    for i in range(start, n + 1):
         dist_before = running_dist
         p1, p2 =  poly[(i - 1) % n].position, poly[i % n].position
         line_length = dist2D(p1, p2)
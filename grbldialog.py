@@ -5,6 +5,7 @@ from builtins import bytes
 
 from objectviewer import *
 from tools.pathtool import *
+from gcode_parser import GCodeReader
 import serial
 from guifw.gui_elements import *
 import os, fnmatch
@@ -149,6 +150,7 @@ class GrblInterface():
         self.jog_scale = [1000, 1000, 1000]
         self.actualFeed = 0.0
         self.status = ""
+        self.settings = dict()
         self.status_callback = None
         self.last_transmission_timer = 10000
 
@@ -222,6 +224,13 @@ class GrblInterface():
                         print("overrides: ", self.overrides)
                     if part[0:3] == "FS:":
                         self.actualFeed = [float(c) for c in part[3:].split(",")]
+            elif line[0:5] == "Grbl ":
+                # welcome message after a (DTR) reset, the controller now accepts commands
+                self.readSettings()
+            elif len(line) > 1 and line[0] == '$' and "=" in line:
+                # reply to $$, the limits are used by the cycle time estimate
+                self.settings.update(parse_grbl_settings([line]))
+                default_limits.updateFromSettings(self.settings)
         except:
             print("GRBL parse error:", line)
         # print self.status, "mpos:", self.axes, "off:", self.offsets
@@ -291,6 +300,10 @@ class GrblInterface():
         self.pending = True
         print("sent:", gcode)
 
+    def readSettings(self):
+        self.serial.write("$$\n")
+        self.serial.flush()
+
     def getUpdate(self):
         self.serial.write("?")
         self.serial.flush()
@@ -612,6 +625,7 @@ class GCodeWidget(QtGui.QWidget):
 
         self.current_gcode = []
         self.current_line_number = 0
+        self.file_reader = None # streams a file directly, without loading it into the editor
 
         buttonlayout = QtGui.QHBoxLayout()
         self.buttonwidget = QtGui.QWidget()
@@ -643,10 +657,16 @@ class GCodeWidget(QtGui.QWidget):
         self.stepButton.setFixedWidth(60)
         self.stepButton.setFixedHeight(30)
         self.stepButton.clicked.connect(self.sendGCode)
+        self.fileButton = QtGui.QPushButton("File")
+        self.fileButton.setToolTip("Stream a G-code file")
+        self.fileButton.setFixedWidth(60)
+        self.fileButton.setFixedHeight(30)
+        self.fileButton.clicked.connect(self.filePushed)
         buttonlayout.addWidget(self.startButton)
         buttonlayout.addWidget(self.stopButton)
         buttonlayout.addWidget(self.pauseButton)
         buttonlayout.addWidget(self.stepButton)
+        buttonlayout.addWidget(self.fileButton)
         buttonlayout.addStretch()
         buttonlayout.setSpacing(0)
 
@@ -685,14 +705,28 @@ class GCodeWidget(QtGui.QWidget):
             return
         if self.current_line_number < len(self.current_gcode):
             self.machine_interface.sendGCommand(self.current_gcode[self.current_line_number])
-            if self.editor is not None:
+            if self.editor is not None and self.file_reader is None:
                 self.editor.highlightLine(self.current_line_number)
             self.current_line_number += 1
         else:
             self.send_timer.stop()
 
+    def filePushed(self):
+        filename = QtWidgets.QFileDialog.getOpenFileName(self, 'Open file', '', "GCode files (*.ngc *.nc *.gcode);;All files (*)")[0]
+        if self.file_reader is not None:
+            self.send_timer.stop()
+            self.file_reader.close()
+            self.file_reader = None
+            self.current_gcode = []
+        if filename:
+            self.file_reader = GCodeReader(filename)
+            print("streaming", filename, len(self.file_reader), "lines")
+
     def startPushed(self):
-        if self.editor is not None:
+        if self.file_reader is not None:
+            self.current_gcode = self.file_reader
+
+        elif self.editor is not None:
             self.current_gcode = self.editor.getText()
 
         elif self.path_dialog is not None and self.path_dialog.pathtab.selectedTool is not None:
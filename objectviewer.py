@@ -117,44 +117,12 @@ class ObjectViewer(QtGui.QWidget):
             self.linecolors = []
             self.pointcolors = []
             self.gpoints = path
-            self.interpolated = path.get_draw_path(interpolate_arcs=True)
-            colorcycle = 0.0
-            # if path.outpaths!=None and len(path.outpaths)>0:
-            #     point_count = sum([len(subpath) for subpath in path.outpaths ])
-            #     for subpath in path.outpaths:
-            #         for p in subpath:
-            #             if p.position is not None:
-            #                 self.rawpath.append(p.position)
-            #                 point_color=(1.0-(colorcycle/point_count),  (colorcycle/point_count),  0.0,  1.0)
-            #                 if p.rapid:
-            #                     point_color=(1.0,  1.0,  1.0,  1.0)
-            #                 if not p.inside_model:
-            #                     point_color=(0.0,  0.0,  1.0,  1.0)
-            #                 if not p.in_contact:
-            #                     point_color=(0.3,  0.3,  0.7,  0.5)
-            #                 self.colors.append(point_color)
-            #                 colorcycle+=1
-            # else:
-            point_count = len(path.path)
-            for p in path.get_draw_path():
-                if p.position is not None:
-                    self.rawpath.append(p.position)
-                    point_color = (1.0 - (colorcycle / point_count), (colorcycle / point_count), 0.0, 1.0)
-                    if p.rapid:
-                        point_color = (1.0, 1.0, 1.0, 1.0)
-                    if not p.inside_model:
-                        point_color = (0.0, 0.0, 1.0, 1.0)
-                    if not p.in_contact:
-                        point_color = (0.3, 0.3, 0.7, 0.5)
-                    self.linecolors.append(point_color)
-                    if not p.interpolated:
-                        self.pointcolors.append(point_color)
-                    else:
-                        self.pointcolors.append((0.0,0.0,0.0,0.0))
-                    colorcycle += 1
+            self.setDrawArrays(path.get_draw_arrays(interpolate_arcs=True))
 
         else:
             self.rawpath = []
+            self.linecolors = []
+            self.pointcolors = []
             self.colors = []
             for p in path:
                 # rawpath.append(p[0])
@@ -166,6 +134,41 @@ class ObjectViewer(QtGui.QWidget):
                 self.pointcolors.append((0.1, 0.1, 0.1, 0.2))
 
                 # colors=[color for p in rawpath]
+        self.refreshPathPlot(width)
+
+    # draws the updated rows start..new_end-1 of the path displayed before, which had the rows
+    # start..old_end-1 instead, and keeps the drawn points of all other rows
+    def updatePathRange(self, path, start, old_end, new_end, width=1, tool=None):
+        if self.gpoints is None or len(self.rawpath) == 0 or len(path.path) != len(self.gpoints.path)+new_end-old_end:
+            self.showPath(path, width=width, tool=tool)
+            return
+        draw = self.draw_arrays
+        low = searchsorted(draw["row"], start)
+        high = searchsorted(draw["row"], old_end)
+        update = path.get_draw_arrays(start, new_end, interpolate_arcs=True)
+        merged = dict()
+        for key in draw.keys():
+            tail = draw[key][high:]
+            if key == "row" or key == "line_number":
+                tail = tail+(new_end-old_end)
+            merged[key] = concatenate((draw[key][:low], update[key], tail))
+        self.gpoints = path
+        self.setDrawArrays(merged)
+        self.refreshPathPlot(width)
+
+    def setDrawArrays(self, draw_arrays):
+        self.draw_arrays = draw_arrays
+        self.rawpath = draw_arrays["position"]
+        point_count = max(len(self.rawpath), 1)
+        colorcycle = arange(len(self.rawpath))/float(point_count)
+        colors = column_stack((1.0-colorcycle, colorcycle, zeros(len(colorcycle)), ones(len(colorcycle))))
+        colors[draw_arrays["rapid"]] = (1.0, 1.0, 1.0, 1.0)
+        colors[~draw_arrays["inside_model"]] = (0.0, 0.0, 1.0, 1.0)
+        colors[~draw_arrays["in_contact"]] = (0.3, 0.3, 0.7, 0.5)
+        self.linecolors = colors
+        self.pointcolors = where(draw_arrays["interpolated"][:, newaxis], 0.0, colors)
+
+    def refreshPathPlot(self, width=1):
         if len(self.rawpath) == 0: return
 
         self.path_slider.setMaximum(len(self.rawpath))
@@ -184,8 +187,6 @@ class ObjectViewer(QtGui.QWidget):
 
             self.pathPlotHighlight.setData(pos=array(drawpath), color=array(self.pointcolors))
 
-
-
     def setSelection(self, start_index, end_index):
         self.path_slider.blockSignals(True)
         self.path_slider.setValue(end_index)
@@ -203,12 +204,18 @@ class ObjectViewer(QtGui.QWidget):
             self.pathPlotHighlight.setData(pos=array(drawpath), color=array(self.pointcolors[start_index:end_index]))
 
             if self.gpoints is not None:
-                lp = self.gpoints.path[end_index - 1]
-                feed = self.gpoints.default_feedrate
-                if lp.feedrate is not None:
-                    feed = lp.feedrate
-                self.stats.setText(
-                    "x=% 4.2f y=% 4.2f z=% 4.2f f=%i, line=%i" % (lp.position[0], lp.position[1], lp.position[2], int(feed), lp.line_number))
+                self.showPointStats(end_index - 1)
+
+    # shows position, feedrate and line of a drawn point, returns its position and rotation
+    def showPointStats(self, index):
+        position = self.rawpath[index]
+        rotation = self.draw_arrays["rotation"][index]
+        feed = self.draw_arrays["feedrate"][index]
+        if isnan(feed):
+            feed = self.gpoints.default_feedrate if self.gpoints.default_feedrate is not None else 0
+        self.stats.setText(
+            "x=% 4.2f y=% 4.2f z=% 4.2f f=%i, line=%i" % (position[0], position[1], position[2], int(feed), self.draw_arrays["line_number"][index]))
+        return position, rotation
 
     @staticmethod
     def rounded_cylinder(rows, cols, radius=[1.0, 1.0, 0.0], length=1.0, offset=False):
@@ -318,22 +325,16 @@ class ObjectViewer(QtGui.QWidget):
 
 
             if self.gpoints is not None:
-                lp = self.interpolated[end_index - 1]
-                feed = self.gpoints.default_feedrate
-                if lp.feedrate is not None:
-                    feed = lp.feedrate
-                if lp.feedrate is not None and lp.position is not None:
-                    self.stats.setText(
-                        "x=% 4.2f y=% 4.2f z=% 4.2f f=%i, line=%i" % (lp.position[0], lp.position[1], lp.position[2], int(feed), lp.line_number))
+                position, rotation = self.showPointStats(end_index - 1)
                 if self.gl_cutting_tool is not None:
                     self.gl_cutting_tool.resetTransform()
-                    if lp.rotation is not None:
-                        self.gl_cutting_tool.rotate(-lp.rotation[0], 1, 0, 0)
-                        axis = rotate_y((0, 0, 1), lp.rotation[1]*PI/180.0)
-                        #self.gl_cutting_tool.rotate(lp.rotation[2], 0, 1, 0)
-                        self.gl_cutting_tool.rotate(-lp.rotation[2], axis[0], axis[1], axis[2])
-                        #self.gl_cutting_tool.rotate(2*lp.rotation[1], 0, 1, 0)
-
-                        self.gl_cutting_tool.translate(lp.position[0], lp.position[1], lp.position[2])
+                    if not isnan(rotation[0]):
+                        self.gl_cutting_tool.rotate(-rotation[0], 1, 0, 0)
+                        axis = rotate_y((0, 0, 1), rotation[1]*PI/180.0)
+                        #self.gl_cutting_tool.rotate(rotation[2], 0, 1, 0)
+                        self.gl_cutting_tool.rotate(-rotation[2], axis[0], axis[1], axis[2])
+                        #self.gl_cutting_tool.rotate(2*rotation[1], 0, 1, 0)
+
+                        self.gl_cutting_tool.translate(position[0], position[1], position[2])
                     else:
-                        self.gl_cutting_tool.translate(lp.position[0], lp.position[1], lp.position[2])
+                        self.gl_cutting_tool.translate(position[0], position[1], position[2])
@@ -0,0 +1,127 @@
+from numpy import *
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Cycle time estimate with a model of GRBL's motion planner: junction speeds from the junction
+# deviation, trapezoidal acceleration profiles, and a look-ahead buffer of planner blocks that must
+# always be able to stop at its end. All passes are vectorised over the segments of the path.
+
+
+# Machine limits as in GRBL's settings: $110-$112 max. rate (mm/min), $120-$122 acceleration (mm/s^2),
+# $11 junction deviation (mm). planner_blocks is the size of the look-ahead buffer.
+class MachineLimits:
+    def __init__(self, max_rate=[3000.0, 3000.0, 3000.0], acceleration=[100.0, 100.0, 100.0], junction_deviation=0.01, planner_blocks=16):
+        self.max_rate = list(max_rate)
+        self.acceleration = list(acceleration)
+        self.junction_deviation = junction_deviation
+        self.planner_blocks = planner_blocks
+        self.from_controller = False # False while the values are the defaults above
+
+    # takes the values of a settings dict ({110: 500.0, ...}) or of "$110=500.000" lines (reply to $$)
+    def updateFromSettings(self, settings):
+        if not isinstance(settings, dict):
+            settings = parse_grbl_settings(settings)
+        for axis in range(0, 3):
+            if 110+axis in settings:
+                self.max_rate[axis] = settings[110+axis]
+            if 120+axis in settings:
+                self.acceleration[axis] = settings[120+axis]
+        if 11 in settings:
+            self.junction_deviation = settings[11]
+        if len([key for key in [11, 110, 111, 112, 120, 121, 122] if key in settings]) > 0:
+            self.from_controller = True
+
+
+# the limits used when none are given; updated when the GRBL settings are read from the controller
+default_limits = MachineLimits()
+
+
+def parse_grbl_settings(lines):
+    settings = dict()
+    for line in lines:
+        line = line.split("(")[0].strip()
+        if len(line) > 1 and line[0] == "$" and "=" in line:
+            key, value = line[1:].split("=", 1)
+            try:
+                settings[int(key)] = float(value)
+            except ValueError:
+                pass
+    return settings
+
+
+# limit (per axis) scaled along the unit vectors, as GRBL's limit_value_by_axis_maximum
+def limit_by_axes(unit, limits):
+    with errstate(divide="ignore"):
+        return (array(limits, dtype=float)/abs(unit)).min(axis=1)
+
+
+# time to move each segment with entry/exit speed squared w0/w1, nominal speed v and acceleration a
+def trapezoid_times(length, w0, w1, v, a):
+    v0 = sqrt(w0)
+    v1 = sqrt(w1)
+    accelerate = (v*v-w0)/(2.0*a)
+    decelerate = (v*v-w1)/(2.0*a)
+    cruise = length-accelerate-decelerate
+    # segments too short to reach the nominal speed accelerate to a peak and decelerate again
+    peak = sqrt(maximum((2.0*a*length+w0+w1)/2.0, 0.0))
+    peak = minimum(peak, v)
+    return where(cruise > 0, (v-v0)/a+(v-v1)/a+maximum(cruise, 0.0)/v, (peak-v0)/a+(peak-v1)/a)
+
+
+# Estimated duration (in minutes) of moving through the positions with the given feedrates (mm/min)
+# and rapid flags of the target points. Returns (length, duration, cut_length, rapid_length,
+# cut_duration, rapid_duration).
+def planner_estimate(position, feedrate, rapid, limits=None):
+    if limits is None:
+        limits = default_limits
+    position = asarray(position, dtype=float)
+    if len(position) < 2:
+        return (0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+    delta = diff(position, axis=0)
+    length = sqrt((delta*delta).sum(axis=1))
+    moving = length > 1e-9
+    length = length[moving]
+    unit = delta[moving]/length[:, newaxis]
+    feed = asarray(feedrate, dtype=float)[1:][moving]/60.0
+    is_rapid = asarray(rapid, dtype=bool)[1:][moving]
+    n = len(length)
+    if n == 0:
+        return (0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+
+    speed = limit_by_axes(unit, limits.max_rate)/60.0
+    speed = where(is_rapid, speed, minimum(speed, feed))
+    accel = limit_by_axes(unit, limits.acceleration)
+
+    # maximum junction speeds (squared) between consecutive segments from the junction deviation
+    cos_theta = -(unit[:-1]*unit[1:]).sum(axis=1)
+    junction_unit = unit[1:]-unit[:-1]
+    norms = sqrt((junction_unit*junction_unit).sum(axis=1))
+    junction_accel = limit_by_axes(junction_unit/maximum(norms, 1e-12)[:, newaxis], limits.acceleration)
+    sin_theta_d2 = sqrt(maximum(0.5*(1.0-cos_theta), 0.0))
+    with errstate(divide="ignore", invalid="ignore"):
+        junction = junction_accel*limits.junction_deviation*sin_theta_d2/(1.0-sin_theta_d2)
+    junction = where(cos_theta > 0.999999, 0.0, junction) # reversal
+    junction = where(cos_theta < -0.999999, inf, junction) # straight
+    junction = minimum(junction, minimum(speed[:-1], speed[1:])**2)
+    # entry speed limits (squared): standing start, and the junctions; the path ends standing
+    limit = concatenate(([0.0], junction, [0.0]))
+
+    # backward pass, w[i] = min(limit[i], w[i+1] + 2*a*L): with the running sum S of 2*a*L this is
+    # a cumulative minimum of limit+S from the end. The look-ahead buffer only sees the next
+    # planner_blocks segments, the last of which must be able to stop, hence a sliding minimum.
+    reach = 2.0*accel*length
+    s = concatenate(([0.0], cumsum(reach)))
+    blocks = max(1, int(limits.planner_blocks))
+    padded = concatenate((limit+s, full(blocks, inf)))
+    window = sliding_window_view(padded, blocks)[:n+1].min(axis=1)
+    stop = s[minimum(arange(n+1)+blocks, n)]
+    w = minimum(window, stop)-s
+    # forward pass, w[i+1] = min(w[i+1], w[i] + 2*a*L), as a cumulative minimum from the start
+    w = minimum.accumulate(w-s)+s
+    w = maximum(w, 0.0)
+
+    times = trapezoid_times(length, w[:-1], w[1:], speed, accel)/60.0
+    cut_length = length[~is_rapid].sum()
+    rapid_length = length[is_rapid].sum()
+    cut_duration = times[~is_rapid].sum()
+    rapid_duration = times[is_rapid].sum()
+    return (cut_length+rapid_length, cut_duration+rapid_duration, cut_length, rapid_length, cut_duration, rapid_duration)
@@ -1,7 +1,113 @@
 
 import pyclipper
 from gcode import *
-from scipy.spatial import Voronoi
+from scipy.spatial import Voronoi,  cKDTree
+from collections import deque
+import numpy as np
+
+# hashable key of a set of polygons in clipper integer coordinates (z is ignored).
+# Identical contours on different slice levels produce the same key.
+def quantized_polygons_key(polygons, scaling = 1000.0):
+    return tuple(sorted(tuple((int(scaling*p[0]), int(scaling*p[1])) for p in poly) for poly in polygons))
+
+# even-odd ray casting of points (x, y) against edges (x1, y1)-(x2, y2), vectorized over points and edges.
+# Same crossing rule as PolygonGroup.pointInside.
+def crossings_odd(x,  y,  x1,  y1,  x2,  y2):
+    x = x[:,  np.newaxis]
+    y = y[:,  np.newaxis]
+    crossing = (y > np.minimum(y1,  y2)) & (y <= np.maximum(y1,  y2)) & (x <= np.maximum(x1,  x2))
+    with np.errstate(divide='ignore',  invalid='ignore'):
+        xinters = (y-y1)*(x2-x1)/(y2-y1)+x1
+    crossing &= (x1 == x2) | (x <= xinters)
+    return (np.count_nonzero(crossing,  axis=1) % 2) == 1
+
+# Nearest-segment index over a list of polygons, for batched closest point queries.
+# Segments are numbered like in closest_point_on_polygon (index i is the segment ending at poly[i],
+# index 0 is the first point itself), so results match the scalar functions.
+# Segments are subdivided into pieces of at most "spacing" length, whose midpoints go into a kd-tree.
+class SegmentIndex:
+    def __init__(self,  polygons,  closed = True,  spacing = None):
+        self.polygons = polygons
+        starts = []
+        ends = []
+        poly_index = []
+        segment_index = []
+        for pi,  poly in enumerate(polygons):
+            n = len(poly)
+            if n==0:
+                continue
+            points = np.zeros((n,  3))
+            for i,  p in enumerate(poly):
+                points[i, 0:len(p)] = p[0:3]
+            if closed:
+                starts.append(np.vstack([points[0:1],  points]))
+                ends.append(np.vstack([points[0:1],  points[1:],  points[0:1]]))
+                segment_index.append(np.arange(n+1))
+            else:
+                starts.append(np.vstack([points[0:1],  points[:-1]]))
+                ends.append(points)
+                segment_index.append(np.arange(n))
+            poly_index.append(np.full(len(segment_index[-1]),  pi))
+        if len(starts)==0:
+            self.starts = np.zeros((0,  3))
+            self.ends = np.zeros((0,  3))
+            self.polyIndex = np.zeros(0,  dtype=int)
+            self.segmentIndex = np.zeros(0,  dtype=int)
+            self.tree = None
+            return
+        self.starts = np.concatenate(starts)
+        self.ends = np.concatenate(ends)
+        self.polyIndex = np.concatenate(poly_index)
+        self.segmentIndex = np.concatenate(segment_index)
+
+        lengths = np.linalg.norm(self.ends-self.starts,  axis=1)
+        if spacing is None:
+            spacing = lengths[lengths>0].mean() if (lengths>0).any() else 1.0
+        pieces = np.maximum(1,  np.ceil(lengths/spacing).astype(int))
+        owner = np.repeat(np.arange(len(lengths)),  pieces)
+        piece = np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces)-pieces,  pieces)
+        t = (piece+0.5)/pieces[owner]
+        midpoints = self.starts[owner] + t[:, np.newaxis]*(self.ends[owner]-self.starts[owner])
+        self.pieceOwner = owner
+        # every point of a segment is within halfLength of one of its piece midpoints
+        self.halfLength = (lengths/pieces).max()/2.0
+        self.tree = cKDTree(midpoints)
+
+    # exact distance and closest point of points to the given segments (arrays of equal length)
+    def segmentDistances(self,  points,  segments):
+        a = self.starts[segments]
+        ab = self.ends[segments]-a
+        ab_sp = (ab*ab).sum(axis=1)
+        with np.errstate(divide='ignore',  invalid='ignore'):
+            t = np.where(ab_sp>0,  ((points-a)*ab).sum(axis=1)/ab_sp,  0.0)
+        t = np.clip(t,  0.0,  1.0)
+        closest = a+t[:, np.newaxis]*ab
+        return np.linalg.norm(points-closest,  axis=1),  closest
+
+    # batched nearest segment query. Returns distances, closest points, polygon indices and segment indices
+    def query(self,  points):
+        points = np.asarray([list(p[0:3])+[0.0]*(3-len(p)) for p in points],  dtype=float).reshape(-1,  3)
+        n = len(points)
+        if n==0 or self.tree is None:
+            return np.full(n,  np.inf),  np.zeros((n,  3)),  np.full(n,  -1),  np.full(n,  -1)
+        # the nearest midpoint gives an upper bound for the distance to the nearest segment
+        d0,  nearest = self.tree.query(points)
+        candidates = self.tree.query_ball_point(points,  d0+self.halfLength+1e-9)
+        counts = np.array([len(c) for c in candidates])
+        query_index = np.repeat(np.arange(n),  counts)
+        segments = self.pieceOwner[np.concatenate([np.asarray(c,  dtype=int) for c in candidates])]
+        # order candidates by query, then segment number, so that ties resolve like the scalar search
+        order = np.lexsort((segments,  query_index))
+        query_index = query_index[order]
+        segments = segments[order]
+        distances,  closest = self.segmentDistances(points[query_index],  segments)
+        starts = np.concatenate([[0],  np.cumsum(counts)[:-1]])
+        best_distance = np.minimum.reduceat(distances,  starts)
+        # first candidate of each query reaching its minimum
+        best = np.flatnonzero(distances == best_distance[query_index])
+        best = best[np.concatenate([[True],  np.diff(query_index[best])!=0])]
+        best_segment = segments[best]
+        return best_distance,  closest[best],  self.polyIndex[best_segment],  self.segmentIndex[best_segment]
 
 class PolygonGroup:
     def __init__(self,  polys = None,  precision = 0.005,  scaling = 1000.0,  zlevel = 0):
@@ -13,9 +119,11 @@ class PolygonGroup:
         self.scaling = scaling
         self.precision = precision
         self.zlevel = zlevel
+        self.gridIndex = None
     
     def addPolygon(self,  points):
         self.polygons.append(points)
+        self.gridIndex = None
     
     # determine if a point is inside this polygon 
     def pointInside(self,  p):
@@ -38,7 +146,84 @@ class PolygonGroup:
                                 inside = not inside
                 p1x,p1y = p2x,p2y
         return inside
+
+    # all polygon edges as arrays x1, y1, x2, y2 (including the closing edge of each polygon)
+    def edgeArrays(self):
+        starts = []
+        ends = []
+        for poly in self.polygons:
+            if len(poly)==0:
+                continue
+            points = np.asarray([p[0:2] for p in poly],  dtype=float)
+            starts.append(points)
+            ends.append(np.roll(points,  -1,  axis=0))
+        if len(starts)==0:
+            return np.zeros(0),  np.zeros(0),  np.zeros(0),  np.zeros(0)
+        starts = np.concatenate(starts)
+        ends = np.concatenate(ends)
+        return starts[:, 0],  starts[:, 1],  ends[:, 0],  ends[:, 1]
+
+    # Edge-bucket index for pointsInside: the y range is split into rows, and every edge is listed in
+    # all rows its y span touches. A horizontal ray from a point can only cross edges of the point's row.
+    # Needs to be rebuilt if the polygons are modified directly.
+    def buildGridIndex(self,  rows=None):
+        x1,  y1,  x2,  y2 = self.edgeArrays()
+        if len(x1)==0:
+            self.gridIndex = None
+            return
+        if rows is None:
+            rows = int(sqrt(len(x1)))+1
+        ymin = min(y1.min(),  y2.min())
+        ymax = max(y1.max(),  y2.max())
+        height = (ymax-ymin)/rows
+        if height<=0:
+            height = 1.0
+        first_row = np.clip(((np.minimum(y1,  y2)-ymin)/height).astype(int),  0,  rows-1)
+        last_row = np.clip(((np.maximum(y1,  y2)-ymin)/height).astype(int),  0,  rows-1)
+        # expand edges into (row, edge) pairs, sorted by row
+        counts = last_row-first_row+1
+        edge_index = np.repeat(np.arange(len(x1)),  counts)
+        row_index = np.repeat(first_row,  counts) + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts)-counts,  counts))
+        order = np.argsort(row_index,  kind='stable')
+        buckets = edge_index[order]
+        offsets = np.searchsorted(row_index[order],  np.arange(rows+1))
+        self.gridIndex = (ymin,  height,  rows,  buckets,  offsets,  (x1,  y1,  x2,  y2))
+
+    # batch version of pointInside for an (n, 2) or (n, 3) array of points. Returns a boolean array.
+    def pointsInside(self,  points,  chunk_size=1000000):
+        inside = np.zeros(len(points),  dtype=bool)
+        if len(points)==0 or len(self.polygons)==0:
+            return inside
+        points = np.asarray([p[0:2] for p in points] if isinstance(points,  list) else points,  dtype=float)
+        x = points[:, 0]
+        y = points[:, 1]
+        if self.gridIndex is None:
+            edges = self.edgeArrays()
+            step = max(1,  int(chunk_size/max(1,  len(edges[0]))))
+            for start in range(0,  len(points),  step):
+                inside[start:start+step] = crossings_odd(x[start:start+step],  y[start:start+step],  *edges)
+            return inside
+
+        ymin,  height,  rows,  buckets,  offsets,  (x1,  y1,  x2,  y2) = self.gridIndex
+        point_rows = ((y-ymin)/height).astype(int)
+        valid = (y>=ymin) & (point_rows<=rows)
+        point_rows = np.clip(point_rows,  0,  rows-1)
+        order = np.argsort(point_rows,  kind='stable')
+        order = order[valid[order]]
+        sorted_rows = point_rows[order]
+        bounds = np.flatnonzero(np.diff(sorted_rows))+1
+        for group in np.split(order,  bounds):
+            if len(group)==0:
+                continue
+            row = point_rows[group[0]]
+            e = buckets[offsets[row]:offsets[row+1]]
+            if len(e)>0:
+                inside[group] = crossings_odd(x[group],  y[group],  x1[e],  y1[e],  x2[e],  y2[e])
+        return inside
     
+    def quantizedKey(self):
+        return quantized_polygons_key(self.polygons,  self.scaling)
+
     def getBoundingBox(self):
         points = [p for poly in self.polygons for p in poly]
         return polygon_bounding_box(points)
@@ -49,6 +234,7 @@ class PolygonGroup:
                 p[0]+=v[0]
                 p[1] += v[1]
                 p[2] += v[2]
+        self.gridIndex = None
     
     def interpolateLines(self,  maxLength):
         ipolys=[]
@@ -68,135 +254,112 @@ class PolygonGroup:
             ipolys.append(newpoly)
         return ipolys
     
-    def medialLines(self):
-        points=[]
-        ipolys = self.interpolateLines(2.0)
-        
-        for poly in ipolys:
-            points+=[[p[0],  p[1]] for p in poly]
-        if len(points)<3: 
+    # array version of interpolateLines: returns one (n, 2) array per polygon with no edge longer than maxLength
+    def densify(self,  maxLength):
+        dpolys = []
+        for poly in self.polygons:
+            if len(poly)==0:
+                continue
+            points = np.asarray([p[0:2] for p in poly],  dtype=float)
+            vectors = np.roll(points,  -1,  axis=0)-points
+            lengths = np.linalg.norm(vectors,  axis=1)
+            pieces = (lengths/maxLength).astype(int)+1
+            owner = np.repeat(np.arange(len(points)),  pieces)
+            t = (np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces)-pieces,  pieces)) / pieces[owner]
+            dpolys.append(points[owner] + t[:, np.newaxis]*vectors[owner])
+        return dpolys
+
+    # medial lines as 2-point segments between Voronoi vertices that lie inside the polygons.
+    # The boundary is sampled every "spacing" mm, or coarser on large pockets to keep at most max_samples points.
+    def medialLines(self,  spacing = 2.0,  max_samples = 20000):
+        perimeter = sum([np.linalg.norm(np.diff(np.asarray([p[0:2] for p in poly+poly[0:1]],  dtype=float),  axis=0),  axis=1).sum() for poly in self.polygons if len(poly)>0])
+        spacing = max(spacing,  perimeter/max_samples)
+        dpolys = self.densify(spacing)
+        if sum([len(d) for d in dpolys])<3:
             return []
-        vor = Voronoi(points)
-        
-        vpoints = [[p[0],  p[1],  self.zlevel] for p in vor.vertices]
-        segments = []
-        for r in vor.ridge_vertices:
-            if r[0]>=0 and r[1]>=0 and  self.pointInside(vpoints[r[0]]) and  self.pointInside(vpoints[r[1]]):
-                segments.append([r[0],  r[1]])
-        outpaths = [[vpoints[i] for i in s]for s in segments]
+        vor = Voronoi(np.concatenate(dpolys))
+
+        self.buildGridIndex()
+        inside = self.pointsInside(vor.vertices)
+        ridges = np.asarray(vor.ridge_vertices,  dtype=int).reshape(-1,  2)
+        ridges = ridges[(ridges>=0).all(axis=1)]
+        ridges = ridges[inside[ridges].all(axis=1)]
+        vpoints = np.column_stack([vor.vertices,  np.full(len(vor.vertices),  self.zlevel)])
+        outpaths = vpoints[ridges].tolist()
         cleanPaths = PolygonGroup(polys=outpaths,  precision=0.5,  zlevel=self.zlevel)
         #cleanPaths.joinConnectedLines()
         return cleanPaths
 
+    # joins line segments that share end points (within precision) into maximal polylines.
+    # Polylines are split at junctions (points shared by more than two segments), closed loops are
+    # returned with the first point repeated at the end. Degenerate and duplicate segments are dropped,
+    # as are stray points that are part of another line.
     def joinConnectedLines(self):
-        finished = False
-        
-        while not finished:
-            finished = True
-            for i in range(0, len(self.polygons)):
-                poly=self.polygons[i]
-                if len(poly)==0:
-                    del self.polygons[i]
-                    finished=False
-                    break
-                if len(poly)==1: # for stray points, check if they are already contained somewhere
-                    contained = False
-                    for j in range(0, len(self.polygons)):
-                        if i!=j:
-                            s = self.polygons[j]
-                            for p in s:
-                                if dist(poly[0],  p)<self.precision:
-                                    contained=True
-                                    break
-                            if contained:
-                                break
-                    if contained:
-                        del self.polygons[i]
-                        finished=False
-                        break
-                if not finished:
-                    break
-                # see if this fits any existing segment:
-                inserted=False
-                for j in range(i+1, len(self.polygons)):
-                    inserted=False
-                    s = self.polygons[j]
-                    if dist(poly[0],  s[0])<self.precision:
-                        for p in s[1:]:
-                            poly.insert(0,  p)
-                        inserted=True
-                    elif dist(poly[0],  s[-1])<self.precision:
-                        for p in reversed(s[:-1]):
-                            poly.insert(0,  p)
-                        inserted=True
-                    elif dist(poly[-1],  s[0])<self.precision:
-                        for p in (s[1:]):
-                            poly.append(p)
-                        inserted=True
-                    elif dist(poly[-1],  s[-1])<self.precision:
-                        for p in reversed(s[:-1]):
-                            poly.append(p)
-                        inserted=True
-                    if inserted:
-                        del self.polygons[j]
-                        finished=False
-                        break
-                if not finished:
-                    break
-                    # we're only done if we can't do any more joining
-            #remove overlapping line segments
-            for poly in self.polygons:
-                if len(poly)>=2:
-                    closest_distance,  closest_point,  closest_index = closest_point_on_open_polygon(poly[0],  poly[1:])
-                    if closest_distance <self.precision:
-                        #remove overlapping point
-                        del poly[0]
-                        finished=False
-                        break
-                if len(poly)>=2:
-                    closest_distance,  closest_point,  closest_index = closest_point_on_open_polygon(poly[-1],  poly[:-1])
-                    if closest_distance <self.precision:
-                        #remove overlapping point
-                        del poly[-1]
-                        finished = False
-                        break
-        #delete any stray lines left after joining
-        #for i in reversed(range(0, len(self.polygons))):
-        #     poly=self.polygons[i]
-        #     if len(poly)==2:
-        #         del self.polygons[i]
-
-        #check for joints and split segments at the joint
-        finished=False
-        while not finished:
-            finished=True
-            for i in range(0, len(self.polygons)):
-                for j in range(0, len(self.polygons)):
-                    if i!=j and len(self.polygons[i])>2:
-                        for k in range(1, len(self.polygons[i])-1): # go through all points except start and end
-                            if dist(self.polygons[i][k], self.polygons[j][0]) < self.precision or dist(self.polygons[i][k], self.polygons[j][-1]) < self.precision:
-                                #split poly
-                                segment1 = [p for p in self.polygons[i][:k+1]] #include joint point
-                                segment2 = [p for p in self.polygons[i][k:]]
-                                del self.polygons[i]
-                                self.polygons.append(segment1)
-                                self.polygons.append(segment2)
-                                finished = False
-                                break
-                    if not finished:
-                        break
-                if not finished: 
-                    break
-        finished=False
-        while not finished:
-            finished=True
-            for i in range(0, len(self.polygons)):
-                if len(self.polygons[i])==2 and dist(self.polygons[i][0], self.polygons[i][1])<self.precision:
-                    del self.polygons[i]
-                    finished=False
-                    break
+        # snap points to nodes using a hash grid with cell size = precision
+        grid = dict()
+        nodes = []
+        def node_of(p):
+            cell = (int(floor(p[0]/self.precision)),  int(floor(p[1]/self.precision)))
+            for dx in (-1,  0,  1):
+                for dy in (-1,  0,  1):
+                    for n in grid.get((cell[0]+dx,  cell[1]+dy),  []):
+                        if dist(p,  nodes[n])<self.precision:
+                            return n
+            nodes.append(p)
+            grid.setdefault(cell,  []).append(len(nodes)-1)
+            return len(nodes)-1
 
+        edges = []
+        edge_set = set()
+        stray_points = []
+        for poly in self.polygons:
+            if len(poly)==1:
+                stray_points.append(node_of(poly[0]))
+                continue
+            last = None
+            for p in poly:
+                n = node_of(p)
+                if last is not None and n!=last and (min(n,  last),  max(n,  last)) not in edge_set:
+                    edge_set.add((min(n,  last),  max(n,  last)))
+                    edges.append((last,  n))
+                last = n
 
+        adjacent = [[] for n in nodes]
+        for e,  (a,  b) in enumerate(edges):
+            adjacent[a].append(e)
+            adjacent[b].append(e)
+
+        # walk each unvisited edge forward and backward until a junction, an end or the start is reached
+        visited = [False]*len(edges)
+        lines = []
+        for e,  (a,  b) in enumerate(edges):
+            if visited[e]:
+                continue
+            visited[e] = True
+            line = deque([a,  b])
+            for forward in (True,  False):
+                current = b if forward else a
+                previous_edge = e
+                while len(adjacent[current])==2 and not (line[0]==line[-1] and len(line)>2):
+                    next_edge = adjacent[current][0] if adjacent[current][1]==previous_edge else adjacent[current][1]
+                    if visited[next_edge]:
+                        break
+                    visited[next_edge] = True
+                    ea,  eb = edges[next_edge]
+                    current = eb if ea==current else ea
+                    if forward:
+                        line.append(current)
+                    else:
+                        line.appendleft(current)
+                    previous_edge = next_edge
+            lines.append([nodes[n] for n in line])
+
+        for n in stray_points:
+            if len(adjacent[n])==0:
+                lines.append([nodes[n]])
+                adjacent[n].append(None) # only keep one copy of duplicate stray points
+        self.polygons = lines
+        self.gridIndex = None
 
     def medialLines2(self):
         lines = []
@@ -216,78 +379,34 @@ class PolygonGroup:
                 segments.append([m1,  m2])
         return segments
     
-    def offset(self,  radius=0,  rounding = 0.0):
-        offset=[]
-        clip = pyclipper.PyclipperOffset()  #Pyclipper
-        polyclipper = pyclipper.Pyclipper()  #Pyclipper
-        for pat in self.polygons:
-            outPoly=[[int(self.scaling*p[0]), int(self.scaling*p[1])] for p in pat]  #Pyclipper
-            outPoly  = pyclipper.SimplifyPolygons([outPoly])            
-            try:
-                polyclipper.AddPaths(outPoly, poly_type=pyclipper.PT_SUBJECT, closed=True)
-            except:
-                None
-                #print "path invalid",  outPoly
-        poly = polyclipper.Execute(pyclipper.CT_UNION, pyclipper.PFT_EVENODD, pyclipper.PFT_EVENODD)
-        clip.AddPaths(poly, pyclipper.JT_ROUND, pyclipper.ET_CLOSEDPOLYGON)
-
-        offset = clip.Execute( -int((radius+rounding)*self.scaling))
-        offset = pyclipper.SimplifyPolygons(offset)
-        if rounding>0.0:
-            roundclipper =  pyclipper.PyclipperOffset() 
-            roundclipper.AddPaths(offset, pyclipper.JT_ROUND, pyclipper.ET_CLOSEDPOLYGON)
+    def toIntegerGroup(self):
+        return IntPolygonGroup.fromPolygonGroup(self)
 
-            offset = roundclipper.Execute( int(rounding*self.scaling))
-        offset = pyclipper.CleanPolygons(offset,  distance=self.scaling*self.precision)
-        #print (len(offset))
-        
-        result = PolygonGroup(scaling = self.scaling,  precision = self.precision,  zlevel = self.zlevel)
-        result.polygons = []
-        for poly in offset:
-            if len(poly)>0:
-                output_poly = [[float(x[0])/self.scaling,  float(x[1])/self.scaling, self.zlevel]  for x in poly]
-                result.addPolygon(output_poly)
-        return result
+    def offset(self,  radius=0,  rounding = 0.0):
+        return self.toIntegerGroup().offset(radius=radius,  rounding=rounding).toPolygonGroup()
 
     def convolute(self, pattern):
-        spoly=[]
-        for pat in self.polygons:
-            spoly.append([[int(self.scaling*p[0]), int(self.scaling*p[1])] for p in pat])  #Pyclipper
-
-        spattern = [[int(self.scaling*p[0]), int(self.scaling*p[1])] for p in pattern]
-
-        output =  pyclipper.MinkowskiSum2(spattern, spoly, True)
-        result = PolygonGroup(scaling = self.scaling,  precision = self.precision,  zlevel = self.zlevel)
-        result.polygons = []
-        for poly in output:
-            if len(poly)>0:
-                output_poly = [[float(x[0])/self.scaling,  float(x[1])/self.scaling, self.zlevel]  for x in poly]
-                result.addPolygon(output_poly)
-        return result
-
+        return self.toIntegerGroup().convolute(pattern).toPolygonGroup()
 
     def trim(self,  trimPoly):
         if len(self.polygons)>0 and len(trimPoly.polygons)>0:
-            
-            polytrim = pyclipper.Pyclipper()  #Pyclipper
-            polytrim.AddPaths([[[int(self.scaling*p[0]), int(self.scaling*p[1])] for p in pat] for pat in  trimPoly.polygons],  poly_type=pyclipper.PT_CLIP, closed=True)
-            polytrim.AddPaths([[[int(self.scaling*p[0]), int(self.scaling*p[1])] for p in pat] for pat in  self.polygons],  poly_type=pyclipper.PT_SUBJECT, closed=True)
-            try:
-                trimmed = polytrim.Execute(pyclipper.CT_INTERSECTION, pyclipper.PFT_EVENODD, pyclipper.PFT_EVENODD)
-                trimmed = pyclipper.SimplifyPolygons(trimmed)
-                self.polygons = [[[float(x[0])/self.scaling,  float(x[1])/self.scaling, self.zlevel]  for x in poly] for poly in trimmed]
-            except:
-                print("clipping intersection error")
+            trimmed = self.toIntegerGroup()
+            trimmed.trim(trimPoly)
+            self.polygons = trimmed.toPolygonGroup().polygons
+            self.gridIndex = None
 
     #remove all points outside of trimPoly
     def clip(self, trim_poly):
         clipped_polys=[]
         if len(self.polygons) > 0 and len(trim_poly.polygons) > 0:
             clipped_poly=[]
+            inside = trim_poly.pointsInside([p for poly in self.polygons for p in poly])
+            i = 0
             for poly in self.polygons:
                 clipped_poly=[]
                 for p in poly:
-                    if trim_poly.pointInside(p):
+                    i += 1
+                    if inside[i-1]:
                         clipped_poly.append(p)
                     else: # if point outside, flush collected points and start new segment
                         if len(clipped_poly) > 0:
@@ -297,6 +416,7 @@ class PolygonGroup:
                 if len(clipped_poly)>0:
                     clipped_polys.append(clipped_poly)
         self.polygons=clipped_polys
+        self.gridIndex = None
 
     def clipToBoundingBox(self, minx, miny, maxx, maxy):
         clipped_polys=[]
@@ -307,6 +427,7 @@ class PolygonGroup:
                 if len(clipped_poly)>0:
                     clipped_polys.append(clipped_poly)
         self.polygons=clipped_polys
+        self.gridIndex = None
 
     def trimToBoundingBox(self, minx, miny, maxx, maxy):
         clipped_polys=[]
@@ -315,17 +436,12 @@ class PolygonGroup:
 
 
     def compare(self,  reference,  tolerance=0.01):
-        for poly in self.polygons:
-            for p in poly:
-                found = False
-                for r in reference.polygons:
-                    bdist,  bpoint,  bindex = closest_point_on_polygon(p,  r)
-                    if bdist<tolerance: # found a point that is within tolerance
-                        found=True
-                        break
-                if not found: # if we could not find a point within tolerance, abort
-                    return False 
-        return True
+        points = [p for poly in self.polygons for p in poly]
+        if len(points)==0:
+            return True
+        distances = SegmentIndex(reference.polygons).query(points)[0]
+        # all points need to be within tolerance of the reference
+        return bool((distances<tolerance).all())
 
     def pointDistance(self, p):
         dist = None
@@ -341,6 +457,10 @@ class PolygonGroup:
                 ci=pindex
         return dist, cp, subpoly, ci
 
+    # batch version of pointDistance. Returns arrays of distances, closest points, polygon indices and segment indices
+    def pointDistances(self,  points):
+        return SegmentIndex(self.polygons).query(points)
+
     def intersectWithLine(self, a, b):
         if len(self.polygons) > 0:
             points = []
@@ -367,14 +487,11 @@ class PolygonGroup:
         result = PolygonGroup(scaling = self.scaling,  precision = self.precision,  zlevel = self.zlevel)
         result.polygons=[]
         subpoly=[]
+        reference_index = SegmentIndex(reference.polygons)
         for poly in self.polygons:
-            for p in poly+[poly[0]]:
-                found = False
-                for r in reference.polygons:
-                    bdist,  bpoint,  bindex = closest_point_on_polygon(p,  r)
-                    if bdist<tolerance: # found a point that is within tolerance
-                        found=True
-                        break
+            distances = reference_index.query(poly+[poly[0]])[0]
+            for p,  bdist in zip(poly+[poly[0]],  distances):
+                found = bdist<tolerance # found a point that is within tolerance
                 if not found: # if we could not find a point within tolerance, abort
                    subpoly.append(p)
                 else:
@@ -385,6 +502,548 @@ class PolygonGroup:
         return result
 
 
+
+# converts a list of [x, y, (z)] points to a clipper path (int64 array of scaled x, y)
+def to_clipper_path(points,  scaling):
+    if isinstance(points,  np.ndarray) and points.dtype == np.int64:
+        return points
+    return (np.asarray(points,  dtype=float)[:, 0:2]*scaling).astype(np.int64)
+
+# converts a clipper path back to a list of [x, y, z] points
+def from_clipper_path(path,  scaling,  zlevel):
+    path = np.asarray(path)
+    output = np.empty((len(path),  3))
+    output[:, 0:2] = path/scaling
+    output[:, 2] = zlevel
+    return output.tolist()
+
+# Polygon group in clipper integer coordinates (int64 arrays of scaled x, y).
+# Offset, trim and convolute results stay in clipper space, so chained operations
+# only convert to floats once at the end (toPolygonGroup).
+class IntPolygonGroup:
+    def __init__(self,  polys = None,  precision = 0.005,  scaling = 1000.0,  zlevel = 0):
+        self.polygons = []
+        if polys is not None:
+            self.polygons = [np.asarray(p,  dtype=np.int64) for p in polys if len(p)>0]
+
+        self.scaling = scaling
+        self.precision = precision
+        self.zlevel = zlevel
+
+    @staticmethod
+    def fromPolygonGroup(group):
+        result = IntPolygonGroup(scaling = group.scaling,  precision = group.precision,  zlevel = group.zlevel)
+        result.polygons = [to_clipper_path(poly,  group.scaling) for poly in group.polygons if len(poly)>0]
+        return result
+
+    def toPolygonGroup(self):
+        result = PolygonGroup(scaling = self.scaling,  precision = self.precision,  zlevel = self.zlevel)
+        result.polygons = [from_clipper_path(poly,  self.scaling,  self.zlevel) for poly in self.polygons]
+        return result
+
+    def copy(self,  polys=None):
+        return IntPolygonGroup(polys,  scaling = self.scaling,  precision = self.precision,  zlevel = self.zlevel)
+
+    def quantizedKey(self):
+        return tuple(sorted(poly.tobytes() for poly in self.polygons))
+
+    def offset(self,  radius=0,  rounding = 0.0):
+        clip = pyclipper.PyclipperOffset()  #Pyclipper
+        polyclipper = pyclipper.Pyclipper()  #Pyclipper
+        for pat in self.polygons:
+            outPoly  = pyclipper.SimplifyPolygons([pat])
+            try:
+                polyclipper.AddPaths(outPoly, poly_type=pyclipper.PT_SUBJECT, closed=True)
+            except:
+                None
+                #print "path invalid",  outPoly
+        poly = polyclipper.Execute(pyclipper.CT_UNION, pyclipper.PFT_EVENODD, pyclipper.PFT_EVENODD)
+        clip.AddPaths(poly, pyclipper.JT_ROUND, pyclipper.ET_CLOSEDPOLYGON)
+
+        offset = clip.Execute( -int((radius+rounding)*self.scaling))
+        offset = pyclipper.SimplifyPolygons(offset)
+        if rounding>0.0:
+            roundclipper =  pyclipper.PyclipperOffset()
+            roundclipper.AddPaths(offset, pyclipper.JT_ROUND, pyclipper.ET_CLOSEDPOLYGON)
+
+            offset = roundclipper.Execute( int(rounding*self.scaling))
+        offset = pyclipper.CleanPolygons(offset,  distance=self.scaling*self.precision)
+        return self.copy(offset)
+
+    def convolute(self, pattern):
+        spattern = to_clipper_path(pattern,  self.scaling)
+        output =  pyclipper.MinkowskiSum2(spattern, self.polygons, True)
+        return self.copy(output)
+
+    def trim(self,  trimPoly):
+        if len(self.polygons)>0 and len(trimPoly.polygons)>0:
+            polytrim = pyclipper.Pyclipper()  #Pyclipper
+            polytrim.AddPaths([to_clipper_path(pat,  self.scaling) for pat in trimPoly.polygons],  poly_type=pyclipper.PT_CLIP, closed=True)
+            polytrim.AddPaths(self.polygons,  poly_type=pyclipper.PT_SUBJECT, closed=True)
+            try:
+                trimmed = polytrim.Execute(pyclipper.CT_INTERSECTION, pyclipper.PFT_EVENODD, pyclipper.PFT_EVENODD)
+                trimmed = pyclipper.SimplifyPolygons(trimmed)
+                self.polygons = [np.asarray(poly,  dtype=np.int64) for poly in trimmed if len(poly)>0]
+            except:
+                print("clipping intersection error")
+
+
+# Generates the complete stack of concentric offsets of a pocket boundary in one pass.
+# The boundary is unioned once and added to a single offset object, which is then executed
+# with growing deltas (radius, radius+stepover, ...) instead of re-offsetting each result.
+# Inward offsets are trimmed once against trimPoly up front; outward offsets grow beyond it
+# and are trimmed per level.
+class ConcentricOffset:
+    def __init__(self,  boundary,  radius,  stepover,  rounding = 0.0,  roundingStep = None,  trimPoly = None,  max_iterations = 0,  outwards = False):
+        self.boundary = boundary
+        self.radius = radius
+        self.stepover = stepover
+        self.rounding = rounding
+        self.roundingStep = roundingStep  # increase rounding per level up to 'rounding' (None: constant)
+        self.trimPoly = trimPoly
+        self.max_iterations = max_iterations
+        self.outwards = outwards
+        self.levels = []
+
+    def generate(self):
+        scaling = self.boundary.scaling
+        polyclipper = pyclipper.Pyclipper()
+        for pat in self.boundary.polygons:
+            try:
+                polyclipper.AddPaths(pyclipper.SimplifyPolygons([pat]), poly_type=pyclipper.PT_SUBJECT, closed=True)
+            except:
+                None
+        region = polyclipper.Execute(pyclipper.CT_UNION, pyclipper.PFT_EVENODD, pyclipper.PFT_EVENODD)
+
+        trim = None
+        if self.trimPoly is not None and len(self.trimPoly.polygons)>0:
+            trim = [to_clipper_path(pat,  scaling) for pat in self.trimPoly.polygons]
+        trimclipper = pyclipper.Pyclipper()
+        if trim is not None and not self.outwards:
+            # inward offsets of the trimmed region stay inside the trim polygon
+            region = self.trimPaths(trimclipper,  region,  trim)
+            trim = None
+
+        sign = -1
+        if self.outwards:
+            sign = 1
+        # large deltas produce large arcs - approximate them to the path precision instead of clipper's default
+        offsetter = pyclipper.PyclipperOffset()
+        offsetter.ArcTolerance = scaling*self.boundary.precision
+        offsetter.AddPaths(region, pyclipper.JT_ROUND, pyclipper.ET_CLOSEDPOLYGON)
+        roundclipper = pyclipper.PyclipperOffset()
+        roundclipper.ArcTolerance = scaling*self.boundary.precision
+
+        self.levels = []
+        delta = self.radius
+        rounding = 0.0
+        while self.max_iterations<=0 or len(self.levels)<self.max_iterations:
+            if self.roundingStep is None:
+                rounding = self.rounding
+            else:
+                rounding = min(rounding + self.roundingStep,  self.rounding)
+            offset = offsetter.Execute(sign*int((delta+rounding)*scaling))
+            offset = pyclipper.SimplifyPolygons(offset)
+            if rounding>0.0:
+                roundclipper.Clear()
+                roundclipper.AddPaths(offset, pyclipper.JT_ROUND, pyclipper.ET_CLOSEDPOLYGON)
+                offset = roundclipper.Execute(-sign*int(rounding*scaling))
+            offset = pyclipper.CleanPolygons(offset,  distance=scaling*self.boundary.precision)
+            if trim is not None:
+                offset = self.trimPaths(trimclipper,  offset,  trim)
+            level = self.boundary.copy(offset)
+            if len(level.polygons)==0:
+                break
+            self.levels.append(level)
+            delta += self.stepover
+        return self.levels
+
+    def trimPaths(self,  trimclipper,  paths,  trim):
+        trimclipper.Clear()
+        trimclipper.AddPaths(trim,  poly_type=pyclipper.PT_CLIP, closed=True)
+        try:
+            trimclipper.AddPaths(paths,  poly_type=pyclipper.PT_SUBJECT, closed=True)
+            paths = trimclipper.Execute(pyclipper.CT_INTERSECTION, pyclipper.PFT_EVENODD, pyclipper.PFT_EVENODD)
+            paths = pyclipper.SimplifyPolygons(paths)
+        except:
+            print("clipping intersection error")
+        return paths
+
+
+# Clearing paths with bounded tool engagement (adaptive clearing) for one pocket level.
+# Works on tool centre regions: R is the pocket region shrunk by the tool radius, T the region the
+# tool centre has already covered (the cleared material is T grown by the radius).
+# Clearing starts with a loop of diameter ae in each of the innermost cores of R (contours of the inward
+# offset stack of R without deeper contours inside), so the first pass doesn't slot along a whole core
+# contour, and grows T by the radial depth of cut ae = r*(1-cos(engagement)) per pass:
+#   F = open((T + ae) & R, r) | T
+# The opening rounds convex corners of the front, where the tool would otherwise run into an inside
+# corner of the material with a much larger engagement. Only the loops of F that moved are emitted.
+# When the front stops growing, the exact contour of R is cut as a last pass to clear the corners.
+class AdaptiveClearing:
+    def __init__(self,  boundary,  radius,  engagement = 90.0,  trimPoly = None,  max_iterations = 0):
+        self.boundary = boundary
+        self.radius = radius
+        self.stepover = radius*(1.0-cos(engagement*PI/180.0))
+        self.trimPoly = trimPoly
+        self.max_iterations = max_iterations
+        self.passes = []
+
+    def generate(self):
+        scaling = self.boundary.scaling
+        self.arcTolerance = scaling*self.boundary.precision
+        region = clipper_boolean(self.boundary.polygons,  [],  pyclipper.CT_UNION)
+        if self.trimPoly is not None and len(self.trimPoly.polygons)>0:
+            region = clipper_boolean(region,  [to_clipper_path(pat,  scaling) for pat in self.trimPoly.polygons],  pyclipper.CT_INTERSECTION)
+        reachable = self.offset(region,  -self.radius)
+        self.passes = []
+        if len(reachable)==0 or self.stepover<=0:
+            return self.passes
+
+        cleared = self.seeds(reachable)
+        self.passes.append(self.boundary.copy([np.vstack((c,  c[:1])) for c in cleared if len(c)>0]))
+        ae = int(self.stepover*scaling)
+        while self.max_iterations<=0 or len(self.passes)<self.max_iterations:
+            front = clipper_boolean(self.offset(cleared,  self.stepover),  reachable,  pyclipper.CT_INTERSECTION)
+            front = clipper_boolean(front,  cleared,  pyclipper.CT_UNION)
+            # only the parts of the front that advanced by more than a quarter of the stepover are new cuts
+            done = PolygonGroup(polys=self.offset(cleared,  self.stepover/4.0))
+            moved = []
+            for loop in front:
+                loop = np.asarray(loop,  dtype=np.int64)
+                moved += moved_runs(loop,  ~done.pointsInside(loop))
+            if len(moved)==0:
+                break
+            self.passes.append(self.boundary.copy(moved))
+            cleared = front
+        self.passes.append(self.boundary.copy([np.vstack((c,  c[:1])) for c in reachable if len(c)>0]))
+        return self.passes
+
+    def offset(self,  paths,  delta):
+        if len(paths)==0:
+            return []
+        offsetter = pyclipper.PyclipperOffset()
+        offsetter.ArcTolerance = self.arcTolerance
+        offsetter.AddPaths(paths,  pyclipper.JT_ROUND,  pyclipper.ET_CLOSEDPOLYGON)
+        return pyclipper.CleanPolygons(offsetter.Execute(int(delta*self.boundary.scaling)),  distance=self.arcTolerance)
+
+    # loops of diameter ae around a point on the outline of each core, trimmed to the reachable region
+    def seeds(self,  reachable):
+        offsetter = pyclipper.PyclipperOffset()
+        offsetter.ArcTolerance = self.arcTolerance
+        for contour in self.cores(reachable):
+            if pyclipper.Orientation(contour):
+                offsetter.AddPath(contour[:1],  pyclipper.JT_ROUND,  pyclipper.ET_OPENROUND)
+        return clipper_boolean(offsetter.Execute(int(self.stepover/2.0*self.boundary.scaling)),  reachable,  pyclipper.CT_INTERSECTION)
+
+    # innermost regions of the inward offset stack of the reachable region, one per local maximum
+    # of the distance to the boundary. Returns the contours of all cores (outlines and holes).
+    def cores(self,  reachable):
+        # the polytree nodes are owned by the offsetter, copy the contours out before the next Execute2
+        def outlines(delta):
+            return [(node.Contour,  [hole.Contour for hole in node.Childs]) for node in polytree_outlines(level.Execute2(delta))]
+        cores = []
+        level = pyclipper.PyclipperOffset()
+        level.ArcTolerance = self.arcTolerance
+        level.AddPaths(reachable,  pyclipper.JT_ROUND,  pyclipper.ET_CLOSEDPOLYGON)
+        current = outlines(0)
+        depth = 0.0
+        while len(current)>0:
+            depth += self.stepover
+            deeper = outlines(-int(depth*self.boundary.scaling))
+            deeper_points = [tuple(outline[0]) for outline, holes in deeper]
+            for outline, holes in current:
+                inside = [p for p in deeper_points if pyclipper.PointInPolygon(p,  outline)!=0 and
+                          len([hole for hole in holes if pyclipper.PointInPolygon(p,  hole)==1])==0]
+                if len(inside)==0:
+                    cores += [outline] + holes
+            current = deeper
+        return cores
+
+# split an open path into the runs of points where mask is set, extended by one point at both ends
+def masked_runs(path,  mask):
+    edges = np.diff(np.concatenate(([0],  mask.astype(np.int8),  [0])))
+    starts = np.flatnonzero(edges==1)
+    ends = np.flatnonzero(edges==-1)
+    return [path[max(s-1,  0):e+1] for s, e in zip(starts,  ends)]
+
+# split a closed loop into the open runs of points where mask is set, extended by one point at both ends.
+# A loop that is masked everywhere is returned closed (first point repeated at the end).
+def moved_runs(loop,  mask):
+    if not mask.any():
+        return []
+    if mask.all():
+        return [np.vstack((loop,  loop[:1]))]
+    # rotate the loop to start on an unmasked point, so no run wraps around the end
+    start = argmin(mask)
+    loop = np.roll(loop,  -start,  axis=0)
+    mask = np.roll(mask,  -start)
+    return masked_runs(np.vstack((loop,  loop[:1])),  np.append(mask,  False))
+
+# all outline (non-hole) nodes of a clipper polytree, including islands inside holes
+def polytree_outlines(node):
+    outlines = []
+    for child in node.Childs:
+        outlines.append(child)
+        for hole in child.Childs:
+            outlines += polytree_outlines(hole)
+    return outlines
+
+# union / intersection / difference of two lists of clipper paths
+def clipper_boolean(subject,  clip,  clip_type):
+    clipper = pyclipper.Pyclipper()
+    # AddPaths skips degenerate paths, but raises if none of them is usable
+    try:
+        clipper.AddPaths(subject,  pyclipper.PT_SUBJECT,  True)
+    except pyclipper.ClipperException:
+        return []
+    try:
+        clipper.AddPaths(clip,  pyclipper.PT_CLIP,  True)
+    except pyclipper.ClipperException:
+        pass
+    return clipper.Execute(clip_type,  pyclipper.PFT_EVENODD,  pyclipper.PFT_EVENODD)
+
+# Material removed by the tool on one slice level: the union of the bands swept by the cutter along
+# the paths cut so far, in clipper integer coordinates. Used to check that a link between two paths
+# at slice level only moves through material that is already gone.
+class ClearedArea:
+    def __init__(self,  radius,  level,  scaling = 1000.0,  precision = 0.005):
+        self.radius = radius
+        self.level = level
+        self.scaling = scaling
+        self.precision = precision
+        self.cleared = []
+        self.pending = []
+
+    def sweep(self,  points):
+        offsetter = pyclipper.PyclipperOffset()
+        offsetter.ArcTolerance = self.scaling*self.precision
+        offsetter.AddPath(to_clipper_path(points,  self.scaling),  pyclipper.JT_ROUND,  pyclipper.ET_OPENROUND)
+        return offsetter.Execute(int(self.radius*self.scaling))
+
+    def add(self,  points):
+        self.pending += self.sweep(points)
+
+    # bands overlap each other, so the union has to use non-zero filling
+    def union(self,  paths):
+        if len(paths)==0:
+            return []
+        clipper = pyclipper.Pyclipper()
+        clipper.AddPaths(paths,  pyclipper.PT_SUBJECT,  True)
+        return clipper.Execute(pyclipper.CT_UNION,  pyclipper.PFT_NONZERO,  pyclipper.PFT_NONZERO)
+
+    # True if the cutter moving straight from a to b stays in the cleared area, apart from the
+    # tool position at b (where the next path plunges in anyway). Slivers from the arc
+    # approximation of the bands are tolerated.
+    def containsLink(self,  a,  b):
+        if len(self.pending)>0:
+            self.cleared = self.union(self.cleared + self.pending)
+            self.pending = []
+        link = self.sweep([a,  b])
+        clipper = pyclipper.Pyclipper()
+        clipper.AddPaths(link,  pyclipper.PT_SUBJECT,  True)
+        clipper.AddPaths(self.sweep([b]),  pyclipper.PT_CLIP,  True)
+        if len(self.cleared)>0:
+            clipper.AddPaths(self.cleared,  pyclipper.PT_CLIP,  True)
+        uncut = clipper.Execute(pyclipper.CT_DIFFERENCE,  pyclipper.PFT_NONZERO,  pyclipper.PFT_NONZERO)
+        uncut_area = abs(sum([pyclipper.Area(p) for p in uncut]))/self.scaling**2
+        return uncut_area <= 4.0*self.precision*(dist2D(a,  b)+2.0*self.radius)
+
+# nesting test used by polygon_tree: both paths on the same slice level and nested
+def same_level_nested(path1, path2):
+    return path1[0][2] == path2[0][2] and polygons_nested(path1, path2)
+
+# precomputed same_level_nested relation for all pairs of a list of paths.
+# Only points inside the bounding box of a polygon are tested against its edges (all at once);
+# points outside the bounding box are outside.
+class NestingTable:
+    def __init__(self, paths):
+        self.index = dict((id(p), i) for i, p in enumerate(paths))
+        self.level = [p[0][2] for p in paths]
+        self.position = [0]*len(paths)
+        self.relation = dict()
+        levels = dict()
+        for i, p in enumerate(paths):
+            levels.setdefault(p[0][2], []).append(i)
+        for z, members in levels.items():
+            for k, i in enumerate(members):
+                self.position[i] = k
+            chirality = np.array([polygon_chirality(paths[i]) for i in members])
+            firsts = np.array([paths[i][0][0:2] for i in members], dtype=float)
+            raw_inside = np.zeros((len(members), len(members)), dtype=bool)
+            for j, pj in enumerate(members):
+                points = np.asarray([p[0:2] for p in paths[pj]], dtype=float)
+                ends = np.roll(points, -1, axis=0)
+                candidates = np.flatnonzero((firsts[:, 0] >= points[:, 0].min()) & (firsts[:, 0] <= points[:, 0].max()) &
+                                            (firsts[:, 1] > points[:, 1].min()) & (firsts[:, 1] <= points[:, 1].max()))
+                candidates = candidates[candidates != j]
+                if len(candidates) > 0:
+                    raw_inside[candidates, j] = crossings_odd(firsts[candidates, 0], firsts[candidates, 1],
+                                                              points[:, 0], points[:, 1], ends[:, 0], ends[:, 1])
+            # point_inside_polygon is inverted for polygons with positive chirality
+            inside = np.where(chirality[np.newaxis, :] < 0, raw_inside, ~raw_inside)
+            self.relation[z] = (chirality[:, np.newaxis]*chirality[np.newaxis, :] >= 0) & (inside | inside.T)
+
+    def nested(self, path1, path2):
+        i = self.index[id(path1)]
+        j = self.index[id(path2)]
+        if self.level[i] != self.level[j]:
+            return False
+        return bool(self.relation[self.level[i]][self.position[i], self.position[j]])
+
+# Orders paths to minimise rapid moves between them. Closed paths can be entered at any vertex
+# (entry = exit), open paths at either end. predecessors[i] lists the paths that have to be cut before path i.
+# Starts with a greedy nearest neighbour tour over a kd-tree of entry points, then improves it with
+# 2-opt (segment reversal) and Or-opt (moving single paths) moves that keep the precedence constraints.
+# Returns a list of (path index, entry vertex index, reversed).
+def order_paths(paths, closed, predecessors, start=None, max_passes=5):
+    n = len(paths)
+    if n == 0:
+        return []
+    points = [np.asarray([p[0:3] for p in path], dtype=float) for path in paths]
+    successors = [[] for i in range(n)]
+    waiting = [0]*n
+    for i in range(n):
+        for p in set(predecessors[i]):
+            successors[p].append(i)
+            waiting[i] += 1
+
+    owners = []
+    vertices = []
+    entry_points = []
+    for i in range(n):
+        candidates = np.arange(len(points[i])) if closed[i] else np.unique([0, len(points[i])-1])
+        owners.append(np.full(len(candidates), i))
+        vertices.append(candidates)
+        entry_points.append(points[i][candidates])
+    owners = np.concatenate(owners)
+    vertices = np.concatenate(vertices)
+    entry_points = np.concatenate(entry_points)
+
+    # greedy nearest neighbour, restricted to paths whose predecessors are done
+    done = np.zeros(n, dtype=bool)
+    indexed = np.arange(len(owners))
+    tree = cKDTree(entry_points)
+    position = np.asarray(start[0:3], dtype=float) if start is not None else None
+    sequence = []
+    while len(sequence) < n:
+        chosen = None
+        if position is None:
+            chosen = (min(i for i in range(n) if waiting[i] == 0), 0)
+        k = 16
+        while chosen is None:
+            k = min(k, len(indexed))
+            d, found = tree.query(position, k=k)
+            for f in np.atleast_1d(found):
+                owner = owners[indexed[f]]
+                if not done[owner] and waiting[owner] == 0:
+                    chosen = (owner, vertices[indexed[f]])
+                    break
+            if k == len(indexed):
+                break
+            k *= 4
+        owner, vertex = chosen
+        reverse = not closed[owner] and vertex != 0
+        sequence.append([owner, vertex, reverse])
+        done[owner] = True
+        for s in successors[owner]:
+            waiting[s] -= 1
+        position = points[owner][vertex] if closed[owner] else points[owner][0 if reverse else -1]
+        # drop finished paths from the kd-tree once they make up half of it
+        if len(sequence) < n and 2*done[owners[indexed]].sum() > len(indexed):
+            indexed = indexed[~done[owners[indexed]]]
+            tree = cKDTree(entry_points[indexed])
+
+    for iteration in range(max_passes):
+        improved = False
+        for i in range(n):
+            improved = path_sequence_2opt(sequence, i, points, closed, successors, start) or improved
+        for i in range(n):
+            improved = path_sequence_oropt(sequence, i, points, closed, predecessors, successors, start) or improved
+        if not improved:
+            break
+
+    return [tuple(s) for s in sequence]
+
+def path_sequence_ends(sequence, points, closed):
+    entries = np.array([points[o][v] if closed[o] else points[o][-1 if r else 0] for o, v, r in sequence])
+    exits = np.array([points[o][v] if closed[o] else points[o][0 if r else -1] for o, v, r in sequence])
+    return entries, exits
+
+# tries to improve the sequence by reversing a part of it that starts at position i
+def path_sequence_2opt(sequence, i, points, closed, successors, start):
+    n = len(sequence)
+    if i >= n-1:
+        return False
+    position = dict((s[0], k) for k, s in enumerate(sequence))
+    # positions following i can be included in the reversed part until a successor of an included path is reached
+    first_successor = np.array([min([position[s] for s in successors[o]] + [n]) for o, v, r in sequence[i:]])
+    limit = np.minimum.accumulate(first_successor)
+    j = np.arange(i, n)
+    valid = (j < limit) & (j > i)
+    if not valid.any():
+        return False
+    entries, exits = path_sequence_ends(sequence, points, closed)
+    before = exits[i-1] if i > 0 else (np.asarray(start[0:3], dtype=float) if start is not None else None)
+    after_entries = np.vstack([entries[i+1:], np.full((1, 3), np.nan)])
+    gain = np.zeros(len(j))
+    if before is not None:
+        gain += norm_rows(entries[i]-before) - norm_rows(exits[j]-before)
+    gain += np.nan_to_num(norm_rows(after_entries[j-i]-exits[j]) - norm_rows(after_entries[j-i]-entries[i]))
+    gain[~valid] = 0
+    best = np.argmax(gain)
+    if gain[best] <= 1e-9:
+        return False
+    k = j[best]
+    reversed_part = [[o, v, (not r) if not closed[o] else r] for o, v, r in reversed(sequence[i:k+1])]
+    sequence[i:k+1] = reversed_part
+    return True
+
+# tries to improve the sequence by moving the path at position i to a different position
+def path_sequence_oropt(sequence, i, points, closed, predecessors, successors, start):
+    n = len(sequence)
+    if n < 3:
+        return False
+    entries, exits = path_sequence_ends(sequence, points, closed)
+    # missing neighbours (before the start, after the end) are NaN and contribute no length
+    begin = np.asarray(start[0:3], dtype=float) if start is not None else np.full(3, np.nan)
+    exits = np.vstack([[begin], exits])
+    entries = np.vstack([entries, np.full((1, 3), np.nan)])
+    def link(a, b):
+        return np.nan_to_num(norm_rows(b-a))
+    removal_gain = link(exits[i], entries[i]) + link(exits[i+1], entries[i+1]) - link(exits[i], entries[i+1])
+
+    owner = sequence[i][0]
+    rest = sequence[:i] + sequence[i+1:]
+    position = dict((s[0], k) for k, s in enumerate(rest))
+    # insert before the path at slot, somewhere between the last predecessor and the first successor
+    lowest = max([position[p]+1 for p in predecessors[owner]] + [0])
+    highest = min([position[s] for s in successors[owner]] + [len(rest)])
+    slots = np.arange(lowest, highest+1)
+    rest_exits = np.delete(exits, i+1, axis=0)
+    rest_entries = np.delete(entries, i, axis=0)
+    best_gain = 1e-9
+    best = None
+    orientations = [sequence[i]] if closed[owner] else [[owner, sequence[i][1], False], [owner, sequence[i][1], True]]
+    for orientation in orientations:
+        entry, exit = [e[0] for e in path_sequence_ends([orientation], points, closed)]
+        a = rest_exits[slots]
+        b = rest_entries[slots]
+        gain = removal_gain - (link(a, entry) + link(exit, b) - link(a, b))
+        k = np.argmax(gain)
+        if gain[k] > best_gain:
+            best_gain = gain[k]
+            best = (slots[k], orientation)
+    if best is None:
+        return False
+    slot, orientation = best
+    rest.insert(slot, list(orientation))
+    sequence[:] = rest
+    return True
+
+def norm_rows(v):
+    return np.sqrt((v*v).sum(axis=-1))
+
 class polygon_tree:
     def __init__(self, path=None):
         self.path = path
@@ -393,31 +1052,30 @@ class polygon_tree:
         self.topDownOrder = 0
         self.bottomUpOrder = 0
 
-    def insert(self, new_path):
+    def insert(self, new_path, nested=None):
         if len(new_path) == 0:  # empty poly - ignore
             return
+        if nested is None:
+            nested = same_level_nested
         if self.parent is None:
-            print("adding path", polygon_chirality(new_path))
             if len(self.children) < 2:
                 self.children = [polygon_tree(), polygon_tree()]
                 self.children[0].parent = self
                 self.children[1].parent = self
-            print("top level:", len(self.children))
             if polygon_chirality(new_path) < 0:
-                self.children[0].insert(new_path)
+                self.children[0].insert(new_path, nested)
             else:
-                self.children[1].insert(new_path)
+                self.children[1].insert(new_path, nested)
             return
         if self.path is None:
             self.path = new_path
             return
 
-        if (new_path[0][2] == self.path[0][2] and polygons_nested(new_path, self.path)):
-            print("fits into me")
+        if nested(new_path, self.path):
             # check which sub-branch to go down
             for child in self.children:
-                if new_path[0][2] == child.path[0][2] and polygons_nested(new_path, child.path):
-                    child.insert(new_path)
+                if nested(new_path, child.path):
+                    child.insert(new_path, nested)
                     return
 
             # path fits into this node, but none of its children - add to list of children
@@ -426,8 +1084,7 @@ class polygon_tree:
 
             node = polygon_tree(new_path)
             for child in self.children:
-                if new_path[0][2] == child.path[0][2] and polygons_nested(child.path, new_path):
-                    print("push down to child")
+                if nested(child.path, new_path):
                     # shift child into subtree of node
                     self.children.remove(child)
                     node.children.append(child)
@@ -441,8 +1098,7 @@ class polygon_tree:
             node.parent = self
 
         else:
-            if (new_path[0][2] == self.path[0][2] and polygons_nested(self.path, new_path)):
-                print("I fit into it")
+            if nested(self.path, new_path):
                 # if path doesn't fit into this node, shift this node into new subtree
                 tmp = polygon_tree(self.path)
                 tmp.parent = self
@@ -450,18 +1106,23 @@ class polygon_tree:
                 self.children = [tmp]
                 self.path = new_path
             else:
-                print("path doesn't fit anywhere!")
                 inserted = False
                 if self.parent is not None:
                     for child in self.parent.children:
-                        if child is not None and child.path is not None and new_path[0][2] == child.path[0][2] and polygons_nested(child.path, new_path):
-                            print("push down to child")
+                        if child is not None and child.path is not None and nested(child.path, new_path):
                             inserted = True
-                            child.insert(new_path)
+                            child.insert(new_path, nested)
                 if not inserted:
-                    print("create new parallel path")
                     self.parent.children.append(polygon_tree(new_path))
 
+    # inserts all paths in the given order (same tree as calling insert for each path), with the
+    # nesting relation of all path pairs precomputed in bulk
+    def insertAll(self, paths):
+        paths = [p for p in paths if len(p) > 0]
+        table = NestingTable(paths)
+        for p in paths:
+            self.insert(p, table.nested)
+
     def pathLength(self):
         lastp = array(self.path[0])
         length = 0
@@ -525,6 +1186,51 @@ class polygon_tree:
 
         return result
 
+    # like toGPoints, but reorders the paths of each slice level to minimise rapids, keeping the
+    # constraint that children are cut before their parents (or parents first if outside_in is set).
+    # Paths of different levels stay in the order of toGPoints (reversed for outside_in).
+    def toGPointsOrdered(self, outside_in=False, start=None):
+        self.calcOrder()
+        nodes = self.postOrder()
+        if outside_in:
+            nodes.reverse()
+
+        result = []
+        block_start = 0
+        while block_start < len(nodes):
+            block_end = block_start
+            while block_end < len(nodes) and nodes[block_end].path[0][2] == nodes[block_start].path[0][2]:
+                block_end += 1
+            block = nodes[block_start:block_end]
+            index = dict((id(node), i) for i, node in enumerate(block))
+            predecessors = []
+            for node in block:
+                if outside_in:
+                    predecessors.append([index[id(node.parent)]] if id(node.parent) in index else [])
+                else:
+                    predecessors.append([index[id(c)] for c in node.children if id(c) in index])
+            if len(result) > 0:
+                start = result[-1][-1].position
+            sequence = order_paths([node.path for node in block], [True]*len(block), predecessors, start=start)
+            for i, vertex, reverse in sequence:
+                node = block[i]
+                opt_path = node.path[vertex:] + node.path[:vertex]
+                out_poly = [GPoint(position=(p[0], p[1], p[2]), order=node.bottomUpOrder, dist_from_model=node.topDownOrder) for p in opt_path]
+                # explicitly close path
+                out_poly.append(out_poly[0])
+                result.append(out_poly)
+            block_start = block_end
+        return result
+
+    # all nodes with a path, children before parents (same order as toGPoints)
+    def postOrder(self):
+        result = []
+        for child in self.children:
+            result += child.postOrder()
+        if self.path is not None:
+            result.append(self)
+        return result
+
     def toGPointsOutIn(self):
         self.calcOrder()
         result = []
@@ -3,7 +3,8 @@ from numpy import  *
 import math
 from gcode import *
 import time
-#import pyclipper
+import pyclipper
+from polygons import PolygonGroup,  IntPolygonGroup
 
 import multiprocessing as mp
 #import subprocess
@@ -16,6 +17,8 @@ def RandomPoly(maxWidth, maxHeight, vertCnt):
     return result
     
 class facet:
+    __slots__ = ("normal", "vertices", "maxHeight")
+
     def __init__(self, normal):
         self.normal=normal;
         self.vertices=[]
@@ -53,6 +56,8 @@ class Solid:
         self.map=[]
         self.update_visual=False
         self.refmap=None
+        self.clearance_map=None
+        self.silhouette=None
         self.material=None
         self.facets=None
         self.minv=[0, 0, 0]
@@ -73,6 +78,8 @@ class Solid:
         self.get_bounding_box()
         #force recomputation of refmap as mesh has changed
         self.refmap=None
+        self.clearance_map=None
+        self.silhouette=None
 
     def rotate_x(self):
         for f in self.facets:
@@ -84,6 +91,8 @@ class Solid:
         self.get_bounding_box()
         #force recomputation of refmap as mesh has changed
         self.refmap=None
+        self.clearance_map=None
+        self.silhouette=None
 
     def rotate_y(self):
         for f in self.facets:
@@ -95,6 +104,8 @@ class Solid:
         self.get_bounding_box()
         #force recomputation of refmap as mesh has changed
         self.refmap=None
+        self.clearance_map=None
+        self.silhouette=None
 
 
     def rotate_z(self):
@@ -107,6 +118,8 @@ class Solid:
         self.get_bounding_box()
         #force recomputation of refmap as mesh has changed
         self.refmap=None
+        self.clearance_map=None
+        self.silhouette=None
     
     def get_bounding_box(self):
         if self.facets==None:
@@ -154,6 +167,11 @@ def run_pool_init(function, *parameters):
     run_pool.function=function
     run_pool.parameters=parameters
 
+def union_paths(paths):
+    clipper = pyclipper.Pyclipper()
+    clipper.AddPaths(paths, pyclipper.PT_SUBJECT, True)
+    return clipper.Execute(pyclipper.CT_UNION, pyclipper.PFT_NONZERO, pyclipper.PFT_NONZERO)
+
 class CAM_Solid(Solid):
     
     def calc_ref_map(self,  refgrid, radius=0):
@@ -186,6 +204,74 @@ class CAM_Solid(Solid):
         self.refmap_indexed=refmap_indexed
 
 
+    # Height map for retract moves: every cell holds the highest facet point within radius of the cell
+    # (plus one cell as margin), which is an upper bound of the cutter location height of a tool
+    # with that radius anywhere in the cell.
+    def calc_clearance_map(self, radius, grid=1.0):
+        if self.clearance_map is not None and self.clearance_map[0] == radius and self.clearance_map[1] == grid:
+            return
+        margin = radius+grid
+        origin = [self.minv[0]-margin, self.minv[1]-margin]
+        nx = int((self.maxv[0]-origin[0]+margin)/grid)+1
+        ny = int((self.maxv[1]-origin[1]+margin)/grid)+1
+        heights = full((nx, ny), -inf)
+        for f in self.facets:
+            v = array(f.vertices)
+            x0 = int((v[:, 0].min()-origin[0]-margin)/grid)
+            x1 = int((v[:, 0].max()-origin[0]+margin)/grid)+1
+            y0 = int((v[:, 1].min()-origin[1]-margin)/grid)
+            y1 = int((v[:, 1].max()-origin[1]+margin)/grid)+1
+            heights[x0:x1, y0:y1] = maximum(heights[x0:x1, y0:y1], v[:, 2].max())
+        self.clearance_map = (radius, grid, origin, heights)
+
+    # highest cutter location along the moves between the waypoints, for a tool of the given radius
+    # leaving offset (stock to leave) on the model. None if the moves don't pass over the model.
+    def get_retract_height(self, waypoints, radius, offset=0.0):
+        self.calc_clearance_map(radius+offset)
+        height = None
+        for a, b in zip(waypoints[:-1], waypoints[1:]):
+            model_height = self.get_clearance_height(a, b)
+            if model_height is not None and (height is None or model_height > height):
+                height = model_height
+        if height is None:
+            return None
+        return height+offset
+
+    # highest cutter location along the straight move from a to b (None if the move doesn't pass the model)
+    def get_clearance_height(self, a, b):
+        radius, grid, origin, heights = self.clearance_map
+        length = sqrt((b[0]-a[0])**2+(b[1]-a[1])**2)
+        t = linspace(0.0, 1.0, int(2.0*length/grid)+2)
+        ix = floor((a[0]+t*(b[0]-a[0])-origin[0])/grid).astype(int)
+        iy = floor((a[1]+t*(b[1]-a[1])-origin[1])/grid).astype(int)
+        inside = (ix >= 0) & (ix < heights.shape[0]) & (iy >= 0) & (iy < heights.shape[1])
+        if not inside.any():
+            return None
+        height = heights[ix[inside], iy[inside]].max()
+        if height == -inf:
+            return None
+        return height
+
+    # XY silhouette of the model: union of all projected non-vertical facets. The triangles are
+    # unioned in chunks and the partial unions merged pairwise, which keeps each clipper call small.
+    def calc_silhouette(self, zlevel=0.0, chunk_size=2000, precision=0.005):
+        if self.silhouette is None:
+            scaling = 1000.0
+            triangles = array([[v[0:2] for v in f.vertices[0:3]] for f in self.facets])
+            # orient all triangles counter-clockwise and drop vertical (zero area) facets
+            edge1 = triangles[:, 1]-triangles[:, 0]
+            edge2 = triangles[:, 2]-triangles[:, 0]
+            area = edge1[:, 0]*edge2[:, 1]-edge1[:, 1]*edge2[:, 0]
+            triangles[area < 0] = triangles[area < 0][:, ::-1]
+            triangles = rint(triangles[abs(area) > 1e-9]*scaling).astype(int64)
+            parts = [union_paths(list(triangles[i:i+chunk_size])) for i in range(0, len(triangles), chunk_size)]
+            while len(parts) > 1:
+                parts = [union_paths(parts[i]+parts[i+1]) if i+1 < len(parts) else parts[i] for i in range(0, len(parts), 2)]
+            self.silhouette = IntPolygonGroup(parts[0] if len(parts) > 0 else [], scaling=scaling)
+        scaling = self.silhouette.scaling
+        outline = pyclipper.CleanPolygons([poly.tolist() for poly in self.silhouette.polygons], distance=precision*scaling)
+        return IntPolygonGroup(outline, precision=precision, scaling=scaling, zlevel=zlevel).toPolygonGroup()
+
 # determines state of facet (belongs to surface=1, does not belong=-1, undecided (vertical face) =0
     def projectFacetToSurface(self,  f, inverted):
         is_surface=-1
@@ -293,6 +379,8 @@ class CAM_Solid(Solid):
         self.get_bounding_box()
         #force recomputation of refmap as mesh has changed
         self.refmap=None
+        self.clearance_map=None
+        self.silhouette=None
                                         
 
     def calc_height_map_pixel(self,  index,   inverted):
@@ -420,6 +508,8 @@ class CAM_Solid(Solid):
         self.update_visual=True
         #force recomputation of refmap as mesh has changed
         self.refmap=None
+        self.clearance_map=None
+        self.silhouette=None
 
 
     def smooth_height_map(self):
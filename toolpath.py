@@ -0,0 +1,566 @@
+from numpy import *
+from gcode import *
+
+# point flags
+RAPID = 1
+IN_CONTACT = 2
+INSIDE_MODEL = 4
+INTERPOLATED = 8
+CONTROL_POINT = 16
+ARC = 32
+COMMAND = 64 # row without position, the command object is kept in Toolpath.commands
+
+
+# Columnar storage of a toolpath: one NumPy array per point attribute instead of one object per point.
+# Arcs are kept in side arrays (point index, ij, direction), rows without a position (plain commands,
+# feedrate control points) keep their object in a sparse dict. Iterating or indexing returns
+# lightweight GPoint/GArc views onto the rows, so code written for lists of GPoints keeps working.
+class Toolpath:
+    def __init__(self, capacity=16, axis_mapping=None, axis_scaling=None, rot_axis_mapping=None):
+        self.size = 0
+        self._position = empty((capacity, 3))
+        self._feedrate = full(capacity, nan)
+        self._flags = zeros(capacity, dtype=uint8)
+        self._order = zeros(capacity, dtype=int32)
+        self._dist_from_model = full(capacity, nan)
+        self._line_number = zeros(capacity, dtype=int32)
+        self.arc_index = zeros(0, dtype=int64)
+        self.arc_ij = zeros((0, 2))
+        self.arc_dir = zeros(0, dtype='<U2')
+        self.commands = dict()
+        self.rotations = dict()
+        # start offsets of the segments (passes) of the path
+        self.segments = []
+        # shared by all points of the path
+        self.axis_mapping = axis_mapping if axis_mapping is not None else ["X", "Y", "Z"]
+        self.axis_scaling = axis_scaling if axis_scaling is not None else [1.0, 1.0, 1, 0]
+        self.rot_axis_mapping = rot_axis_mapping if rot_axis_mapping is not None else ["A", "B", "C"]
+
+    @staticmethod
+    def fromPoints(points):
+        if isinstance(points, Toolpath):
+            return points[:]
+        path = Toolpath(capacity=max(16, len(points)))
+        for p in points[0:1]:
+            if isinstance(p, GCommand):
+                path.axis_mapping, path.axis_scaling, path.rot_axis_mapping = p.axis_mapping, p.axis_scaling, p.rot_axis_mapping
+        path.extend(points)
+        return path
+
+    # bulk construction from a (n,3) array of positions with the same attributes for all points
+    @staticmethod
+    def fromArrays(position, feedrate=None, rapid=False, in_contact=True, inside_model=True, order=0, dist_from_model=None):
+        path = Toolpath(capacity=max(16, len(position)))
+        path.appendArrays(position, feedrate=feedrate, rapid=rapid, in_contact=in_contact, inside_model=inside_model,
+                          order=order, dist_from_model=dist_from_model)
+        return path
+
+    # construction from complete columns, as collected by the G-code parser
+    @staticmethod
+    def fromColumns(position, feedrate, flags, line_number, arc_index=None, arc_ij=None, arc_dir=None, commands=None, rotations=None):
+        path = Toolpath(capacity=max(16, len(flags)))
+        path.size = len(flags)
+        if path.size > 0:
+            path._position[:path.size] = position
+            path._feedrate[:path.size] = feedrate
+            path._flags[:path.size] = flags
+            path._line_number[:path.size] = line_number
+        path._order[:path.size] = 0
+        path._dist_from_model[:path.size] = nan
+        if arc_index is not None and len(arc_index) > 0:
+            path.arc_index = array(arc_index, dtype=int64)
+            path.arc_ij = array(arc_ij, dtype=float).reshape(-1, 2)
+            path.arc_dir = array(arc_dir, dtype='<U2')
+        if commands is not None:
+            path.commands = commands
+        if rotations is not None:
+            path.rotations = rotations
+        return path
+
+    position = property(lambda self: self._position[:self.size])
+    feedrate = property(lambda self: self._feedrate[:self.size])
+    flags = property(lambda self: self._flags[:self.size])
+    order = property(lambda self: self._order[:self.size])
+    dist_from_model = property(lambda self: self._dist_from_model[:self.size])
+    line_number = property(lambda self: self._line_number[:self.size])
+    rapid = property(lambda self: (self.flags & RAPID) != 0)
+    in_contact = property(lambda self: (self.flags & IN_CONTACT) != 0)
+    inside_model = property(lambda self: (self.flags & INSIDE_MODEL) != 0)
+    interpolated = property(lambda self: (self.flags & INTERPOLATED) != 0)
+
+    def reserve(self, capacity):
+        if capacity <= len(self._flags):
+            return
+        capacity = max(capacity, 2*len(self._flags))
+        for name in ["_position", "_feedrate", "_flags", "_order", "_dist_from_model", "_line_number"]:
+            column = getattr(self, name)
+            grown = empty((capacity,)+column.shape[1:], dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+
+    # marks the start of a new segment at the current end of the path
+    def startSegment(self):
+        if len(self.segments) == 0 or self.segments[-1] != self.size:
+            self.segments.append(self.size)
+
+    # (start, end) index ranges of all segments
+    def segmentRanges(self):
+        starts = list(self.segments)
+        if len(starts) == 0 or starts[0] != 0:
+            starts = [0] + starts
+        return [(s, e) for s, e in zip(starts, starts[1:]+[self.size]) if e > s]
+
+    def appendArrays(self, position, feedrate=None, rapid=False, in_contact=True, inside_model=True, interpolated=False,
+                     order=0, dist_from_model=None, line_number=0):
+        position = asarray(position, dtype=float)
+        n = len(position)
+        start = self.size
+        self.reserve(start+n)
+        self.size += n
+        self._position[start:self.size] = position[:, 0:3]
+        self._feedrate[start:self.size] = nan if feedrate is None else feedrate
+        self._flags[start:self.size] = where(rapid, RAPID, 0) | where(in_contact, IN_CONTACT, 0) | \
+                                       where(inside_model, INSIDE_MODEL, 0) | where(interpolated, INTERPOLATED, 0)
+        self._order[start:self.size] = order
+        self._dist_from_model[start:self.size] = nan if dist_from_model is None else dist_from_model
+        self._line_number[start:self.size] = line_number
+
+    def append(self, p):
+        self.reserve(self.size+1)
+        self.size += 1
+        self._store(self.size-1, p)
+
+    def extend(self, points):
+        if isinstance(points, Toolpath):
+            start = self.size
+            self.reserve(start+len(points))
+            self.size += len(points)
+            for name in ["_position", "_feedrate", "_flags", "_order", "_dist_from_model", "_line_number"]:
+                getattr(self, name)[start:self.size] = getattr(points, name)[:points.size]
+            self.arc_index = concatenate((self.arc_index, points.arc_index+start))
+            self.arc_ij = concatenate((self.arc_ij, points.arc_ij))
+            self.arc_dir = concatenate((self.arc_dir, points.arc_dir))
+            for i, c in points.commands.items():
+                self.commands[i+start] = c
+            for i, r in points.rotations.items():
+                self.rotations[i+start] = r
+            self.segments += [s+start for s in points.segments if s+start not in self.segments]
+            return
+        self.reserve(self.size+len(points))
+        for p in points:
+            self.append(p)
+
+    def __iadd__(self, points):
+        self.extend(points)
+        return self
+
+    def insert(self, index, p):
+        if index < 0:
+            index += self.size
+        index = min(max(index, 0), self.size)
+        if isinstance(p, ToolpathView) and p.toolpath is self and p.index >= index:
+            # the row of p moves up by one
+            p = p.__class__(self, p.index+1)
+        self.reserve(self.size+1)
+        for name in ["_position", "_feedrate", "_flags", "_order", "_dist_from_model", "_line_number"]:
+            column = getattr(self, name)
+            column[index+1:self.size+1] = column[index:self.size].copy()
+        self.size += 1
+        self.arc_index[self.arc_index >= index] += 1
+        self.commands = dict((i+1 if i >= index else i, c) for i, c in self.commands.items())
+        self.rotations = dict((i+1 if i >= index else i, r) for i, r in self.rotations.items())
+        self.segments = [s+1 if s > index else s for s in self.segments]
+        self._store(index, p, new=True)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for i in range(0, self.size):
+            yield self._view(i)
+
+    def __reversed__(self):
+        for i in range(self.size-1, -1, -1):
+            yield self._view(i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._slice(*index.indices(self.size))
+        if index < 0:
+            index += self.size
+        if index < 0 or index >= self.size:
+            raise IndexError("toolpath index out of range")
+        return self._view(index)
+
+    def __setitem__(self, index, p):
+        if index < 0:
+            index += self.size
+        if index < 0 or index >= self.size:
+            raise IndexError("toolpath index out of range")
+        self._store(index, p)
+
+    def _view(self, i):
+        flags = int(self._flags[i])
+        if flags & COMMAND:
+            return self.commands[i]
+        if flags & ARC:
+            return ToolpathArc(self, i)
+        return ToolpathPoint(self, i)
+
+    # new path with the rows selected by a boolean mask or an index array (segment offsets are dropped)
+    def select(self, rows):
+        rows = arange(self.size)[rows]
+        result = Toolpath(capacity=max(16, len(rows)), axis_mapping=self.axis_mapping, axis_scaling=self.axis_scaling, rot_axis_mapping=self.rot_axis_mapping)
+        result.size = len(rows)
+        for name in ["_position", "_feedrate", "_flags", "_order", "_dist_from_model", "_line_number"]:
+            getattr(result, name)[:result.size] = getattr(self, name)[rows]
+        new_index = full(self.size, -1)
+        new_index[rows] = arange(len(rows))
+        arcs = new_index[self.arc_index] >= 0
+        result.arc_index = new_index[self.arc_index[arcs]]
+        result.arc_ij = self.arc_ij[arcs]
+        result.arc_dir = self.arc_dir[arcs]
+        result.commands = dict((int(new_index[i]), c) for i, c in self.commands.items() if new_index[i] >= 0)
+        result.rotations = dict((int(new_index[i]), r) for i, r in self.rotations.items() if new_index[i] >= 0)
+        return result
+
+    def _slice(self, start, stop, step):
+        result = Toolpath(capacity=16, axis_mapping=self.axis_mapping, axis_scaling=self.axis_scaling, rot_axis_mapping=self.rot_axis_mapping)
+        if step != 1:
+            result.extend([self._view(i) for i in range(start, stop, step)])
+            return result
+        stop = max(start, stop)
+        result.reserve(stop-start)
+        result.size = stop-start
+        for name in ["_position", "_feedrate", "_flags", "_order", "_dist_from_model", "_line_number"]:
+            getattr(result, name)[:result.size] = getattr(self, name)[start:stop]
+        arcs = (self.arc_index >= start) & (self.arc_index < stop)
+        result.arc_index = self.arc_index[arcs]-start
+        result.arc_ij = self.arc_ij[arcs]
+        result.arc_dir = self.arc_dir[arcs]
+        result.commands = dict((i-start, c) for i, c in self.commands.items() if start <= i < stop)
+        result.rotations = dict((i-start, r) for i, r in self.rotations.items() if start <= i < stop)
+        result.segments = [s-start for s in self.segments if start <= s < stop]
+        return result
+
+    # per-row output attributes of rows start..end-1, with the command rows taken from their objects
+    def _outputColumns(self, start, end):
+        flags = self._flags[start:end].astype(int32)
+        is_point = (flags & COMMAND) == 0
+        rapids = (flags & RAPID) != 0
+        control = (flags & CONTROL_POINT) != 0
+        feedrate = self._feedrate[start:end].copy()
+        gmode = where(rapids, "G0", "G1").astype('<U3')
+        arc_slots = arange(searchsorted(self.arc_index, start), searchsorted(self.arc_index, end))
+        gmode[self.arc_index[arc_slots]-start] = char.add("G", self.arc_dir[arc_slots])
+        rotated = zeros(end-start, dtype=bool)
+        for i in self.rotations.keys():
+            if start <= i < end:
+                rotated[i-start] = True
+        is_gpoint = is_point.copy()
+        for i, c in self.commands.items():
+            if start <= i < end:
+                r = i-start
+                is_gpoint[r] = isinstance(c, GPoint)
+                rapids[r] = bool(c.rapid)
+                control[r] = bool(c.control_point)
+                feedrate[r] = nan if c.feedrate is None else c.feedrate
+                if is_gpoint[r]:
+                    gmode[r] = c.gmode
+        return is_point, is_gpoint, rapids, control, feedrate, gmode, (flags & ARC) != 0, rotated
+
+    # feedrate words: written on control points and on cutting moves where the feedrate changes.
+    # Returns the words and the current feedrate after the rows.
+    def _feedrateWords(self, feedrate, rapids, control, current_feedrate, format_feedrate):
+        n = len(feedrate)
+        has_feed = ~isnan(feedrate)
+        updates = has_feed & (control | ~rapids)
+        last = maximum.accumulate(where(updates, arange(n), -1))
+        last_before = concatenate(([-1], last[:-1]))
+        current = where(last_before >= 0, feedrate[maximum(last_before, 0)], current_feedrate)
+        write_feed = has_feed & (control | (~rapids & (feedrate != current)))
+        words = full(n, "", dtype=object)
+        words[write_feed] = ["F"+format_feedrate(f) for f in feedrate[write_feed].tolist()]
+        if n > 0 and last[-1] >= 0:
+            current_feedrate = feedrate[last[-1]]
+        return words, current_feedrate
+
+    # G-code text of the path in blocks of rows, with the same output as formatting the points one by one
+    # (modal G0/G1/G2/G3 words, laser mode M5/M4 around rapids, feedrates only where they change).
+    # Plain points are formatted with one template per block, special rows (arcs, rotations, control
+    # points, commands) use their to_output(). With precision set, the compact format is written instead.
+    def textBlocks(self, default_feedrate=None, laser_mode=False, block_size=10000, precision=None):
+        if precision is not None:
+            for block in self.compactTextBlocks(default_feedrate, laser_mode, precision, block_size):
+                yield block
+            return
+        am = self.axis_mapping
+        scaling = array([float(s) for s in self.axis_scaling[0:3]])
+        plain_template = "%s"+am[0]+"%f "+am[1]+"%f "+am[2]+"%f %s\n"
+        templates = array([plain_template, "%s%s%.0s%.0s%s\n"], dtype=object)
+        rapid = -1 # unknown before the first point
+        current_gmode = "G1"
+        current_feedrate = nan if default_feedrate is None else default_feedrate
+        for start in range(0, self.size, block_size):
+            end = min(start+block_size, self.size)
+            n = end-start
+            is_point, is_gpoint, rapids, control, feedrate, gmode, arcs, rotated = self._outputColumns(start, end)
+            special = ~is_point | control | arcs | rotated
+
+            # modal G words: switching to rapid always writes G0 (and leaves the current mode unchanged),
+            # switching back from rapid always writes the mode, other points write it if it changed
+            prefix = full(n, "", dtype=object)
+            rows = flatnonzero(is_gpoint)
+            if len(rows) > 0:
+                r = rapids[rows].astype(int8)
+                switch = r != concatenate(([rapid], r[:-1]))
+                to_rapid = switch & (r == 1)
+                gm = gmode[rows]
+                last = maximum.accumulate(where(~to_rapid, arange(len(rows)), -1))
+                last_before = concatenate(([-1], last[:-1]))
+                current = where(last_before >= 0, gm[maximum(last_before, 0)], current_gmode)
+                write_gmode = ~to_rapid & (switch | (gm != current))
+                words = full(len(rows), "", dtype=object)
+                words[write_gmode] = char.add(gm[write_gmode], " ").astype(object)
+                if laser_mode:
+                    words[to_rapid] = "M5\nG0 "
+                    to_feed = switch & (r == 0)
+                    words[to_feed] = "M4 S1000\n"+words[to_feed]
+                else:
+                    words[to_rapid] = "G0 "
+                prefix[rows] = words
+                rapid = int(r[-1])
+                if last[-1] >= 0:
+                    current_gmode = str(gm[last[-1]])
+
+            suffix, current_feedrate = self._feedrateWords(feedrate, rapids, control, current_feedrate, lambda f: "%f" % f)
+
+            args = empty((n, 5), dtype=object)
+            args[:, 0] = prefix
+            args[:, 1:4] = self._position[start:end]*scaling
+            args[:, 4] = suffix
+            for r in flatnonzero(special):
+                args[r, 1] = self._view(start+r).to_output()
+            yield "".join(templates[special.astype(int8)]) % tuple(args.ravel().tolist())
+
+    # Compact G-code: G words only when the mode changes, axes only when their value changes,
+    # numbers with precision[axis] decimals (more where axis_scaling shrinks the values) and
+    # without trailing zeros. Lines without any word are left out.
+    def compactTextBlocks(self, default_feedrate=None, laser_mode=False, precision=[3, 3, 3], block_size=10000):
+        am = self.axis_mapping
+        ram = self.rot_axis_mapping
+        scaling = [float(s) for s in self.axis_scaling[0:3]]
+        decimals = [output_decimals(precision[a], scaling[a]) for a in range(0, 3)]
+        feed_decimals = max(decimals)
+        rapid = -1
+        current_gmode = None
+        current_feedrate = nan if default_feedrate is None else default_feedrate
+        last_words = [None, None, None]
+        for start in range(0, self.size, block_size):
+            end = min(start+block_size, self.size)
+            n = end-start
+            is_point, is_gpoint, rapids, control, feedrate, gmode, arcs, rotated = self._outputColumns(start, end)
+
+            # axis words of the moving rows, where the formatted value changed. Arcs always get X and Y:
+            # G2/G3 need an axis word, and a full circle ends where it starts.
+            moving = flatnonzero(is_point & ~control)
+            moving_arcs = arcs[moving]
+            axis_words = []
+            for a in range(0, 3):
+                words = array([format_number(v, decimals[a]) for v in (self._position[start:end, a][moving]*scaling[a]).tolist()], dtype=object)
+                changed = words != array([last_words[a]]+words[:-1].tolist(), dtype=object)
+                if a < 2:
+                    changed |= moving_arcs
+                column = full(n, "", dtype=object)
+                column[moving[changed]] = [am[a]+w+" " for w in words[changed].tolist()]
+                axis_words.append(column)
+                if len(moving) > 0:
+                    last_words[a] = words[-1]
+
+            middle = full(n, "", dtype=object)
+            for r in flatnonzero(arcs & is_point & ~control):
+                ij = self.arc_ij[self._arcSlot(start+r)]
+                middle[r] = "I%s J%s " % (format_number(ij[0], decimals[0]), format_number(ij[1], decimals[1]))
+            for r in flatnonzero(rotated & is_point & ~control):
+                rotation = self.rotations[start+r]
+                middle[r] += "%s%s %s%s %s%s " % (ram[0], format_number(rotation[0], decimals[0]), ram[1], format_number(rotation[1], decimals[1]),
+                                                  ram[2], format_number(rotation[2], decimals[2]))
+            for r in flatnonzero(~is_point):
+                middle[r] = self.commands[start+r].to_output()
+            motion = axis_words[0]+axis_words[1]+axis_words[2]+middle
+            # points that don't move are left out, the modal words go to the next move
+            moves = flatnonzero(is_point & ~control & (motion != ""))
+
+            # modal G words, laser on/off around rapids
+            prefix = full(n, "", dtype=object)
+            if len(moves) > 0:
+                gm = gmode[moves]
+                write_gmode = gm != concatenate(([current_gmode], gm[:-1]))
+                words = full(len(moves), "", dtype=object)
+                words[write_gmode] = char.add(gm[write_gmode], " ").astype(object)
+                if laser_mode:
+                    r = rapids[moves].astype(int8)
+                    switch = r != concatenate(([rapid], r[:-1]))
+                    words[switch & (r == 1)] = "M5\n"+words[switch & (r == 1)]
+                    words[switch & (r == 0)] = "M4 S1000\n"+words[switch & (r == 0)]
+                    rapid = int(r[-1])
+                prefix[moves] = words
+                current_gmode = str(gm[-1])
+
+            suffix, current_feedrate = self._feedrateWords(feedrate, rapids, control, current_feedrate,
+                                                           lambda f: format_number(f, feed_decimals))
+
+            lines = prefix+motion+suffix
+            keep = (lines != "") | ~is_point
+            yield "".join((lines[keep]+"\n").tolist())
+
+    def _arcSlot(self, i):
+        slot = searchsorted(self.arc_index, i)
+        if slot < len(self.arc_index) and self.arc_index[slot] == i:
+            return slot
+        return None
+
+    # writes point p into row i (new: the row was just inserted and holds no arc yet)
+    def _store(self, i, p, new=False):
+        is_command = not isinstance(p, GPoint) or p.position is None
+        if not is_command:
+            # read everything first, p may be a view onto this path
+            position = array(p.position[0:3], dtype=float)
+            flags = (RAPID if p.rapid else 0) | (IN_CONTACT if p.in_contact else 0) | \
+                    (INSIDE_MODEL if p.inside_model else 0) | (INTERPOLATED if p.interpolated else 0) | \
+                    (CONTROL_POINT if p.control_point else 0)
+            order = p.order
+            dist_from_model = p.dist_from_model
+            rotation = p.rotation
+            arc = None
+            if isinstance(p, GArc):
+                arc = (array(p.ij[0:2], dtype=float), str(p.arcdir))
+        line_number = p.line_number
+        feedrate = p.feedrate
+        if not new and len(self.arc_index) > 0:
+            slot = self._arcSlot(i)
+            if slot is not None:
+                self.arc_index = delete(self.arc_index, slot)
+                self.arc_ij = delete(self.arc_ij, slot, axis=0)
+                self.arc_dir = delete(self.arc_dir, slot)
+        self.commands.pop(i, None)
+        self.rotations.pop(i, None)
+        self._line_number[i] = line_number
+        self._feedrate[i] = nan if feedrate is None else feedrate
+        if is_command:
+            self.commands[i] = p
+            self._position[i] = nan
+            self._flags[i] = COMMAND
+            self._order[i] = 0
+            self._dist_from_model[i] = nan
+            return
+        self._position[i] = position
+        self._flags[i] = flags
+        self._order[i] = order
+        self._dist_from_model[i] = nan if dist_from_model is None else dist_from_model
+        if rotation is not None:
+            self.rotations[i] = rotation
+        if arc is not None:
+            self._flags[i] |= ARC
+            slot = searchsorted(self.arc_index, i)
+            self.arc_index = insert(self.arc_index, slot, i)
+            self.arc_ij = insert(self.arc_ij, slot, arc[0], axis=0)
+            self.arc_dir = insert(self.arc_dir, slot, arc[1])
+
+
+def _column_property(name):
+    def get(self):
+        return getattr(self.toolpath, name)[self.index]
+    def set(self, value):
+        getattr(self.toolpath, name)[self.index] = value
+    return property(get, set)
+
+def _optional_property(name):
+    def get(self):
+        value = getattr(self.toolpath, name)[self.index]
+        if isnan(value):
+            return None
+        return float(value)
+    def set(self, value):
+        getattr(self.toolpath, name)[self.index] = nan if value is None else value
+    return property(get, set)
+
+def _flag_property(flag):
+    def get(self):
+        return (int(self.toolpath._flags[self.index]) & flag) != 0
+    def set(self, value):
+        if value:
+            self.toolpath._flags[self.index] |= flag
+        else:
+            self.toolpath._flags[self.index] &= ~uint8(flag)
+    return property(get, set)
+
+def _shared_property(name):
+    def get(self):
+        return getattr(self.toolpath, name)
+    def set(self, value):
+        setattr(self.toolpath, name, value)
+    return property(get, set)
+
+
+# Column-backed attributes shared by the point and arc views onto one row of a Toolpath.
+# Attribute reads and writes go to the columns, position is a view onto the position row
+# (in-place edits change the toolpath).
+class ToolpathView:
+    __slots__ = ()
+
+    position = _column_property("_position")
+    order = _column_property("_order")
+    line_number = _column_property("_line_number")
+    feedrate = _optional_property("_feedrate")
+    dist_from_model = _optional_property("_dist_from_model")
+    rapid = _flag_property(RAPID)
+    in_contact = _flag_property(IN_CONTACT)
+    inside_model = _flag_property(INSIDE_MODEL)
+    interpolated = _flag_property(INTERPOLATED)
+    control_point = _flag_property(CONTROL_POINT)
+    axis_mapping = _shared_property("axis_mapping")
+    axis_scaling = _shared_property("axis_scaling")
+    rot_axis_mapping = _shared_property("rot_axis_mapping")
+
+    def __init__(self, toolpath, index):
+        self.toolpath = toolpath
+        self.index = index
+        self.command = ""
+
+    @property
+    def rotation(self):
+        return self.toolpath.rotations.get(self.index)
+
+    @rotation.setter
+    def rotation(self, value):
+        if value is None:
+            self.toolpath.rotations.pop(self.index, None)
+        else:
+            self.toolpath.rotations[self.index] = value
+
+
+class ToolpathPoint(ToolpathView, GPoint):
+    __slots__ = ("toolpath", "index")
+
+    @property
+    def gmode(self):
+        if self.rapid:
+            return "G0"
+        return "G1"
+
+
+class ToolpathArc(ToolpathView, GArc):
+    __slots__ = ("toolpath", "index")
+
+    @property
+    def ij(self):
+        return self.toolpath.arc_ij[self.toolpath._arcSlot(self.index)]
+
+    @property
+    def arcdir(self):
+        return str(self.toolpath.arc_dir[self.toolpath._arcSlot(self.index)])
+
+    @property
+    def gmode(self):
+        return "G"+self.arcdir
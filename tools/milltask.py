@@ -2,10 +2,12 @@ from guifw.abstractparameters import *
 from geometry import *
 from solids import  *
 import multiprocessing as mp
+import numpy as np
 import time
 import pyclipper
 from polygons import *
 from gcode import *
+from toolpath import *
 
 
 class CalcJob:
@@ -31,13 +33,29 @@ def run(pattern):
                     margin=task.offset.value,  \
                     min_stepx=task.minStep.value \
                     )
-        return pathlet
+        # columnar result is much cheaper to send back from the worker than a list of GPoints
+        return Toolpath.fromPoints(pathlet)
 
 def run_init(task_options):
     run.task=task_options
 
         
 
+# boustrophedon raster along x, stepping over in y. Returns one (n,3) array per pass, alternating in direction.
+def zigzag_pattern(start_pos,  end_pos,  forward_step,  side_step,  z):
+    count = int((end_pos[0]-start_pos[0])/forward_step)
+    forward = np.append(start_pos[0]+np.arange(count)*forward_step,  end_pos[0])
+    backward = np.append(end_pos[0]-np.arange(count)*forward_step,  start_pos[0])
+    # passes at every side step below the end, plus one on the end itself
+    rows = int(ceil((end_pos[1]-start_pos[1])/side_step))
+    y = np.append(start_pos[1]+np.arange(max(rows,  0))*side_step,  end_pos[1])
+    grid = np.empty((len(y),  count+1,  3))
+    grid[0::2, :, 0] = forward
+    grid[1::2, :, 0] = backward
+    grid[:, :, 1] = y[:, None]
+    grid[:, :, 2] = z
+    return list(grid)
+
 class MillTask(ItemWithParameters):
     def __init__(self,  model=None,  tools=[], viewUpdater=None, **kwargs):
         ItemWithParameters.__init__(self,  **kwargs)
@@ -56,11 +74,74 @@ class MillTask(ItemWithParameters):
         self.waterlevel=NumericalParameter(parent=self,  name='waterlevel',  value=self.model.minv[2],  min=self.model.minv[2],  max=self.model.maxv[2],  step=1.0)
         self.deviation = NumericalParameter(parent=self, name='max. deviation', value=0.1, min=0.0, max=10, step=0.01)
         self.minStep=NumericalParameter(parent=self, name="min. step size",  value=0.1,  min=0.0,  max=50.0,  step=0.01)
+        self.linking=ChoiceParameter(parent=self,  name="Linking",  choices=["retract",  "stay down"],  value="retract")
+        self.maxLinkLength=NumericalParameter(parent=self, name="max. link length",  value=10.0,  min=0.0,  max=1000.0,  step=0.1)
+        self.retract=ChoiceParameter(parent=self,  name="Retract",  choices=["traverse height",  "minimum height"],  value="traverse height")
+        self.clearance=NumericalParameter(parent=self, name="retract clearance",  value=2.0,  min=0.0,  max=100.0,  step=0.1)
         self.viewUpdater=viewUpdater
 
+    # material left on the model by this task's paths
+    def stockToLeave(self):
+        return self.offset.value
+
+    # Height for a rapid move from a to b: with "minimum height" retracts, the highest cutter location
+    # along the move (from the model clearance map), the end points and floor (e.g. top of uncut stock),
+    # plus clearance. Never above the traverse height.
+    def retractHeight(self,  a,  b,  floor=None):
+        if self.retract.getValue() != "minimum height":
+            return self.traverseHeight.value
+        self.model.__class__ = CAM_Solid
+        height = max(a[2],  b[2])
+        model_height = self.model.get_retract_height([a,  b],  self.tool.getValue().diameter.value/2.0,  self.stockToLeave())
+        if model_height is not None:
+            height = max(height,  model_height)
+        if floor is not None:
+            height = max(height,  floor)
+        return min(height + self.clearance.getValue(),  self.traverseHeight.value)
+
+    # cutter location height function for link checks (same tool radius and margin as follow_surface).
+    # offset is the stock to leave on the model, the task's offset by default
+    def linkHeightFunction(self,  offset=None):
+        if offset is None:
+            offset = self.offset.value
+        tool = self.tool.getValue()
+        radius = tool.diameter.value/2.0 + offset
+        self.model.__class__ = CAM_Solid
+        self.model.calc_ref_map(tool.diameter.value / 2.0, tool.diameter.value / 2.0 + offset)
+        self.model.waterlevel = self.waterlevel.value
+        height_function = tool.getHeightFunction(self.model)
+        return lambda x, y: max(height_function(x, y, radius)[0] + offset,  self.model.minv[2])
+
+    # Tries to connect a and b without retracting. Returns the intermediate points of the link
+    # (empty for a straight move), or None if no safe link was found and the tool has to retract.
+    # The link is checked against the model with the drop cutter height along the line; if a straight
+    # move would gouge and follow_surface is set, the link follows the surface instead.
+    # Links longer than max. link length are rejected, as they would cut through uncut stock.
+    def findLink(self,  a,  b,  height,  follow_surface=True):
+        length = dist2D(a,  b)
+        if length > self.maxLinkLength.getValue():
+            return None
+        step = max(self.minStep.getValue(),  self.tool.getValue().diameter.value/8.0)
+        samples = int(length/step)+2
+        link = []
+        direct = True
+        for i in range(1,  samples-1):
+            t = float(i)/(samples-1)
+            x = a[0]+t*(b[0]-a[0])
+            y = a[1]+t*(b[1]-a[1])
+            z = height(x,  y)
+            if z > a[2]+t*(b[2]-a[2]) + self.deviation.getValue():
+                direct = False
+            link.append([x,  y,  z])
+        if direct:
+            return []
+        if follow_surface:
+            return link
+        return None
+
     def dropPathToModel(self):
         tool_diameter = self.tool.getValue().diameter.value
-        keepToolDown = False
+        keepToolDown = self.linking.getValue() == "stay down"
         patterns = self.patterns
 
         self.model.__class__ = CAM_Solid
@@ -80,21 +161,38 @@ class MillTask(ItemWithParameters):
         # run_init(self)
         # results=map(run,  self.patterns)
 
+        # links between consecutive segments (None where the tool retracts)
+        results = [segment for segment in results if len(segment) > 0]
+        links = [None]*(len(results)+1)
+        if keepToolDown:
+            height = self.linkHeightFunction()
+            for i in range(1,  len(results)):
+                links[i] = self.findLink(results[i-1][-1].position,  results[i][0].position,  height)
+            print("linked %i of %i segments without retract" % (len([l for l in links if l is not None]),  len(results)))
+
         self.path = GCode()
+        self.path.path = Toolpath()
         self.path.append(
             GPoint(position=(results[0][0].position[0], results[0][0].position[1], self.traverseHeight.value),
                    rapid=True))
-        for segment in results:
+        # retract heights between consecutive segments (lift, traverse, plunge)
+        heights = [self.traverseHeight.value]*(len(results)+1)
+        for i in range(1,  len(results)):
+            heights[i] = self.retractHeight(results[i-1][-1].position,  results[i][0].position)
+        for i, segment in enumerate(results):
             # self.path+=p
-            if not keepToolDown:
+            self.path.path.startSegment()
+            if links[i] is None:
                 self.path.append(
-                    GPoint(position=(segment[0].position[0], segment[0].position[1], self.traverseHeight.value),
+                    GPoint(position=(segment[0].position[0], segment[0].position[1], heights[i]),
                            rapid=True))
-            for p in segment:
-                self.path.append(p)
-            if not keepToolDown:
+            else:
+                for p in links[i]:
+                    self.path.append(GPoint(position=p))
+            self.path.path.extend(segment)
+            if links[i+1] is None:
                 self.path.append(
-                    GPoint(position=(segment[-1].position[0], segment[-1].position[1], self.traverseHeight.value),
+                    GPoint(position=(segment[-1].position[0], segment[-1].position[1], heights[i+1]),
                            rapid=True))
 
         self.path.append(
@@ -109,6 +207,7 @@ class PatternTask(MillTask):
         MillTask.__init__(self, model,   tools,  **kwargs)
 
         self.direction=ChoiceParameter(parent=self,  name="Pattern direction",  choices=["X",  "Y",  "Spiral",  "Concentric"],  value="X")
+        self.clipping=ChoiceParameter(parent=self,  name="Pattern clipping",  choices=["silhouette",  "none"],  value="silhouette")
         self.model=model.object
         self.forwardStep=NumericalParameter(parent=self, name="forward step",  value=3.0,  min=0.0001,    step=0.1)
         self.sideStep=NumericalParameter(parent=self, name="side step",  value=1.0,  min=0.0001,  step=0.1)
@@ -117,7 +216,7 @@ class PatternTask(MillTask):
 
 
 
-        self.parameters=[self.tool, self.padding,  self.direction,  self.forwardStep,  self.sideStep, self.traverseHeight, self.waterlevel,   self.minStep, self.offset, self.sliceIter,   self.deviation]
+        self.parameters=[self.tool, self.padding,  self.direction,  self.clipping,  self.forwardStep,  self.sideStep, self.traverseHeight, self.linking,  self.maxLinkLength,  self.retract,  self.clearance,  self.waterlevel,   self.minStep, self.offset, self.sliceIter,   self.deviation]
         self.patterns=None
         
 
@@ -136,7 +235,30 @@ class PatternTask(MillTask):
             self.generateConcentric()
         if self.direction.getValue()=="Outline":
             self.generateOutline()
-        
+        if self.clipping.getValue()=="silhouette" and self.patterns is not None:
+            self.clipToSilhouette()
+
+    # model outline in XY, grown by the cutter radius: outside of it the tool can't touch the model
+    def getSilhouette(self):
+        radius = self.tool.getValue().diameter.value/2.0 + self.offset.value
+        silhouette = self.model.calc_silhouette().offset(radius=-radius)
+        silhouette.buildGridIndex()
+        return silhouette
+
+    # keep only the parts of the pattern lines that can touch material, including one point beyond
+    # both ends of each run so the cut starts and ends outside the silhouette
+    def clipToSilhouette(self):
+        silhouette = self.getSilhouette()
+        clipped = []
+        total = 0
+        for pat in self.patterns:
+            pat = np.asarray(pat,  dtype=float)
+            total += len(pat)
+            if len(pat)>0:
+                clipped += masked_runs(pat,  silhouette.pointsInside(pat))
+        print("silhouette clipping kept %i of %i pattern points" % (sum([len(pat) for pat in clipped]),  total))
+        self.patterns = clipped
+
     def generateXPattern(self):
         model=self.model
         #padding=self.tool.getValue().diameter.value +self.offset.value
@@ -144,80 +266,18 @@ class PatternTask(MillTask):
 
         start_pos=[model.minv[0]-padding,  model.minv[1]-padding,  model.minv[2]]
         end_pos=[model.maxv[0]+padding,  model.maxv[1]+padding,  model.maxv[2]]
+        self.patterns = zigzag_pattern(start_pos,  end_pos,  self.forwardStep.value,  self.sideStep.value,  self.traverseHeight.value)
 
-        stepx=self.forwardStep.value
-        stepy=self.sideStep.value
-        path=[]
-        #path.append(start_pos)
-        y=start_pos[1]
-        #last_pass=0
-        dir=1
-        self.patterns=[]
-        while y<=end_pos[1]:
-            if dir==1:
-                for x in frange(start_pos[0], end_pos[0], stepx):
-                    path.append([x,  y,  self.traverseHeight.value])
-                x=end_pos[0]
-                path.append([x,  y,  self.traverseHeight.value])
-                self.patterns.append(path)
-                path=[]
-            else:
-                for x in frange(end_pos[0],start_pos[0],  -stepx):
-                    path.append([x,  y,  self.traverseHeight.value])
-                x=start_pos[0]
-                path.append([x,  y,  self.traverseHeight.value])
-                self.patterns.append(path)
-                path=[]
-            dir=-dir
-            if y<end_pos[1]:
-                y+=stepy
-                if y>end_pos[1]:
-                    y=end_pos[1]
-            else:
-                y+=stepy
-                
-        
     def generateYPattern(self):
         model=self.model
-        start_pos=model.minv
         #padding=self.tool.getValue().diameter.value +self.offset.value
         padding =  self.padding.getValue()
 
         start_pos=[model.minv[0]-padding,  model.minv[1]-padding,  model.minv[2]]
         end_pos=[model.maxv[0]+padding,  model.maxv[1]+padding,  model.maxv[2]]
-        
-
-        stepy=self.forwardStep.value
-        stepx=self.sideStep.value
-        path=[]
-        #path.append(start_pos)
-        x=start_pos[0]
-        #last_pass=0
-        dir=1
-        self.patterns=[]
-        while x<=end_pos[0]:
-            if dir==1:
-                for y in frange(start_pos[1], end_pos[1], stepy):
-                    path.append([x,  y,  self.traverseHeight.value])
-                y=end_pos[1]
-                path.append([x,  y,  self.traverseHeight.value])
-                self.patterns.append(path)
-                path=[]
-            else:
-                for y in frange(end_pos[1],start_pos[1],  -stepy):
-                    path.append([x,  y,  self.traverseHeight.value])
-                y=start_pos[1]
-                path.append([x,  y,  self.traverseHeight.value])
-                self.patterns.append(path)
-                path=[]
-            dir=-dir
-            if x<end_pos[0]:
-                x+=stepx
-                if x>end_pos[0]:
-                    x=end_pos[0]
-            else:
-                x+=stepx
-
+        # same zigzag with the axes swapped
+        patterns = zigzag_pattern(start_pos[1::-1],  end_pos[1::-1],  self.forwardStep.value,  self.sideStep.value,  self.traverseHeight.value)
+        self.patterns = [pat[:, [1, 0, 2]] for pat in patterns]
 
     def generateSpiralPattern(self,  climb=True,  start_inside=True):
         model=self.model
@@ -227,64 +287,59 @@ class PatternTask(MillTask):
         bound_min=[model.minv[0]-padding,  model.minv[1]-padding,  model.minv[2]]
         bound_max=[model.maxv[0]+padding,  model.maxv[1]+padding,  model.maxv[2]]
 
-        path=[]
-        #path.append(start_pos)
         # set start position to corner
-        pos = [bound_min[0],  bound_min[1], self.traverseHeight.value]
-        
+        pos = np.array([bound_min[0],  bound_min[1], self.traverseHeight.value])
+
         if (climb and start_inside) or (not climb and not start_inside) :
-            vec = [0, self.forwardStep.value,  0]
+            vec = np.array([0, self.forwardStep.value,  0])
         else:
-            vec = [self.forwardStep.value,  0,  0]
+            vec = np.array([self.forwardStep.value,  0,  0])
 
         self.patterns=[]
         firstpass=True
+        # one straight segment per iteration: all steps up to the bounding box, then the clipped corner point
         while bound_min[0]<bound_max[0] or bound_min[1]<bound_max[1]:
-            if (pos[0]>=bound_min[0] and pos[0]<=bound_max[0] and pos[1]>=bound_min[1] and pos[1]<=bound_max[1]):
-                path.append([pos[0],  pos[1],  pos[2]])
-            else:
-                # clip to bounding box
-                if pos[0] > bound_max[0]:
-                    pos[0] = bound_max[0]
-                    if not firstpass:
-                        bound_min[0] = min(bound_max[0],  bound_min[0] + self.sideStep.value)
-                    
-                if pos[1] > bound_max[1]:
-                    pos[1] = bound_max[1]
-                    if not firstpass:
-                        bound_min[1] = min(bound_max[1],  bound_min[1] + self.sideStep.value)
-                    
-                if pos[0] < bound_min[0]:
-                    pos[0] = bound_min[0]
-                    if not firstpass:
-                        bound_max[0] = max(bound_min[0],  bound_max[0] - self.sideStep.value)
-                    
-                if pos[1] < bound_min[1]:
-                    pos[1] = bound_min[1]
-                    if not firstpass:
-                        bound_max[1] = max(bound_min[1],  bound_max[1] - self.sideStep.value)
-                                    
-                path.append([pos[0],  pos[1],  pos[2]])
-                # rotate vector
-                t = vec[0]
-                if climb:
-                    vec[0] = vec[1]
-                    vec[1] = -t
+            axis = 0 if vec[0]!=0 else 1
+            steps = 0
+            if pos[0]>=bound_min[0] and pos[0]<=bound_max[0] and pos[1]>=bound_min[1] and pos[1]<=bound_max[1]:
+                if vec[axis]>0:
+                    steps = int(floor((bound_max[axis]-pos[axis])/vec[axis]))+1
                 else:
-                    vec[0] = -vec[1]
-                    vec[1] = t
-                #append path segment to output
-                self.patterns.append(path)
-                path=[]
-                firstpass = False
-
-            pos[0] += vec[0]
-            pos[1] += vec[1]
+                    steps = int(floor((bound_min[axis]-pos[axis])/vec[axis]))+1
+            path = pos + np.arange(steps+1)[:, None]*vec
+            pos = path[-1]
+            # clip to bounding box
+            if pos[0] > bound_max[0]:
+                pos[0] = bound_max[0]
+                if not firstpass:
+                    bound_min[0] = min(bound_max[0],  bound_min[0] + self.sideStep.value)
+
+            if pos[1] > bound_max[1]:
+                pos[1] = bound_max[1]
+                if not firstpass:
+                    bound_min[1] = min(bound_max[1],  bound_min[1] + self.sideStep.value)
+
+            if pos[0] < bound_min[0]:
+                pos[0] = bound_min[0]
+                if not firstpass:
+                    bound_max[0] = max(bound_min[0],  bound_max[0] - self.sideStep.value)
+
+            if pos[1] < bound_min[1]:
+                pos[1] = bound_min[1]
+                if not firstpass:
+                    bound_max[1] = max(bound_min[1],  bound_max[1] - self.sideStep.value)
+            # rotate vector
+            if climb:
+                vec = np.array([vec[1],  -vec[0],  0])
+            else:
+                vec = np.array([-vec[1],  vec[0],  0])
+            #append path segment to output
+            self.patterns.append(path)
+            firstpass = False
+            pos = pos + vec
         # reverse path if starting on inside:
         if start_inside:
-            for pat in self.patterns:
-                pat.reverse()
-            self.patterns.reverse()
+            self.patterns = [pat[::-1] for pat in reversed(self.patterns)]
 
     def generateConcentric(self):
         #model=self.model
@@ -292,7 +347,6 @@ class PatternTask(MillTask):
         padding =  self.padding.getValue()
         stepy=self.forwardStep.value #radial step
         stepx=self.sideStep.value       #stepover
-        path=[]
         self.patterns=[]
         center = [0, 0, self.traverseHeight.value]
         iterations = int(self.sliceIter.getValue())
@@ -300,16 +354,16 @@ class PatternTask(MillTask):
         if start_radius<stepx:
             start_radius = stepx
             iterations = int((padding-start_radius) / stepx)
-        
-        for i in reversed(range(0,  iterations)):
-            radius = padding - i*stepx
-            for a in range(0,  int(360.0/stepy)+1):
-                alpha = a*stepy*PI/180.0
-                pos = [center[0]+radius*sin(alpha),  center[1]-radius*cos(alpha),  center[2]]
-                path.append([pos[0],  pos[1],  pos[2]])
-        
+
+        radius = padding - np.arange(iterations)[::-1]*stepx
+        alpha = np.arange(int(360.0/stepy)+1)*stepy*PI/180.0
+        path = np.empty((len(radius),  len(alpha),  3))
+        path[:, :, 0] = center[0]+radius[:, None]*np.sin(alpha)
+        path[:, :, 1] = center[1]-radius[:, None]*np.cos(alpha)
+        path[:, :, 2] = center[2]
+
         #keep all circles in one path pattern
-        self.patterns.append(path)
+        self.patterns.append(path.reshape(-1,  3))
 
     def getStockPolygon(self):
         bound_min==[model.minv[0]-padding,  model.minv[1]-padding,  model.minv[2]]
@@ -336,14 +390,16 @@ class SliceTask(MillTask):
         self.stockSizeX=NumericalParameter(parent=self, name="Len. X",  value=self.model.maxv[0]-self.model.minv[0], step=0.1)
         self.stockSizeY=NumericalParameter(parent=self, name="Len. Y",  value=self.model.maxv[1]-self.model.minv[1], step=0.1)
         
-        self.operation=ChoiceParameter(parent=self,  name="Operation",  choices=["Slice",  "Slice & Drop",  "Outline",  "Medial Lines"],  value="Slice")
+        self.operation=ChoiceParameter(parent=self,  name="Operation",  choices=["Slice",  "Slice & Drop",  "Adaptive",  "Outline",  "Medial Lines"],  value="Slice")
         self.direction=ChoiceParameter(parent=self,  name="Direction",  choices=["inside out",  "outside in"],  value="inside out")
+        self.pathOrder=ChoiceParameter(parent=self,  name="Path order",  choices=["shortest rapids",  "tree"],  value="shortest rapids")
         self.model = None
         if model is not None:
             self.model=model.object
 
         self.sideStep=NumericalParameter(parent=self, name="stepover",  value=1.0,  min=0.0001,  step=0.1)
         self.radialOffset = NumericalParameter(parent=self, name='radial offset', value=0.0, min=-100, max=100, step=0.01)
+        self.engagement = NumericalParameter(parent=self, name='max. engagement', value=90.0, min=1.0, max=180.0, step=1.0)
         #self.diameter=NumericalParameter(parent=self, name="tool diameter",  value=6.0,  min=0.0,  max=1000.0,  step=0.1)
         self.pathRounding = NumericalParameter(parent=self,  name='path rounding',  value=0.0,  min=0,  max=10,  step=0.01)
         self.precision = NumericalParameter(parent=self,  name='precision',  value=0.005,  min=0.001,  max=1,  step=0.001)
@@ -355,7 +411,7 @@ class SliceTask(MillTask):
 
         self.scalloping=NumericalParameter(parent=self, name="scalloping",  value=0,  step=1,  enforceRange=False,  enforceStep=True)
 
-        self.parameters=[self.tool, [self.stockMinX,  self.stockMinY],  [self.stockSizeX,  self.stockSizeY], self.operation, self.direction,  self.sideStep, self.traverseHeight,   self.radialOffset,   self.pathRounding, self.precision,  self.sliceTop,  self.sliceBottom, self.sliceStep,  self.sliceIter,  self.scalloping]
+        self.parameters=[self.tool, [self.stockMinX,  self.stockMinY],  [self.stockSizeX,  self.stockSizeY], self.operation, self.direction,  self.pathOrder,  self.sideStep,  self.engagement, self.traverseHeight,  self.linking,  self.maxLinkLength,  self.retract,  self.clearance,   self.radialOffset,   self.pathRounding, self.precision,  self.sliceTop,  self.sliceBottom, self.sliceStep,  self.sliceIter,  self.scalloping]
         self.patterns=None
         
 
@@ -366,9 +422,12 @@ class SliceTask(MillTask):
 
         if self.operation.getValue()=="Outline":
             self.generateOutline()
-        if self.operation.getValue()=="Slice" or self.operation.getValue()=="Slice & Drop"  or self.operation.value=="Medial Lines":
+        if self.operation.getValue()=="Slice" or self.operation.getValue()=="Slice & Drop"  or self.operation.value=="Adaptive" or self.operation.value=="Medial Lines":
             self.slice(addBoundingBox = False)
 
+    def stockToLeave(self):
+        return self.radialOffset.value
+
     def getStockPolygon(self):
         sliceLevel = self.sliceTop.getValue()
         bound_min=[self.stockMinX.getValue(),  self.stockMinY.getValue()]
@@ -382,9 +441,9 @@ class SliceTask(MillTask):
         return stock_poly
 
     def generateOutline(self):
-        self.model.calc_outline()
         self.patterns=[]
-        self.patterns.append(self.model.outline)
+        for poly in self.model.calc_silhouette(zlevel=self.sliceBottom.getValue(),  precision=self.precision.getValue()).polygons:
+            self.patterns.append(poly)
 
     def slice(self,  addBoundingBox = True):
         sliceLevel = self.sliceTop.getValue()
@@ -436,10 +495,11 @@ class SliceTask(MillTask):
             #levelOutput.clipToBoundingBox(bound_min[0], bound_min[1], bound_max[0], bound_max[1])
 
             segments = []
+            input_index = SegmentIndex(input.polygons)
             for poly in levelOutput.polygons:
                 segment = []
-                for p in poly:
-                    local_radius, cp, subpoly, ci= input.pointDistance(p)
+                local_radii = input_index.query(poly)[0]
+                for p,  local_radius in zip(poly,  local_radii):
                     segment.append(GPoint(position=p,  dist_from_model = local_radius))
                 # check that start of segment has a larger radius than end (to go inside-out)
  
@@ -475,20 +535,20 @@ class SliceTask(MillTask):
                     segment = []
                     # find segment connected to last added segment
                     if len(output)>0:
-                        for i in range(0, len(segments)):
-                            s = segments[i]
-                            for o in output:
-                                if closest_point_on_open_polygon(s[0].position, [p.position for p in o])[0]<self.precision.getValue():
-                                    s_index=i
-                                    rev=False
-                                    break
+                        output_index = SegmentIndex([[p.position for p in o] for o in output],  closed=False)
+                        start_distances = output_index.query([s[0].position for s in segments])[0]
+                        connected = np.flatnonzero(start_distances<self.precision.getValue())
+                        if len(connected)>0:
+                            s_index=int(connected[-1])
+                            rev=False
 
                 if s_index<0:
                     s_index=0
                 if rev:
                     segments[s_index].reverse()
                 
-                segment+=([p for p in segments[s_index] if stock_poly.pointInside(p.position)])
+                in_stock = stock_poly.pointsInside([p.position for p in segments[s_index]])
+                segment+=([p for p, inside in zip(segments[s_index], in_stock) if inside])
                 #segment+=segments[s_index]
                 
                 lastpoint=segments[s_index][-1]
@@ -527,6 +587,8 @@ class SliceTask(MillTask):
         max_iterations = self.sliceIter.getValue()
         scaling=1000.0
         output=[]
+        # offset stacks of already computed levels, keyed by their quantized input contours
+        levelCache = dict()
         # sort patterns by slice levels
         patternLevels=dict()
         for p in self.patterns:
@@ -545,60 +607,81 @@ class SliceTask(MillTask):
                         [bound_max[0], bound_max[1],  sliceLevel],  
                         [bound_max[0], bound_min[1] ,  sliceLevel]]
             patternLevels[sliceLevel].append(bb)
-            trimPoly = PolygonGroup([bb], precision = self.precision.getValue(),  zlevel = sliceLevel)
+            trimPoly = PolygonGroup([bb], precision = self.precision.getValue(),  zlevel = sliceLevel).toIntegerGroup()
             
             radius=self.tool.getValue().diameter.value/2.0+self.radialOffset.value
             rounding = self.pathRounding.getValue()
 
             iterations=max_iterations
-            input = PolygonGroup(patternLevels[sliceLevel],  precision = self.precision.getValue(),  zlevel = sliceLevel)
+            # keep the offset pipeline in clipper integer coordinates, convert only the output paths
+            input = PolygonGroup(patternLevels[sliceLevel],  precision = self.precision.getValue(),  zlevel = sliceLevel).toIntegerGroup()
+
+            # identical contours as on a previous level - reuse its offsets at the new height
+            levelKey = input.quantizedKey()
+            if levelKey in levelCache:
+                print("reusing offsets of identical level")
+                for poly in levelCache[levelKey]:
+                    output.append([[p[0],  p[1],  sliceLevel] for p in poly])
+                continue
 
             #input = input.offset(radius=0)
             #pockets = [p for p in input.polygons if polygon_chirality(p)>0]
             #input.polygons = pockets
             offsetOutput = []
-            irounding = 0
-            while len(input.polygons)>0 and (max_iterations<=0 or iterations>0):
-                irounding+=2*self.sideStep.value
-                if irounding>rounding:
-                    irounding=rounding
-                offset = input.offset(radius = radius,  rounding = irounding)
-                offset.trim(trimPoly)
-                if self.scalloping.getValue()>0 and iterations!=max_iterations:
-                    interLevels=[]
-                    inter=offset
-                    for i in range(0, int(self.scalloping.getValue())):
-                        inter2 = inter.offset(radius=-1.5*self.sideStep.value)
-                        inter2.trim(input)
-                        inter2 = inter2.offset(radius=self.sideStep.value)
-                        inter2 = inter2.offset(radius=-self.sideStep.value)
-                        inter2.trim(input)
-                        #if inter2.compare(input,  tolerance = 0.1): # check if polygons are the "same" after trimming
-                        #    break
-                            
-                        pathlets = inter2.getDifferentPathlets(input,  tolerance = 0.1)
-                        #pathlets = inter2
-                        for poly in pathlets.polygons:
-                            interLevels.append(poly)
-                        inter = inter2
-                    for poly in reversed(interLevels):
+            if recursive and self.scalloping.getValue()<=0:
+                # without scalloping, the whole offset stack is generated in one pass
+                stack = ConcentricOffset(input,  radius=radius,  stepover=self.sideStep.value,  rounding=rounding,
+                                         roundingStep=2*self.sideStep.value,  trimPoly=trimPoly,  max_iterations=max_iterations)
+                for level in stack.generate():
+                    for poly in level.toPolygonGroup().polygons:
                         #close polygon
-                        #poly.append(poly[0])
+                        poly.append(poly[0])
                         offsetOutput.append(poly)
+            else:
+                irounding = 0
+                while len(input.polygons)>0 and (max_iterations<=0 or iterations>0):
+                    irounding+=2*self.sideStep.value
+                    if irounding>rounding:
+                        irounding=rounding
+                    offset = input.offset(radius = radius,  rounding = irounding)
+                    offset.trim(trimPoly)
+                    if self.scalloping.getValue()>0 and iterations!=max_iterations:
+                        interLevels=[]
+                        inter=offset
+                        reference = input.toPolygonGroup()
+                        for i in range(0, int(self.scalloping.getValue())):
+                            inter2 = inter.offset(radius=-1.5*self.sideStep.value)
+                            inter2.trim(input)
+                            inter2 = inter2.offset(radius=self.sideStep.value)
+                            inter2 = inter2.offset(radius=-self.sideStep.value)
+                            inter2.trim(input)
+                            #if inter2.compare(input,  tolerance = 0.1): # check if polygons are the "same" after trimming
+                            #    break
+                            
+                            pathlets = inter2.toPolygonGroup().getDifferentPathlets(reference,  tolerance = 0.1)
+                            #pathlets = inter2
+                            for poly in pathlets.polygons:
+                                interLevels.append(poly)
+                            inter = inter2
+                        for poly in reversed(interLevels):
+                            #close polygon
+                            #poly.append(poly[0])
+                            offsetOutput.append(poly)
                     
-                for poly in offset.polygons:
-                    #close polygon
-                    poly.append(poly[0])
-                    offsetOutput.append(poly)
-                    print ("p",  len(poly))
-                if recursive:
-                    input  = offset
-                print(len(input.polygons))
-
-                radius = self.sideStep.value
-                iterations -= 1
+                    for poly in offset.toPolygonGroup().polygons:
+                        #close polygon
+                        poly.append(poly[0])
+                        offsetOutput.append(poly)
+                        print ("p",  len(poly))
+                    if recursive:
+                        input  = offset
+                    print(len(input.polygons))
+
+                    radius = self.sideStep.value
+                    iterations -= 1
             #self.patterns = input
             offsetOutput.reverse()
+            levelCache[levelKey] = offsetOutput
             for p in offsetOutput:
                 output.append(p)
         return output
@@ -619,6 +702,8 @@ class SliceTask(MillTask):
             patternLevels[p[0][2]] = []
         for p in self.patterns:
             patternLevels[p[0][2]].append(p)
+        # offset stacks of already computed levels, keyed by their quantized input contours
+        levelCache = dict()
             
         for sliceLevel in sorted(patternLevels.keys(),  reverse=True):
             #define bounding box
@@ -626,7 +711,6 @@ class SliceTask(MillTask):
                         [bound_min[0], bound_max[1],  sliceLevel],  
                         [bound_max[0], bound_max[1],  sliceLevel],  
                         [bound_max[0], bound_min[1] ,  sliceLevel]]
-            bbpoly = [[int(scaling*p[0]), int(scaling*p[1])] for p in bb]  #Pyclipper
 
             print("Slice Level: ", sliceLevel)
             radius=self.tool.getValue().diameter.value/2.0+self.radialOffset.value
@@ -636,55 +720,31 @@ class SliceTask(MillTask):
                 
             input = patternLevels[sliceLevel]
             offsetOutput = []
-            while len(input)>0 and ( iterations>0):
-                offset=[]
-                clip = pyclipper.PyclipperOffset()  #Pyclipper
-                polyclipper = pyclipper.Pyclipper()  #Pyclipper
-                for pat in input:
-                    outPoly=[[int(scaling*p[0]), int(scaling*p[1])] for p in pat]  #Pyclipper
-                    outPoly  = pyclipper.SimplifyPolygons([outPoly])
-                    
-                    try:
-                        polyclipper.AddPaths(outPoly, poly_type=pyclipper.PT_SUBJECT, closed=True)
-                    except:
-                        None
-                        #print "path invalid",  outPoly
-                poly = polyclipper.Execute(pyclipper.CT_UNION, pyclipper.PFT_EVENODD, pyclipper.PFT_EVENODD)
-                clip.AddPaths(poly, pyclipper.JT_ROUND, pyclipper.ET_CLOSEDPOLYGON)
-
-                rounding = self.pathRounding.getValue()
-                offset = clip.Execute( int((radius+rounding)*scaling))
-                offset = pyclipper.SimplifyPolygons(offset)
-                if rounding>0.0:
-                    roundclipper =  pyclipper.PyclipperOffset() 
-                    roundclipper.AddPaths(offset, pyclipper.JT_ROUND, pyclipper.ET_CLOSEDPOLYGON)
-
-                    offset = roundclipper.Execute( int(-rounding*scaling))
-                offset = pyclipper.CleanPolygons(offset,  distance=scaling*self.precision.getValue())
-
-                # trim to outline
-                polytrim = pyclipper.Pyclipper()  #Pyclipper
-                polytrim.AddPath(bbpoly,  poly_type=pyclipper.PT_CLIP, closed=True)
-                polytrim.AddPaths(offset,  poly_type=pyclipper.PT_SUBJECT, closed=True)
-                try:
-                    offset = polytrim.Execute(pyclipper.CT_INTERSECTION, pyclipper.PFT_EVENODD, pyclipper.PFT_EVENODD)
-                except:
-                    print("clipping intersection error")
-                #print (len(offset))
+            # identical contours as on a previous level - reuse its offsets at the new height
+            levelKey = quantized_polygons_key(input,  scaling)
+            if levelKey in levelCache:
+                print("reusing offsets of identical level")
+                offsetOutput = [[[p[0],  p[1],  sliceLevel] for p in poly] for poly in levelCache[levelKey]]
                 input = []
-                for poly in offset:
-                    offsetOutput.append([[x[0]/scaling,  x[1]/scaling, sliceLevel]  for x in reversed(poly)])
-                    if recursive:
-                        input.append([[x[0]/scaling,  x[1]/scaling, sliceLevel]  for x in poly])
-                
-                radius = self.sideStep.value
-                iterations -= 1
+            if len(input)>0:
+                if not recursive:
+                    iterations = 1
+                # generate all outward offsets of this level in one pass, trimmed to the bounding box
+                stack = ConcentricOffset(PolygonGroup(input,  precision=self.precision.getValue(),  scaling=scaling,  zlevel=sliceLevel).toIntegerGroup(),
+                                         radius=radius,  stepover=self.sideStep.value,  rounding=self.pathRounding.getValue(),
+                                         trimPoly=PolygonGroup([bb]),  max_iterations=iterations,  outwards=True)
+                for level in stack.generate():
+                    for poly in level.toPolygonGroup().polygons:
+                        offsetOutput.append([p for p in reversed(poly)])
+            levelCache[levelKey] = offsetOutput
             #self.patterns = input
             #offsetOutput.reverse()
             
             lastpoint = None
             
+            bb_index = SegmentIndex([bb])
             for p in offsetOutput:
+                boundary_distances = bb_index.query(p)[0]
                 closest_point_index = 0
                 path_closed=True
                 remainder_path=[] # append the start of a boundary path to the first boundary point to the end
@@ -692,7 +752,7 @@ class SliceTask(MillTask):
                 opt_path=[]
                 for i in range(0,  len(p)):
                     #check if point lies on boundary
-                    bdist,  bpoint,  bindex = closest_point_on_polygon(p[i],  bb)
+                    bdist = boundary_distances[i]
                     if bdist<0.001 and False: # (TURNED OFF, buggy) point lies on boundary; skip this point
                         # if this is the first boundary point of the path, append the start to the end
                         if path_closed:
@@ -729,15 +789,53 @@ class SliceTask(MillTask):
                 
         return output
 
+    def adaptivePath(self):
+        output=[]
+        # sort patterns by slice levels
+        patternLevels=dict()
+        for p in self.patterns:
+            patternLevels[p[0][2]] = []
+        for p in self.patterns:
+            patternLevels[p[0][2]].append(p)
+
+        radius=self.tool.getValue().diameter.value/2.0+self.radialOffset.value
+        lastpoint = None
+        for sliceLevel in sorted(patternLevels.keys(),  reverse=True):
+            print("Slice Level: ", sliceLevel)
+            bound_min=[self.stockMinX.getValue(),  self.stockMinY.getValue()]
+            bound_max=[bound_min[0]+self.stockSizeX.getValue(),  bound_min[1]+ self.stockSizeY.getValue()]
+
+            bb  =  [[bound_min[0], bound_min[1],  sliceLevel],
+                        [bound_min[0], bound_max[1],  sliceLevel],
+                        [bound_max[0], bound_max[1],  sliceLevel],
+                        [bound_max[0], bound_min[1] ,  sliceLevel]]
+            trimPoly = PolygonGroup([bb], precision = self.precision.getValue(),  zlevel = sliceLevel)
+            input = PolygonGroup(patternLevels[sliceLevel]+[bb],  precision = self.precision.getValue(),  zlevel = sliceLevel).toIntegerGroup()
+
+            clearing = AdaptiveClearing(input,  radius=radius,  engagement=self.engagement.getValue(),  trimPoly=trimPoly,  max_iterations=self.sliceIter.getValue())
+            for level in clearing.generate():
+                for poly in level.toPolygonGroup().polygons:
+                    # closed loops repeat their first point; start them at the point closest to where the last path ended
+                    if lastpoint is not None and len(poly)>2 and poly[0]==poly[-1]:
+                        poly = poly[:-1]
+                        closest_point_index = argmin([dist(lastpoint,  p) for p in poly])
+                        poly = poly[closest_point_index:] + poly[:closest_point_index]
+                        poly.append(poly[0])
+                    output.append([GPoint(position=(p[0],  p[1],  sliceLevel)) for p in poly])
+                    lastpoint = poly[-1]
+        return output
+
     def calcPath(self):
 
         patterns = self.patterns
         if self.operation.value=="Medial Lines":
             medial = self.medial_lines()
             medialGcode = GCode()
+            medialGcode.path = Toolpath()
             lastpoint = None
             for path in medial:
 
+                medialGcode.path.startSegment()
                 if lastpoint is None:
                     lastpoint = path[0]
                     medialGcode.append(GPoint(position=(lastpoint.position[0], lastpoint.position[1],  self.traverseHeight.getValue()),   rapid=True))
@@ -746,32 +844,39 @@ class SliceTask(MillTask):
                     medialGcode.append(GPoint(position=(lastpoint.position[0], lastpoint.position[1],  self.traverseHeight.getValue()),   rapid=True))
                     medialGcode.append(GPoint(position=(path[0].position[0], path[0].position[1],  self.traverseHeight.getValue()),  rapid=True))
 
-                for p in path:
-                    medialGcode.append(p)
-                    lastpoint = p
+                medialGcode.path.extend(path)
+                lastpoint = path[-1]
             if lastpoint is not None:
                 medialGcode.append(GPoint(position=(lastpoint.position[0], lastpoint.position[1], self.traverseHeight.getValue()),rapid=True))
             return medialGcode
 
-        if self.operation.value=="Outline" or self.operation.value=="Slice" or self.operation.value=="Slice & Drop":
+        if self.operation.value=="Outline" or self.operation.value=="Slice" or self.operation.value=="Slice & Drop" or self.operation.value=="Adaptive":
             recursive = True
             offset_path=[]
             lastpoint = None
-            if self.direction.getValue() == "inside out":
+            if self.operation.value=="Adaptive":
+                # loops are already ordered from the cores outwards, level by level
+                offset_path=self.adaptivePath()
+                self.path=GCode()
+                self.path.path=Toolpath()
+            elif self.direction.getValue() == "inside out":
                 offset_path=self.offsetPath(recursive)
                 self.path=GCode()
+                self.path.path=Toolpath()
                 patterns = []
                 #self.path+=p
                 optimisePath=True
                 if optimisePath:
                     path_tree = polygon_tree()
                     
-                    for p in reversed( offset_path):
-                        path_tree.insert(p)
+                    path_tree.insertAll(list(reversed(offset_path)))
                     #path_tree.optimise()
                     #offset_path = path_tree.toList()
                     #if self.direction.getValue() == "inside out": # reverse path order (paths are naturally inside outwards
-                    offset_path = path_tree.toGPoints()
+                    if self.pathOrder.getValue() == "shortest rapids":
+                        offset_path = path_tree.toGPointsOrdered()
+                    else:
+                        offset_path = path_tree.toGPoints()
                 else:
                     offset_path = [[GPoint(position=(p[0], p[1],  p[2])) for p in segment] for segment in offset_path]
 
@@ -779,20 +884,23 @@ class SliceTask(MillTask):
             else: # outside-in roughing
                 offset_path=self.offsetPathOutIn(recursive)
                 self.path=GCode()
+                self.path.path=Toolpath()
                 #offset_path = [[GPoint(position=(p[0], p[1],  p[2])) for p in segment] for segment in offset_path]
 
                 optimisePath = True
                 if optimisePath:
                     path_tree = polygon_tree()
 
-                    for p in reversed(offset_path):
-                        path_tree.insert(p)
+                    path_tree.insertAll(list(reversed(offset_path)))
 
                     #self.viewUpdater()
                     #path_tree.optimise()
                     # offset_path = path_tree.toList()
                     # if self.direction.getValue() == "inside out": # reverse path order (paths are naturally inside outwards
-                    offset_path = [seg for seg in reversed(path_tree.toGPoints())]
+                    if self.pathOrder.getValue() == "shortest rapids":
+                        offset_path = path_tree.toGPointsOrdered(outside_in=True)
+                    else:
+                        offset_path = [seg for seg in reversed(path_tree.toGPoints())]
                 else:
                     offset_path = [[GPoint(position=(p[0], p[1], p[2])) for p in segment] for segment in offset_path]
 
@@ -800,6 +908,14 @@ class SliceTask(MillTask):
             #else:
             #    offset_path = path_tree.toGPointsOutIn()
             slice_patterns=[]
+            link_height = None
+            if self.linking.getValue() == "stay down" and not self.operation.value=="Slice & Drop":
+                link_height = self.linkHeightFunction(self.stockToLeave())
+            cleared = None
+            adaptive = self.operation.value=="Adaptive"
+            # highest start of the paths from each one onwards: the top of the material not cut yet
+            uncut_tops = np.maximum.accumulate(np.array([path[0].position[2] for path in offset_path], dtype=float)[::-1])[::-1]
+            path_index = 0
             #for path in offset_path:
             while len(offset_path)>0:
                 #do_rapid = True
@@ -822,14 +938,34 @@ class SliceTask(MillTask):
                 path = offset_path[0]
                 del offset_path[0]
                 opt_path = path
+                uncut_top = uncut_tops[path_index]
+                path_index += 1
             
                 if not self.operation.value=="Slice & Drop":
-                    if lastpoint is None or dist(lastpoint.position,  opt_path[0].position)>2*self.sideStep.value:
+                    self.path.path.startSegment()
+                    level = opt_path[0].position[2]
+                    if cleared is None or cleared.level != level:
+                        cleared = ClearedArea(self.tool.getValue().diameter.value/2.0,  level,  precision=self.precision.getValue())
+                    link = None
+                    if adaptive and lastpoint is not None:
+                        # adaptive runs only feed across material that is already gone, the engagement isn't bounded anywhere else
+                        if cleared.containsLink(lastpoint.position,  opt_path[0].position):
+                            link = []
+                    elif link_height is not None and lastpoint is not None:
+                        # stay at slice level if the straight move clears the model and only passes through material cut at this level
+                        link = self.findLink(lastpoint.position,  opt_path[0].position,  link_height,  follow_surface=False)
+                        if link is not None and not cleared.containsLink(lastpoint.position,  opt_path[0].position):
+                            link = None
+                    if link is None and (lastpoint is None or adaptive or dist(lastpoint.position,  opt_path[0].position)>2*self.sideStep.value):
+                        height = self.traverseHeight.value
                         if lastpoint is not None:
-                            self.path.append(GPoint(position=(lastpoint.position[0], lastpoint.position[1],  self.traverseHeight.value),  rapid=True))
-                        self.path.append(GPoint(position=(opt_path[0].position[0], opt_path[0].position[1],  self.traverseHeight.value),  rapid=True))
-                    for p in opt_path:
-                        self.path.append(p)
+                            # material above the highest level that hasn't been cut yet is still there
+                            height = self.retractHeight(lastpoint.position,  opt_path[0].position,  floor=uncut_top)
+                            self.path.append(GPoint(position=(lastpoint.position[0], lastpoint.position[1],  height),  rapid=True))
+                        self.path.append(GPoint(position=(opt_path[0].position[0], opt_path[0].position[1],  height),  rapid=True))
+                    self.path.path.extend(opt_path)
+                    if link_height is not None or adaptive:
+                        cleared.add([p.position for p in opt_path])
                     #self.path.append(GPoint(position=(opt_path[0].position[0], opt_path[0].position[1],  opt_path[0].position[2])))
                     lastpoint = opt_path[-1]
                 else:
@@ -1,8 +1,10 @@
 from guifw.abstractparameters import *
 from gcode import *
+from toolpath import *
 from PyQt5 import QtGui
 
 import datetime
+import math
 import geometry
 import traceback
 
@@ -38,8 +40,9 @@ class PathTool(ItemWithParameters):
             #print self.path.path
             try:
                 if self.path is not None and self.path.getPathLength()>0:
-                    startdepth=max([p.position[2] for p in self.path.get_draw_path() if p.position is not None])
-                    enddepth=min([p.position[2] for p in self.path.get_draw_path() if p.position is not None])
+                    depths = self.path.get_draw_arrays(rotate=False)["position"][:, 2]
+                    startdepth=depths.max()
+                    enddepth=depths.min()
             except Exception as e:
                 print("path error:", e)
                 traceback.print_exc()
@@ -48,6 +51,8 @@ class PathTool(ItemWithParameters):
         self.maxDepthStep=NumericalParameter(parent=self,  name='max. depth step',  value=10.0,  min=0.1,  max=100,  step=1)
         self.rampdown=NumericalParameter(parent=self,  name='rampdown per loop (0=off)',  value=0.1,  min=0.0,  max=10,  step=0.01)
         self.traverseHeight=NumericalParameter(parent=self,  name='traverse height',  value=startdepth+5.0,  enforceRange=False,  step=1.0)
+        self.retract=ChoiceParameter(parent=self,  name="Retract",  choices=["traverse height",  "minimum height"],  value="traverse height")
+        self.clearance=NumericalParameter(parent=self, name="retract clearance",  value=2.0,  min=0.0,  max=100.0,  step=0.1)
         self.laser_mode = NumericalParameter(parent=self,  name='laser mode',  value=0.0,  min=0.0,  max=1.0,  enforceRange=True,  step=1.0)
         self.depthStepping=ActionParameter(parent=self,  name='Depth ramping',  callback=self.applyDepthStep)
         self.depthSteppingRelRamp = CheckboxParameter(parent=self, name='relative ramping')
@@ -71,6 +76,8 @@ class PathTool(ItemWithParameters):
         self.plunge_feedrate = NumericalParameter(parent=self, name='plunge feedrate', value=feedrate/2.0, min=1, max=5000,
                                            step=10, callback=self.updateEstimate)
         self.filename=TextParameter(parent=self,  name="output filename",  value=outputFile)
+        self.outputFormat=ChoiceParameter(parent=self,  name="output format",  choices=["full",  "compact"],  value="full")
+        self.outputDecimals=NumericalParameter(parent=self,  name='output decimals',  value=3,  min=0,  max=6,  step=1)
         self.saveButton=ActionParameter(parent=self,  name='Save to file',  callback=self.save)
         self.appendButton=ActionParameter(parent=self,  name='append from file',  callback=self.appendFromFile)
         self.estimatedTime=TextParameter(parent=self,  name='est. time',  editable=False)
@@ -81,6 +88,7 @@ class PathTool(ItemWithParameters):
                                     self.maxDepthStep,  
                                     self.rampdown,  
                                     self.traverseHeight,   
+                                    [self.retract,  self.clearance],
                                     self.laser_mode, 
                                     [self.depthStepping, self.depthSteppingRelRamp],
                                     [self.tabs, self.tabwidth, self.tabheight],
@@ -94,6 +102,7 @@ class PathTool(ItemWithParameters):
                                     self.trochoidalMilling, 
                                     self.feedrate, self.plunge_feedrate,
                                     self.filename,  
+                                    [self.outputFormat,  self.outputDecimals],
                                     self.saveButton, 
                                     self.appendButton, 
                                     self.estimatedTime,  
@@ -105,6 +114,17 @@ class PathTool(ItemWithParameters):
         self.outpaths=[self.path]
         self.updateView()
 
+    # as updatePath, after an edit that replaced the rows start..old_end-1 of the path by start..new_end-1.
+    # The viewer only redraws these rows.
+    def updatePathRange(self, path, start, old_end, new_end, viewer=None):
+        if viewer is None:
+            self.updatePath(path)
+            return
+        self.path = path
+        self.outpaths=[self.path]
+        viewer.updatePathRange(self.getCompletePath(), start, old_end, new_end, tool=self.tool)
+        self.updateEstimate()
+
     def applyInvertPath(self):
         if len(self.outpaths)==0:
             self.path.outpaths=GCode()
@@ -245,8 +265,14 @@ class PathTool(ItemWithParameters):
 
     def getCompletePath(self):
         completePath = GCode(path=[])
+        if len(self.outpaths) > 0 and len([p for p in self.outpaths if not isinstance(p.path, Toolpath)]) == 0:
+            # keep the combined path columnar (written in blocks), with the axis configuration of the paths
+            first = self.outpaths[0].path
+            completePath.path = Toolpath(axis_mapping=first.axis_mapping, axis_scaling=first.axis_scaling, rot_axis_mapping=first.rot_axis_mapping)
         completePath.default_feedrate=self.feedrate.getValue()
         completePath.laser_mode = (self.laser_mode.getValue() > 0.5)
+        completePath.compact = self.outputFormat.getValue() == "compact"
+        completePath.precision = [int(self.outputDecimals.getValue())]*3
         print("gCP lasermode", completePath.laser_mode, self.laser_mode.getValue())
         for path in self.outpaths:
             completePath.combinePath(path)
@@ -269,10 +295,13 @@ class PathTool(ItemWithParameters):
         self.path.default_feedrate = self.feedrate.getValue()
         estimate = None
 
-        estimate = self.getCompletePath().estimate()
+        estimate = self.getCompletePath().plannerEstimate()
         print(estimate)
-        self.estimatedTime.updateValue("%s (%s)"%(str(datetime.timedelta(seconds=int(estimate[1]*60))),
-                                                           str(datetime.timedelta(seconds=int(estimate[5]*60)))))
+        estimated_time = "%s (%s)"%(str(datetime.timedelta(seconds=int(estimate[1]*60))),
+                                    str(datetime.timedelta(seconds=int(estimate[5]*60))))
+        if not default_limits.from_controller:
+            estimated_time += " [default limits]"
+        self.estimatedTime.updateValue(estimated_time)
         self.estimatedDistance.updateValue("{:.1f} (c {:.0f})".format(estimate[0],  estimate[3],  estimate[4]))
 
 
@@ -293,6 +322,8 @@ class PathTool(ItemWithParameters):
 
 
     def segmentPath(self, path):
+        if isinstance(path, Toolpath):
+            return self.segmentToolpath(path)
         buffered_points = []  # points that need to be finished after rampdown
         # split into segments of closed loops, or separated by rapids
         segments = []
@@ -313,6 +344,26 @@ class PathTool(ItemWithParameters):
             buffered_points = []
         return segments
 
+    # same segmentation as segmentPath on the columns of a Toolpath, returning Toolpath slices
+    def segmentToolpath(self, path):
+        points = path.select((path.flags & COMMAND) == 0)
+        x = points.position[:, 0].tolist()
+        y = points.position[:, 1].tolist()
+        rapid = points.rapid.tolist()
+        segments = []
+        start = 0
+        for i in range(0, len(points)):
+            if rapid[i] and i > start: #flush at rapids
+                segments.append(points[start:i])
+                start = i
+            # detect closed loops,
+            if i-start >= 2 and math.hypot(x[start]-x[i], y[start]-y[i]) < 0.00001:
+                segments.append(points[start:i+1])
+                start = i+1
+        if start < len(points):
+            segments.append(points[start:])
+        return segments
+
     def applyTabbing(self, segment, tabs, tabwidth, tabheight):
         seg_len = polygon_closed_length2D(segment)
         if seg_len<=tabs*tabwidth:
@@ -337,7 +388,7 @@ class PathTool(ItemWithParameters):
 
     def applyRampDown(self, segment, previousCutDepth, currentDepthLimit, rampdown, relative_ramping = False, axis = 2, axis_scaling = 1):
         lastPoint=None
-        output = []
+        output = Toolpath(axis_mapping=segment[0].axis_mapping, axis_scaling=segment[0].axis_scaling)
 
         if relative_ramping:
             seg_len = polygon_closed_length2D(segment)
@@ -381,8 +432,7 @@ class PathTool(ItemWithParameters):
                                   inside_model=p.inside_model, in_contact=False, axis_mapping = p.axis_mapping, axis_scaling=p.axis_scaling))
             for p in reversed(ramp):
                 output.append(p)
-            for p in segment[1:]:
-                output.append(p)
+            output.extend(segment[1:])
             p=segment[-1]
             newpoint = [x for x in p.position]
             newpoint[axis] = self.traverseHeight.getValue() * axis_scaling
@@ -413,22 +463,54 @@ class PathTool(ItemWithParameters):
         return output
 
     def applyStepping(self, segment, currentDepthLimit, finished, axis = 2, axis_scaling = 1):
-        output = []
-        for p in segment:
-            # is_in_contact=p.in_contact
-            is_in_contact = True
-            nd = p.position[axis] / axis_scaling
-            if nd < currentDepthLimit:
-                nd = currentDepthLimit
-                is_in_contact = False;
-                finished = False
-
-            newpoint = [x for x in p.position]
-            newpoint[axis] = axis_scaling * nd
-            output.append(GPoint(position=newpoint, rapid=p.rapid,
-                                  inside_model=p.inside_model, in_contact=is_in_contact, axis_mapping = p.axis_mapping, axis_scaling=p.axis_scaling))
+        source = segment if isinstance(segment, Toolpath) else Toolpath.fromPoints(segment)
+        output = Toolpath.fromArrays(source.position, rapid=source.rapid, inside_model=source.inside_model)
+        output.axis_mapping = segment[0].axis_mapping
+        output.axis_scaling = segment[0].axis_scaling
+        # limit all points to the current depth; limited points are not in contact with the final surface
+        depth = source.position[:, axis] / axis_scaling
+        below = depth < currentDepthLimit
+        output.position[:, axis] = axis_scaling * where(below, currentDepthLimit, depth)
+        output.flags[below] &= ~uint8(IN_CONTACT)
+        if below.any():
+            finished = False
         return output, finished
 
+    # Lowers rapid moves between two cutting points to the minimum safe height: the highest cutter
+    # location along the rapids (from the model clearance map), the end points and floor (depth of
+    # the previous layer), plus clearance. Rapids are only ever lowered, never raised.
+    def lowerRetracts(self,  path,  floor):
+        if self.retract.getValue() != "minimum height" or self.model is None or self.tool is None or self.path.steppingAxis != 2:
+            return path
+        # same tool radius and stock to leave as the retracts of the task that made the path
+        offset = 0.0
+        if self.source is not None and hasattr(self.source,  "stockToLeave"):
+            offset = self.source.stockToLeave()
+        output = path[:]
+        i = 0
+        while i < len(output):
+            if not output[i].rapid:
+                i += 1
+                continue
+            j = i
+            while j < len(output) and output[j].rapid:
+                j += 1
+            if i > 0 and j < len(output):
+                # lift, traverse and plunge between two cutting points
+                waypoints = [output[i-1].position] + [p.position for p in output[i:j]] + [output[j].position]
+                height = max([output[i-1].position[2],  output[j].position[2],  floor])
+                model_height = self.model.get_retract_height(waypoints,  self.tool.diameter.getValue()/2.0,  offset)
+                if model_height is not None:
+                    height = max(height,  model_height)
+                height = min(height + self.clearance.getValue(),  self.traverseHeight.getValue())
+                for k in range(i,  j):
+                    p = output[k]
+                    if p.position[2] > height:
+                        output[k] = GPoint(position=(p.position[0],  p.position[1],  height),  rapid=True,
+                                           inside_model=p.inside_model,  in_contact=False,  axis_mapping=p.axis_mapping,  axis_scaling=p.axis_scaling)
+            i = j
+        return output
+
     def applyDepthStep(self):
         print("apply depth stepping")
         self.outpaths=[]
@@ -452,7 +534,7 @@ class PathTool(ItemWithParameters):
 
         while not finished:
             finished=True
-            newpath=[]
+            newpath=Toolpath(axis_mapping=self.path.path[0].axis_mapping, axis_scaling=self.path.path[0].axis_scaling)
 
             prev_segment = None
 
@@ -467,17 +549,19 @@ class PathTool(ItemWithParameters):
                 if self.tabs.getValue()>0:
                     self.applyTabbing(segment_output, self.tabs.getValue(), self.tabwidth.getValue(), self.tabheight.getValue())
 
-                for p in segment_output:
-                    newpath.append(p)
+                newpath.startSegment()
+                newpath.extend(segment_output)
 
+                positions = s.position.tolist() if isinstance(s, Toolpath) else [p.position for p in s]
                 if prev_segment is None:
-                    prev_segment = [p.position for p in s]
+                    prev_segment = positions
                 else:
-                    prev_segment += [p.position for p in s]
+                    prev_segment += positions
 
             if currentDepthLimit<=endDepth:
                 finished=True
 
+            newpath = self.lowerRetracts(newpath,  previousCutDepth)
             previousCutDepth=currentDepthLimit
             currentDepthLimit-=depthStep
             if currentDepthLimit<endDepth:
@@ -557,6 +641,7 @@ class PathTool(ItemWithParameters):
 
                         steps =  int(float(steps_per_rev)*dist/distPerRev)+1
                         dradius = 0.0
+                        samples = []
                         for i in range(0,  steps):
                             angle -= (dist/float(distPerRev) / float(steps)) * 2.0*PI
                             dradius = radius
@@ -574,9 +659,15 @@ class PathTool(ItemWithParameters):
                             x = lastPoint.position[0]*(1.0-(float(i)/steps)) + p.position[0]*(float(i)/steps) + dradius * sin(angle)
                             y = lastPoint.position[1]*(1.0-(float(i)/steps)) + p.position[1]*(float(i)/steps) + dradius * cos(angle)
                             z = lastPoint.position[2]*(1.0-(float(i)/steps)) + p.position[2]*(float(i)/steps)
+                            samples.append((x, y, z))
 
+                        # classify all samples of this segment against the stock at once
+                        in_stock = None
+                        if stock_poly is not None:
+                            in_stock = stock_poly.pointsInside(samples)
+                        for i, (x, y, z) in enumerate(samples):
                             cutting = True
-                            if stock_poly is not None and not stock_poly.pointInside((x, y, z)):
+                            if in_stock is not None and not in_stock[i]:
                                 cutting = False
                             for cp in self.path.path[0:p_index]:
                                 if cp.dist_from_model is not None and geometry.dist((x, y, z), cp.position) < min(radius, cp.dist_from_model) - 0.5*self.trochoidalStepover.getValue():
@@ -591,6 +682,7 @@ class PathTool(ItemWithParameters):
                             distPerRev = self.trochoidalStepover.getValue()
                             dist = min(radius, p.dist_from_model) - dradius + distPerRev
                             steps = int(float(steps_per_rev) * (dist / distPerRev) )
+                            samples = []
                             for i in range(0, steps):
                                 angle -= (dist / float(distPerRev) / float(steps)) * 2.0 * PI
                                 dradius += dist/steps
@@ -599,8 +691,13 @@ class PathTool(ItemWithParameters):
                                 x = p.position[0] + dradius * sin(angle)
                                 y = p.position[1] + dradius * cos(angle)
                                 z = p.position[2]
+                                samples.append((x, y, z))
+                            in_stock = None
+                            if stock_poly is not None:
+                                in_stock = stock_poly.pointsInside(samples)
+                            for i, (x, y, z) in enumerate(samples):
                                 cutting = True
-                                if stock_poly is not None and not stock_poly.pointInside((x, y, z)):
+                                if in_stock is not None and not in_stock[i]:
                                     cutting = False
                                 if cutting:
                                     newpath.append(GPoint(position = (x,  y,  z),  rapid = p.rapid,  inside_model=p.inside_model,  in_contact=p.in_contact))